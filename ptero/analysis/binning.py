@@ -0,0 +1,219 @@
+import hashlib
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Custom function declarations
+from data_io.result_cache import ResultCache
+from pipeline import FitsPoints
+
+# Bin assignments are reused for as long as the map, errors, mask and target
+# are unchanged; keyed by content hashes so a reloaded file still hits
+BIN_CACHE = ResultCache(maxsize=8)
+
+class SpatialBins:
+    """
+    Assignment of pixels to spatial bins.
+
+    labels has the shape of the pixel grid, holding the bin of every pixel
+    (-1 for masked or unusable pixels). centroid_x/centroid_y are the S/N
+    weighted bin centres in pixels and sn the S/N each bin reached.
+    """
+    def __init__(self, labels, centroid_x, centroid_y, sn):
+        self.labels = labels
+        self.centroid_x = centroid_x
+        self.centroid_y = centroid_y
+        self.sn = sn
+
+    @property
+    def n_bins(self):
+        return len(self.sn)
+
+    def reduce(self, values, weights=None):
+        '''Weighted mean of values (pixel grid or flattened) over each bin; NaN values are ignored.'''
+        values = np.ravel(values).astype(float)
+        weights = np.ones_like(values) if weights is None else np.ravel(weights).astype(float)
+        labels = self.labels.ravel()
+        use = (labels >= 0) & np.isfinite(values) & np.isfinite(weights)
+        total = np.bincount(labels[use], weights[use] * values[use], minlength=self.n_bins)
+        norm = np.bincount(labels[use], weights[use], minlength=self.n_bins)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return total / norm
+
+    def to_map(self, bin_values):
+        '''Paint one value per bin back onto the pixel grid (NaN outside every bin).'''
+        full = np.full(self.labels.shape, np.nan)
+        inside = self.labels >= 0
+        full[inside] = np.asarray(bin_values)[self.labels[inside]]
+        return full
+
+def _bin_stats(labels, rows, cols, signal, noise2, n_bins):
+    total_signal = np.bincount(labels, signal, minlength=n_bins)
+    total_noise = np.sqrt(np.bincount(labels, noise2, minlength=n_bins))
+    weight = np.clip(signal**2 / noise2, 0, None)
+    norm = np.bincount(labels, weight, minlength=n_bins)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sn = total_signal / total_noise
+        cx = np.bincount(labels, weight * cols, minlength=n_bins) / norm
+        cy = np.bincount(labels, weight * rows, minlength=n_bins) / norm
+    # Bins of pixels with zero weight fall back to their plain centroid
+    count = np.bincount(labels, minlength=n_bins)
+    plain = ~np.isfinite(cx)
+    if plain.any():
+        cx[plain] = (np.bincount(labels, cols, minlength=n_bins) / np.maximum(count, 1))[plain]
+        cy[plain] = (np.bincount(labels, rows, minlength=n_bins) / np.maximum(count, 1))[plain]
+    return sn, cx, cy
+
+def sn_bin(flux, err, target_sn, mask=None, max_level=None, cvt_iterations=3):
+    """
+    Group pixels into compact bins that each reach a target signal-to-noise.
+
+    Parameters:
+    - flux, err: 2D signal and 1-sigma noise maps
+    - target_sn: S/N each bin should reach
+    - mask: bad pixel mask (True = bad), or None
+    - max_level: largest accretion block is 2**max_level pixels across (default: whole map)
+    - cvt_iterations: Voronoi regularisation passes (0 to keep the square blocks)
+
+    Pixels already above target stay single. The rest are accreted into
+    square blocks of doubling size until each block of still-unbinned pixels
+    reaches the target (all vectorised with bincount). Leftovers join their
+    nearest bin, then bins are reshaped into a centroidal Voronoi tessellation
+    by repeatedly assigning every pixel to its nearest S/N-weighted centroid
+    with a KD-tree, as in Cappellari & Copin (2003).
+    """
+    flux = np.asarray(flux, dtype=float)
+    err = np.asarray(err, dtype=float)
+    shape = flux.shape
+    good = np.isfinite(flux) & np.isfinite(err) & (err > 0)
+    if mask is not None:
+        good &= ~np.asarray(mask, dtype=bool).reshape(shape)
+
+    index = np.flatnonzero(good)
+    rows, cols = np.unravel_index(index, shape)
+    signal = flux.ravel()[index]
+    noise2 = err.ravel()[index]**2
+    labels = np.full(len(index), -1)
+    n_bins = n_single = 0
+
+    if max_level is None:
+        max_level = int(np.ceil(np.log2(max(shape)))) if max(shape) > 1 else 0
+
+    # Accretion: blocks of 1, 2, 4, ... pixels across, over the pixels still unbinned
+    for level in range(max_level + 1):
+        free = np.flatnonzero(labels < 0)
+        if len(free) == 0:
+            break
+        size = 2**level
+        block = (rows[free] // size) * (shape[1] // size + 1) + cols[free] // size
+        block_signal = np.bincount(block, signal[free])
+        block_noise = np.sqrt(np.bincount(block, noise2[free]))
+        done = (block_signal >= target_sn * block_noise) & (block_noise > 0)
+        if done.any():
+            new_ids = np.full(len(done), -1)
+            new_ids[done] = n_bins + np.arange(done.sum())
+            labels[free] = new_ids[block]
+            n_bins += int(done.sum())
+        if level == 0:
+            n_single = n_bins
+
+    if n_bins == 0:
+        # Nothing reaches the target even summed over the whole map
+        labels[:] = 0
+        n_bins = 1 if len(index) else 0
+        if n_bins == 0:
+            return SpatialBins(np.full(shape, -1), np.zeros(0), np.zeros(0), np.zeros(0))
+
+    sn, cx, cy = _bin_stats(labels[labels >= 0], rows[labels >= 0], cols[labels >= 0],
+                            signal[labels >= 0], noise2[labels >= 0], n_bins)
+
+    # Leftover pixels join the bin with the nearest centroid
+    xy = np.column_stack([cols, rows]).astype(float)
+    leftover = labels < 0
+    if leftover.any():
+        _, labels[leftover] = cKDTree(np.column_stack([cx, cy])).query(xy[leftover], workers=-1)
+        sn, cx, cy = _bin_stats(labels, rows, cols, signal, noise2, n_bins)
+
+    # Voronoi passes: pixels of accreted bins move to the nearest accreted
+    # centroid until nothing changes; single pixels above target stay put
+    movable = labels >= n_single
+    for _ in range(cvt_iterations):
+        if n_bins == n_single:
+            break
+        _, nearest = cKDTree(np.column_stack([cx[n_single:], cy[n_single:]])).query(xy[movable], workers=-1)
+        nearest += n_single
+        if np.array_equal(nearest, labels[movable]):
+            break
+        labels[movable] = nearest
+        # Drop bins that lost every pixel, renumbering the rest
+        used = np.bincount(labels, minlength=n_bins) > 0
+        labels = (np.cumsum(used) - 1)[labels]
+        n_bins = int(used.sum())
+        sn, cx, cy = _bin_stats(labels, rows, cols, signal, noise2, n_bins)
+
+    label_map = np.full(shape, -1)
+    label_map.flat[index] = labels
+    return SpatialBins(label_map, cx, cy, sn)
+
+def _digest(array):
+    if array is None:
+        return None
+    array = np.ascontiguousarray(array)
+    return hashlib.blake2b(array.view(np.uint8), digest_size=16).hexdigest()
+
+def cached_sn_bin(flux, err, target_sn, mask=None, **kwargs):
+    '''sn_bin with results kept in BIN_CACHE, keyed by the content of every input.'''
+    key = ('sn_bin', np.shape(flux), _digest(flux), _digest(err), _digest(mask), target_sn, tuple(sorted(kwargs.items())))
+    return BIN_CACHE.get_or_compute(key, lambda: sn_bin(flux, err, target_sn, mask, **kwargs))
+
+def bin_points(points, target_sn, mask=None, signal='y', **kwargs):
+    """
+    Bin FitsPoints to a target S/N and return one FitsPoints entry per bin.
+
+    The S/N comes from the <signal> ('x' or 'y') values and their errors; x
+    and y are inverse-variance weighted means where errors exist (plain means
+    otherwise) and z is the mean. mask overrides points.mask.
+    """
+    values = getattr(points, signal)
+    errors = getattr(points, f'{signal}_err')
+    if errors is None:
+        raise ValueError(f'S/N binning needs errors for the {signal} map (e.g. a FLUX_ERR extension)')
+    if len(points.shape) != 2:
+        raise ValueError(f'FITS data has shape {points.shape}; spatial binning needs 2D data')
+
+    mask = points.mask if mask is None else mask
+    bins = cached_sn_bin(np.reshape(values, points.shape), np.reshape(errors, points.shape), target_sn, np.reshape(mask, points.shape), **kwargs)
+
+    def weighted(vals, errs):
+        if errs is None:
+            return bins.reduce(vals), None
+        with np.errstate(divide='ignore', invalid='ignore'):
+            w = 1 / np.asarray(errs, dtype=float)**2
+        w = np.where(np.isfinite(w) & np.isfinite(vals), w, 0.0)
+        mean = bins.reduce(vals, w)
+        # Error of an inverse-variance weighted mean is 1/sqrt(sum of weights)
+        labels = bins.labels.ravel()
+        total = np.bincount(labels[labels >= 0], w[labels >= 0], minlength=bins.n_bins)
+        with np.errstate(divide='ignore'):
+            return mean, 1 / np.sqrt(total)
+
+    x, x_err = weighted(points.x, points.x_err)
+    y, y_err = weighted(points.y, points.y_err)
+    z = bins.reduce(points.z)
+    return FitsPoints(x, y, z, shape=(bins.n_bins,), x_err=x_err, y_err=y_err), bins
+
+def bin_pixel_points(points, target_sn, mask=None, signal='y', **kwargs):
+    """
+    FitsPoints on the original pixel grid where every pixel carries its bin's values.
+
+    Same binning as bin_points (sharing its cached bin assignment). Pixel
+    tools (linked brushing, the inspector) built on these see the binned
+    diagram positions, so a lasso around a plotted bin selects every pixel
+    in it. Pixels outside every bin are masked.
+    """
+    binned, bins = bin_points(points, target_sn, mask, signal, **kwargs)
+
+    def paint(values):
+        return bins.to_map(values).ravel() if values is not None else None
+
+    return FitsPoints(paint(binned.x), paint(binned.y), paint(binned.z), bins.labels.ravel() < 0, points.shape,
+                      paint(binned.x_err), paint(binned.y_err))
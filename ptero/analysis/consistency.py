@@ -0,0 +1,163 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Custom function declarations
+from analysis.inference import DEFAULT_CHUNK_SIZE, ShockInference
+from profiling import span
+
+# Does a pixel's velocity dispersion agree with the shock velocity its
+# position on the diagram implies? Every unmasked pixel is placed on the
+# model grid (nearest model point or linear interpolation, as in
+# analysis.inference) and its sigma compared with that velocity:
+#
+#   residual    = sigma - sigma_scale * v_model              (km/s)
+#   zscore      = residual / sqrt(sigma_err^2 + tolerance^2)
+#   consistency = exp(-zscore^2 / 2)                         (1 = agrees)
+#
+# tolerance stands in for the model grid's own velocity resolution (half a
+# grid step by default). Pixels are scored in chunks on a thread pool; the
+# KD-tree queries and the triangulation lookups release the GIL.
+
+DEFAULT_BINS = np.arange(-1000, 1001, 25)
+
+class ConsistencySummary:
+    """
+    Residual histogram and summary numbers of one model grid (or model type).
+
+    counts/edges are the residual histogram (km/s); n the scored pixels;
+    median and mad the median residual and its median absolute deviation;
+    fraction the share of scored pixels with |zscore| <= threshold.
+    """
+    def __init__(self, label, counts, edges, n, median, mad, fraction):
+        self.label = label
+        self.counts = counts
+        self.edges = edges
+        self.n = n
+        self.median = median
+        self.mad = mad
+        self.fraction = fraction
+
+    def __repr__(self):
+        return (f'ConsistencySummary({self.label!r}, n={self.n}, median={self.median:.1f} km/s, '
+                f'mad={self.mad:.1f} km/s, consistent={self.fraction:.1%})')
+
+def grid_tolerance(inference):
+    '''Half the median spacing between neighbouring model velocities (km/s).'''
+    vels = np.unique(inference.vels[np.isfinite(inference.vels)])
+    if len(vels) < 2:
+        return 0.0
+    return 0.5 * float(np.median(np.diff(vels)))
+
+def _chunks(n, chunk_size):
+    return [slice(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+
+def score_pixels(inference, x, y, sigma, sigma_err=None, method='nearest', sigma_scale=1.0, tolerance=None,
+                 max_distance=None, chunk_size=DEFAULT_CHUNK_SIZE, workers=None):
+    """
+    Score 1D arrays of pixels against one ShockInference.
+
+    Parameters:
+    - inference: ShockInference of the model grid
+    - x, y: observed diagram positions (linear); sigma, sigma_err: dispersion and its error (km/s)
+    - method: 'nearest' model point or 'linear' interpolation (NaN outside the grid)
+    - sigma_scale: expected sigma per km/s of shock velocity
+    - tolerance: model velocity uncertainty in km/s (default: grid_tolerance)
+    - max_distance: pixels further than this (dex) from every model point are not scored
+    - chunk_size: pixels per task; workers: threads (default: one per CPU)
+
+    Returns a dict of 1D arrays VSHOCK, DISTANCE, RESIDUAL, ZSCORE and
+    CONSISTENCY, NaN where a pixel cannot be scored.
+    """
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float).ravel()
+    sigma = np.asarray(sigma, dtype=float).ravel()
+    sigma_err = None if sigma_err is None else np.asarray(sigma_err, dtype=float).ravel()
+    tolerance = grid_tolerance(inference) if tolerance is None else tolerance
+
+    n = len(x)
+    out = {name: np.full(n, np.nan) for name in ['VSHOCK', 'DISTANCE', 'RESIDUAL', 'ZSCORE', 'CONSISTENCY']}
+
+    def score(chunk):
+        # Each task writes its own slice of the outputs, so no locking is needed
+        vels, _, dist = inference.infer(x[chunk], y[chunk], method, chunk_size=chunk.stop - chunk.start, workers=1)
+        if max_distance is not None:
+            vels[dist > max_distance] = np.nan
+        residual = sigma[chunk] - sigma_scale * vels
+        variance = np.full(len(residual), tolerance**2)
+        if sigma_err is not None:
+            variance += np.nan_to_num(sigma_err[chunk]**2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            zscore = residual / np.sqrt(variance)
+        out['VSHOCK'][chunk] = vels
+        out['DISTANCE'][chunk] = dist
+        out['RESIDUAL'][chunk] = residual
+        out['ZSCORE'][chunk] = zscore
+        # A zero-variance exact match scores 1; any other zero-variance case 0
+        out['CONSISTENCY'][chunk] = np.where(np.isnan(zscore) & (residual == 0), 1.0, np.exp(-0.5 * zscore**2))
+
+    if method == 'linear':
+        # Triangulate once here rather than racing to do it in every thread
+        inference.interpolator
+    chunks = _chunks(n, chunk_size)
+    with span('score_pixels', n_pixels=n, n_chunks=len(chunks)):
+        if len(chunks) <= 1 or workers == 1:
+            for chunk in chunks:
+                score(chunk)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(score, chunks))
+    return out
+
+def summarise_scores(label, scores, threshold=1.0, bins=DEFAULT_BINS):
+    '''ConsistencySummary of the (1D) RESIDUAL and ZSCORE arrays of score_pixels.'''
+    residual = scores['RESIDUAL'][np.isfinite(scores['RESIDUAL'])]
+    zscore = scores['ZSCORE'][np.isfinite(scores['RESIDUAL'])]
+    counts, edges = np.histogram(residual, bins=bins)
+    if len(residual) == 0:
+        return ConsistencySummary(label, counts, edges, 0, np.nan, np.nan, np.nan)
+    median = float(np.median(residual))
+    mad = float(np.median(np.abs(residual - median)))
+    fraction = float(np.mean(np.abs(zscore) <= threshold))
+    return ConsistencySummary(label, counts, edges, len(residual), median, mad, fraction)
+
+def score_consistency(grid, points, method='nearest', sigma_scale=1.0, tolerance=None, max_distance=None,
+                      threshold=1.0, bins=DEFAULT_BINS, chunk_size=DEFAULT_CHUNK_SIZE, workers=None):
+    """
+    Sigma-velocity consistency maps and residual histograms of FitsPoints on a ModelGrid.
+
+    Independent grids are scored against their shock and precursor models
+    separately. Other parameters are those of score_pixels, plus threshold
+    (|zscore| counted as consistent) and bins (residual histogram edges).
+
+    Returns maps and summaries: maps[group] is a dict of maps shaped like
+    the pixel grid (masked pixels NaN), ready for write_inference_maps;
+    summaries[group] the group's ConsistencySummary. group is 'model', or
+    'shock' and 'precursor'.
+    """
+    groups = ['shock', 'precursor'] if grid.selection.independent else ['model']
+    keep = ~points.mask
+    z_err = points.z_err[keep] if points.z_err is not None else None
+
+    maps, summaries = {}, {}
+    for group in groups:
+        inference = ShockInference(grid, group)
+        scores = score_pixels(inference, points.x[keep], points.y[keep], points.z[keep], z_err, method, sigma_scale,
+                              tolerance, max_distance, chunk_size, workers)
+        label = f'{grid.selection.abundance}, {grid.selection.density} cm$^{{-3}}$' + ('' if group == 'model' else f' ({group})')
+        summaries[group] = summarise_scores(label, scores, threshold, bins)
+
+        # Scatter the scored pixels back onto the full grid
+        maps[group] = {}
+        for name, values in scores.items():
+            full = np.full(len(points.x), np.nan)
+            full[keep] = values
+            maps[group][name] = full.reshape(points.shape)
+    return maps, summaries
+
+def score_grids(grids, points, **kwargs):
+    """
+    score_consistency for several ModelGrids (e.g. overlay families) against the same points.
+
+    Returns a list of (grid, maps, summaries), in the order of grids.
+    """
+    return [(grid, *score_consistency(grid, points, **kwargs)) for grid in grids]
@@ -0,0 +1,138 @@
+import numpy as np
+from matplotlib.path import Path
+
+# Cells per side of the log-space lookup raster
+DEFAULT_RESOLUTION = 1024
+
+def grid_mesh(grid, groups='model'):
+    """
+    Stack a ModelGrid group into (n_mag, n_vel) log10 x and y meshes.
+
+    process_df reindexes every magnetic field onto the same velocities, so the
+    grouped DataFrames line up row for row. Returns vels, log_x, log_y.
+    """
+    data_grouped = {
+        'model': grid.model_data_grouped,
+        'shock': grid.shock_data_grouped,
+        'precursor': grid.precursor_data_grouped,
+    }[groups]
+    x_id, y_id = grid.xy_columns()
+    vels = data_grouped[0].iloc[:, 0].to_numpy(dtype=float)
+    x = np.stack([data.iloc[:, x_id].to_numpy(dtype=float) for data in data_grouped])
+    y = np.stack([data.iloc[:, y_id].to_numpy(dtype=float) for data in data_grouped])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return vels, np.log10(x), np.log10(y)
+
+def mesh_bounds(meshes, pad=0.05):
+    '''Padded (x0, x1, y0, y1) log-space box around all finite mesh points.'''
+    log_x = np.concatenate([m[1].ravel() for m in meshes])
+    log_y = np.concatenate([m[2].ravel() for m in meshes])
+    log_x = log_x[np.isfinite(log_x)]
+    log_y = log_y[np.isfinite(log_y)]
+    x0, x1, y0, y1 = log_x.min(), log_x.max(), log_y.min(), log_y.max()
+    dx, dy = (x1 - x0) * pad or pad, (y1 - y0) * pad or pad
+    return x0 - dx, x1 + dx, y0 - dy, y1 + dy
+
+class GridEnvelope:
+    """
+    Area covered by one model grid in log-space diagram coordinates.
+
+    The region between neighbouring magnetic field curves is split into one
+    quadrilateral per velocity interval, and the quadrilaterals are rasterised
+    onto a lookup grid. Each cell stores a 64-bit mask of the velocity
+    intervals covering it, so a new velocity window is just a bitwise AND.
+    """
+    def __init__(self, vels, log_x, log_y, bounds, resolution=DEFAULT_RESOLUTION):
+        if len(vels) - 1 > 64:
+            raise ValueError('GridEnvelope supports at most 64 velocity intervals')
+        self.vels = vels
+        self.bounds = bounds
+        self.resolution = resolution
+        self.lut = np.zeros((resolution, resolution), dtype=np.uint64)
+
+        x0, x1, y0, y1 = bounds
+        cell_w = (x1 - x0) / resolution
+        cell_h = (y1 - y0) / resolution
+
+        for i in range(log_x.shape[0] - 1):
+            for j in range(log_x.shape[1] - 1):
+                qx = np.array([log_x[i, j], log_x[i, j + 1], log_x[i + 1, j + 1], log_x[i + 1, j]])
+                qy = np.array([log_y[i, j], log_y[i, j + 1], log_y[i + 1, j + 1], log_y[i + 1, j]])
+                if not (np.all(np.isfinite(qx)) and np.all(np.isfinite(qy))):
+                    continue
+
+                # Only test the cells inside the quadrilateral's bounding box
+                c0 = max(int((qx.min() - x0) / cell_w), 0)
+                c1 = min(int((qx.max() - x0) / cell_w) + 1, resolution)
+                r0 = max(int((qy.min() - y0) / cell_h), 0)
+                r1 = min(int((qy.max() - y0) / cell_h) + 1, resolution)
+                rows, cols = np.mgrid[r0:r1, c0:c1]
+                centres = np.column_stack([x0 + (cols.ravel() + 0.5) * cell_w, y0 + (rows.ravel() + 0.5) * cell_h])
+                inside = Path(np.column_stack([qx, qy])).contains_points(centres)
+                self.lut[rows.ravel()[inside], cols.ravel()[inside]] |= np.uint64(1) << np.uint64(j)
+
+    def window_bits(self, vmin=None, vmax=None):
+        '''Bit mask of the velocity intervals lying inside [vmin, vmax].'''
+        vmin = self.vels[0] if vmin is None else vmin
+        vmax = self.vels[-1] if vmax is None else vmax
+        bits = np.uint64(0)
+        for j in range(len(self.vels) - 1):
+            if self.vels[j] >= vmin and self.vels[j + 1] <= vmax:
+                bits |= np.uint64(1) << np.uint64(j)
+        return bits
+
+    def cell_index(self, x, y):
+        '''Flat lookup-raster index of every (x, y) point, -1 where off the raster or not loggable.'''
+        x0, x1, y0, y1 = self.bounds
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cols = np.floor((np.log10(x) - x0) / (x1 - x0) * self.resolution)
+            rows = np.floor((np.log10(y) - y0) / (y1 - y0) * self.resolution)
+        good = (cols >= 0) & (cols < self.resolution) & (rows >= 0) & (rows < self.resolution)
+        cells = np.full(len(x), -1, dtype=np.int64)
+        cells[good] = rows[good].astype(np.int64) * self.resolution + cols[good].astype(np.int64)
+        return cells
+
+    def contains_cells(self, cells, vmin=None, vmax=None):
+        '''Boolean array of which precomputed cells fall inside the envelope for a velocity window.'''
+        inside = np.zeros(len(cells), dtype=bool)
+        on_raster = cells >= 0
+        inside[on_raster] = (self.lut.ravel()[cells[on_raster]] & self.window_bits(vmin, vmax)) != 0
+        return inside
+
+class EnvelopeClassifier:
+    """
+    Classify FitsPoints as inside or outside the envelopes of a ModelGrid.
+
+    Independent grids get separate shock and precursor envelopes, otherwise
+    the single plotted grid is used. Every envelope shares one lookup raster,
+    so each pixel's cell is computed once here and classify() only gathers
+    bits, which keeps re-classification for a new velocity window cheap.
+    """
+    def __init__(self, grid, points, resolution=DEFAULT_RESOLUTION):
+        self.groups = ['shock', 'precursor'] if grid.selection.independent else ['model']
+        meshes = [grid_mesh(grid, group) for group in self.groups]
+        bounds = mesh_bounds(meshes)
+        self.envelopes = {group: GridEnvelope(*mesh, bounds, resolution) for group, mesh in zip(self.groups, meshes)}
+        self.shape = points.shape
+        self.cells = self.envelopes[self.groups[0]].cell_index(points.x, points.y)
+
+    def classify(self, vmin=None, vmax=None):
+        """
+        Classify every pixel for a velocity window (default: the whole grid).
+
+        Returns a dict of boolean maps, one per group plus 'combined' (inside
+        any), and an integer 'label' map with bit k set for self.groups[k].
+        """
+        maps = {}
+        label = np.zeros(len(self.cells), dtype=np.uint8)
+        for k, group in enumerate(self.groups):
+            inside = self.envelopes[group].contains_cells(self.cells, vmin, vmax)
+            label |= inside.astype(np.uint8) << k
+            maps[group] = inside.reshape(self.shape)
+        maps['combined'] = (label > 0).reshape(self.shape)
+        maps['label'] = label.reshape(self.shape)
+        return maps
+
+    def outside_mask(self, vmin=None, vmax=None, group='combined'):
+        '''Bad pixel style mask (True = outside the envelope) for feeding back into the plot.'''
+        return ~self.classify(vmin, vmax)[group]
@@ -0,0 +1,222 @@
+import os
+import numpy as np
+from astropy.io import fits
+from concurrent.futures import ProcessPoolExecutor
+
+# Custom function declarations
+from data_io.query_3mdbs_tools import send_3mdbs_grid_query
+
+# Model parameters spanned by the dense grid, in array axis order
+PARAMETERS = ['abundance', 'preshck_dens', 'mag_fld', 'shck_vel']
+
+# Short names used for FITS extensions
+PARAMETER_EXTNAMES = {'abundance': 'ABUN', 'preshck_dens': 'DENS', 'mag_fld': 'BFIELD', 'shck_vel': 'VSHOCK'}
+
+# Pixels sent to a worker at once, and bytes each worker may use for its
+# (pixels x models) chi-square block
+DEFAULT_BLOCK_SIZE = 65536
+DEFAULT_MEMORY_LIMIT = 256 * 2**20
+
+class DenseModelGrid:
+    """
+    Log10 line ratios for every model, held as a dense
+    (abundance, density, B, velocity, ratio) array with NaN for missing models.
+    """
+    def __init__(self, df, ratio_names):
+        self.ratio_names = list(ratio_names)
+        self.axes = {}
+        indices = []
+        for param in PARAMETERS:
+            values = df[param].to_numpy()
+            values = values.astype(str) if param == 'abundance' else values.astype(float)
+            self.axes[param] = np.unique(values)
+            indices.append(np.searchsorted(self.axes[param], values))
+        self.shape = tuple(len(self.axes[param]) for param in PARAMETERS)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_ratios = np.log10(df[self.ratio_names].to_numpy(dtype=float))
+        self.values = np.full(self.shape + (len(self.ratio_names),), np.nan)
+        self.values[tuple(indices)] = log_ratios
+
+    @property
+    def n_models(self):
+        return int(np.prod(self.shape))
+
+    def flat_models(self):
+        '''(n_models, n_ratios) log ratios and a mask of models with every ratio defined.'''
+        models = self.values.reshape(self.n_models, len(self.ratio_names))
+        valid = np.all(np.isfinite(models), axis=1)
+        return models, valid
+
+def fetch_dense_grid(line_ratios, model_type='shock', abundances=None, densities=None, shck_vel_lo=100, shck_vel_hi=1000):
+    """Query every requested (num, den) ratio over the model grid and preload it as a DenseModelGrid."""
+    df = send_3mdbs_grid_query(line_ratios, model_type, abundances, densities, shck_vel_lo, shck_vel_hi)
+    return DenseModelGrid(df, [f'{num}_{den}' for num, den in line_ratios])
+
+def chi_square(obs, weights, models, valid):
+    """
+    Chi-square of every pixel against every model, as an (n_pixels, n_models) array.
+
+    Expands sum(w * (o - m)^2) into three matrix products so the work is done
+    by BLAS rather than a (pixels, models, ratios) temporary. Ratios with zero
+    weight are ignored; models with missing ratios get infinite chi-square.
+    """
+    obs = np.where(weights > 0, obs, 0.0)
+    models = np.where(valid[:, None], models, 0.0)
+
+    chi2 = (weights * obs**2).sum(axis=1)[:, None]
+    chi2 = chi2 - 2.0 * (weights * obs) @ models.T
+    chi2 += weights @ (models**2).T
+
+    # Cancellation can leave tiny negative values for exact matches
+    np.maximum(chi2, 0.0, out=chi2)
+    chi2[:, ~valid] = np.inf
+    return chi2
+
+# Per-process copy of the model grid, set once by _init_worker so it is not
+# pickled again for every block
+_worker_state = {}
+
+def _init_worker(models, valid, shape, memory_limit):
+    _worker_state['models'] = models
+    _worker_state['valid'] = valid
+    _worker_state['shape'] = shape
+    _worker_state['memory_limit'] = memory_limit
+
+def _fit_block(obs, weights):
+    models = _worker_state['models']
+    valid = _worker_state['valid']
+    shape = _worker_state['shape']
+    n_models = len(models)
+
+    # Three (rows, models) float64 arrays live at once: chi2, likelihood and a temporary
+    rows = max(1, _worker_state['memory_limit'] // (3 * 8 * n_models))
+
+    n = len(obs)
+    best = np.zeros(n, dtype=np.int64)
+    chi2_min = np.full(n, np.inf)
+    marginals = [np.zeros((n, size)) for size in shape]
+
+    for start in range(0, n, rows):
+        sub = slice(start, start + rows)
+        chi2 = chi_square(obs[sub], weights[sub], models, valid)
+        best[sub] = np.argmin(chi2, axis=1)
+        chi2_min[sub] = chi2[np.arange(len(chi2)), best[sub]]
+
+        # Likelihood relative to the best fit, marginalised onto each parameter axis
+        likelihood = np.exp(-0.5 * (chi2 - chi2_min[sub, None])).reshape((len(chi2),) + shape)
+        for axis in range(len(shape)):
+            others = tuple(a + 1 for a in range(len(shape)) if a != axis)
+            marginal = likelihood.sum(axis=others)
+            with np.errstate(invalid='ignore'):
+                marginals[axis][sub] = marginal / marginal.sum(axis=1, keepdims=True)
+
+    return best, chi2_min, marginals
+
+def fit_pixels(grid, ratios, errors, workers=None, block_size=DEFAULT_BLOCK_SIZE, memory_limit=DEFAULT_MEMORY_LIMIT):
+    """
+    Fit each pixel's line ratios against every model in a DenseModelGrid.
+
+    Parameters:
+    - grid: DenseModelGrid
+    - ratios, errors: (n_pixels, n_ratios) linear ratios and 1-sigma errors,
+      columns in grid.ratio_names order. NaN or non-positive entries are ignored.
+    - workers: processes to spread blocks over (None for os.cpu_count(), 1 to run serially)
+    - block_size: pixels per task
+    - memory_limit: bytes each worker may use for its chi-square block
+
+    Returns best-fit model index, minimum chi-square, number of ratios used,
+    and one (n_pixels, n_values) marginal likelihood array per parameter.
+    """
+    ratios = np.asarray(ratios, dtype=float)
+    errors = np.asarray(errors, dtype=float)
+
+    # Move to log space: sigma_log = sigma / (ratio ln 10)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        obs = np.log10(ratios)
+        weights = (ratios * np.log(10) / errors)**2
+    usable = np.isfinite(obs) & np.isfinite(weights) & (errors > 0)
+    weights = np.where(usable, weights, 0.0)
+    ndof = usable.sum(axis=1)
+
+    models, valid = grid.flat_models()
+    initargs = (models, valid, grid.shape, memory_limit)
+    blocks = [slice(start, start + block_size) for start in range(0, len(obs), block_size)]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(blocks) <= 1:
+        _init_worker(*initargs)
+        results = [_fit_block(obs[block], weights[block]) for block in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as pool:
+            results = list(pool.map(_fit_block, [obs[block] for block in blocks], [weights[block] for block in blocks]))
+
+    if not results:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), ndof, [np.zeros((0, size)) for size in grid.shape]
+    best = np.concatenate([r[0] for r in results])
+    chi2_min = np.concatenate([r[1] for r in results])
+    marginals = [np.concatenate([r[2][axis] for r in results]) for axis in range(len(grid.shape))]
+    return best, chi2_min, ndof, marginals
+
+def fit_maps(grid, ratio_maps, error_maps, mask=None, **kwargs):
+    """
+    Fit ratio maps (dicts keyed by grid.ratio_names) pixel by pixel.
+
+    Returns a dict of maps on the input pixel grid: best-fit value of every
+    parameter (abundance as an index into grid.axes['abundance']), CHI2, NDOF
+    and a marginal likelihood cube (n_values, *map_shape) per parameter.
+    Masked pixels (True = bad) and pixels with no usable ratio are NaN.
+    """
+    shape = np.shape(ratio_maps[grid.ratio_names[0]])
+    ratios = np.column_stack([np.ravel(ratio_maps[name]) for name in grid.ratio_names])
+    errors = np.column_stack([np.ravel(error_maps[name]) for name in grid.ratio_names])
+    keep = np.ones(len(ratios), dtype=bool) if mask is None else ~np.ravel(mask).astype(bool)
+
+    best, chi2_min, ndof, marginals = fit_pixels(grid, ratios[keep], errors[keep], **kwargs)
+    fitted = ndof > 0
+    best_idx = np.unravel_index(best, grid.shape)
+
+    def to_map(values):
+        full = np.full(len(ratios), np.nan)
+        full[np.flatnonzero(keep)[fitted]] = values[fitted]
+        return full.reshape(shape)
+
+    maps = {}
+    for axis, param in enumerate(PARAMETERS):
+        axis_values = np.arange(grid.shape[axis]) if param == 'abundance' else grid.axes[param]
+        maps[param] = to_map(axis_values[best_idx[axis]].astype(float))
+    maps['chi2'] = to_map(chi2_min)
+    maps['ndof'] = to_map(ndof.astype(float))
+    for axis, param in enumerate(PARAMETERS):
+        cube = np.stack([to_map(marginals[axis][:, i]) for i in range(grid.shape[axis])])
+        maps[f'{param}_likelihood'] = cube
+    return maps
+
+def write_fit_maps(file_path, maps, grid, header=None, overwrite=False):
+    """
+    Write fit_maps output to FITS: one image per best-fit parameter (e.g. VSHOCK),
+    CHI2, NDOF and one likelihood cube per parameter (e.g. L_VSHOCK) whose
+    AXVALn keywords give the parameter value of plane n.
+    """
+    hdul = fits.HDUList([fits.PrimaryHDU()])
+    hdul[0].header['RATIOS'] = ','.join(grid.ratio_names)
+
+    def image(data, name):
+        return fits.ImageHDU(data=data, header=header.copy() if header is not None else None, name=name)
+
+    for param in PARAMETERS:
+        hdul.append(image(maps[param], PARAMETER_EXTNAMES[param]))
+    hdul.append(image(maps['chi2'], 'CHI2'))
+    hdul.append(image(maps['ndof'], 'NDOF'))
+
+    for param in PARAMETERS:
+        hdu = image(maps[f'{param}_likelihood'], f'L_{PARAMETER_EXTNAMES[param]}')
+        for i, value in enumerate(grid.axes[param]):
+            hdu.header[f'AXVAL{i}'] = value if param == 'abundance' else float(value)
+        hdul.append(hdu)
+
+    # The abundance map holds indices, so record their names too
+    for i, name in enumerate(grid.axes['abundance']):
+        hdul[PARAMETER_EXTNAMES['abundance']].header[f'ABUN{i}'] = name
+    hdul.writeto(file_path, overwrite=overwrite)
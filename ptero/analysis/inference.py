@@ -0,0 +1,128 @@
+import numpy as np
+from astropy.io import fits
+from scipy.spatial import cKDTree
+from scipy.interpolate import LinearNDInterpolator
+
+# Pixels handled per KD-tree query. 2**20 pixels keeps the temporary (N, 2)
+# coordinate and result arrays at a few tens of MB regardless of map size.
+DEFAULT_CHUNK_SIZE = 2**20
+
+def log_points(x, y):
+    """
+    Stack x and y into (N, 2) log10 coordinates.
+
+    Returns the coordinates of the finite, positive entries and the boolean
+    array marking which inputs they came from.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_x = np.log10(x)
+        log_y = np.log10(y)
+    good = np.isfinite(log_x) & np.isfinite(log_y)
+    return np.column_stack([log_x[good], log_y[good]]), good
+
+class ShockInference:
+    """
+    Map positions on a diagnostic diagram to model shock velocity and magnetic field.
+
+    A KD-tree (and, for method='linear', a Delaunay triangulation) is built once
+    over the log-space grid points of a ModelGrid and then queried for any
+    number of pixels.
+    """
+    def __init__(self, grid, groups='model'):
+        vels, mags, x, y = grid.grid_points(groups)
+        self.points, good = log_points(x, y)
+        if len(self.points) == 0:
+            raise ValueError('Model grid has no finite, positive points to infer from')
+        self.vels = vels[good]
+        self.mags = mags[good]
+        self.tree = cKDTree(self.points)
+        self._interpolator = None
+
+    @property
+    def interpolator(self):
+        # Triangulation is only needed for linear inference, so build it lazily
+        if self._interpolator is None:
+            self._interpolator = LinearNDInterpolator(self.points, np.column_stack([self.vels, self.mags]))
+        return self._interpolator
+
+    def infer(self, x, y, method='nearest', chunk_size=DEFAULT_CHUNK_SIZE, workers=-1):
+        """
+        Infer (shck_vel, mag_fld) for every (x, y) pair.
+
+        Parameters:
+        - x, y: 1D arrays of observed diagram positions (linear, not log)
+        - method: 'nearest' model point, or 'linear' barycentric interpolation
+          inside the triangulated grid (NaN outside it)
+        - chunk_size: number of pixels processed at once
+        - workers: threads used by the KD-tree query (-1 for all cores)
+
+        Returns vels, mags and dist, where dist is the log-space (dex) distance
+        to the nearest model point. Pixels that cannot be placed in log space are NaN.
+        """
+        if method not in ['nearest', 'linear']:
+            raise ValueError(f"<method> must be 'nearest' or 'linear'. You entered {method}")
+
+        x = np.asarray(x).ravel()
+        y = np.asarray(y).ravel()
+        n = len(x)
+        vels = np.full(n, np.nan)
+        mags = np.full(n, np.nan)
+        dist = np.full(n, np.nan)
+
+        for start in range(0, n, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            pts, good = log_points(x[chunk], y[chunk])
+            if len(pts) == 0:
+                continue
+
+            # Distances always come from the KD-tree; slices of the outputs are views
+            d, idx = self.tree.query(pts, workers=workers)
+            dist[chunk][good] = d
+
+            if method == 'nearest':
+                vels[chunk][good] = self.vels[idx]
+                mags[chunk][good] = self.mags[idx]
+            else:
+                values = self.interpolator(pts)
+                vels[chunk][good] = values[:, 0]
+                mags[chunk][good] = values[:, 1]
+
+        return vels, mags, dist
+
+def infer_shock_maps(grid, points, method='nearest', groups='model', chunk_size=DEFAULT_CHUNK_SIZE, workers=-1):
+    """
+    Infer shock velocity, magnetic field and distance maps for FitsPoints.
+
+    Masked pixels are NaN. Returns a dict of arrays shaped like the input pixel grid.
+    """
+    inference = ShockInference(grid, groups)
+
+    # Only query unmasked pixels, then scatter the results back onto the grid
+    keep = ~points.mask
+    vels, mags, dist = inference.infer(points.x[keep], points.y[keep], method, chunk_size, workers)
+
+    maps = {}
+    for name, values in [('VSHOCK', vels), ('BFIELD', mags), ('DISTANCE', dist)]:
+        full = np.full(len(points.x), np.nan)
+        full[keep] = values
+        maps[name] = full.reshape(points.shape)
+    return maps
+
+def write_inference_maps(file_path, maps, header=None, overwrite=False):
+    """
+    Write maps from infer_shock_maps to a FITS file, one image extension per map.
+
+    header (e.g. the WCS of the input maps) is copied onto every extension.
+    """
+    units = {'VSHOCK': 'km/s', 'BFIELD': 'uG', 'DISTANCE': 'dex', 'RESIDUAL': 'km/s'}
+    hdul = fits.HDUList([fits.PrimaryHDU()])
+    for name, data in maps.items():
+        hdu = fits.ImageHDU(data=data, header=header.copy() if header is not None else None, name=name)
+        # Prefixed names (e.g. SHOCK_RESIDUAL) take the unit of the plain map
+        unit = units.get(name, units.get(name.rsplit('_', 1)[-1]))
+        if unit is not None:
+            hdu.header['BUNIT'] = unit
+        hdul.append(hdu)
+    hdul.writeto(file_path, overwrite=overwrite)
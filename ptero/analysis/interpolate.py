@@ -0,0 +1,181 @@
+import hashlib
+import numpy as np
+from scipy.interpolate import NdBSpline, RegularGridInterpolator, make_interp_spline
+
+# Custom function declarations
+from data_io.result_cache import ResultCache
+
+# Continuous model grids. Line ratios (and quantities) are interpolated in
+# log10 over shock velocity, log10 B and log10 density, either linearly or
+# with a tensor-product interpolating spline. Fitting happens once per grid
+# and is cached by the grid's content, so densified curves and lookups at
+# arbitrary (velocity, B, density) only cost a vectorised evaluation.
+
+INTERP_CACHE = ResultCache(maxsize=16)
+
+# Axes interpolated in log10 (velocity stays linear)
+LOG_AXES = {'mag_fld', 'preshck_dens'}
+
+# Tiny stand-in for B = 0 so it still has a log
+MIN_LOG_VALUE = 1e-6
+
+def _axis_coords(name, values):
+    values = np.asarray(values, dtype=float)
+    if name in LOG_AXES:
+        return np.log10(np.maximum(values, MIN_LOG_VALUE))
+    return values
+
+class GridInterpolator:
+    """
+    Interpolant of log10 values on a regular grid of model parameters.
+
+    Parameters:
+    - axes: list of (name, node values) pairs, e.g. [('mag_fld', B), ('shck_vel', v)]
+    - values: array of shape (len(axis 0), ..., n_outputs), NaN for missing models
+    - outputs: names of the n_outputs values (e.g. ratio columns)
+    - method: 'linear' or 'spline' (cubic where an axis has 4+ nodes)
+
+    Axes with a single node are dropped. Missing models are filled along the
+    velocity axis for the fit, but evaluations that depend on a missing node
+    return NaN.
+    """
+    def __init__(self, axes, values, outputs, method='spline'):
+        if method not in ['linear', 'spline']:
+            raise ValueError(f"<method> must be 'linear' or 'spline'. You entered {method}")
+        values = np.asarray(values, dtype=float)
+        keep = [i for i, (_, nodes) in enumerate(axes) if len(nodes) > 1]
+        if not keep:
+            raise ValueError('Model grid needs at least two nodes along some axis to interpolate')
+        drop = tuple(i for i in range(len(axes)) if i not in keep)
+        values = values.squeeze(axis=drop) if drop else values
+
+        self.method = method
+        self.outputs = list(outputs)
+        self.names = [axes[i][0] for i in keep]
+        self.nodes = [_axis_coords(axes[i][0], axes[i][1]) for i in keep]
+        self.fixed = {axes[i][0]: float(axes[i][1][0]) for i in drop}
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_values = np.log10(values)
+        valid = np.all(np.isfinite(log_values), axis=-1)
+        self._valid = RegularGridInterpolator(self.nodes, valid.astype(float), bounds_error=False, fill_value=0.0)
+        filled = self._fill(log_values)
+
+        if method == 'linear':
+            self._interp = RegularGridInterpolator(self.nodes, filled, bounds_error=False, fill_value=np.nan)
+        else:
+            # Tensor-product interpolation: 1D solves along each axis in turn
+            # give the coefficients of the N-d spline through every node
+            coeffs = filled
+            knots, degrees = [], []
+            for axis, nodes in enumerate(self.nodes):
+                k = min(3, len(nodes) - 1)
+                spline = make_interp_spline(nodes, coeffs, k=k, axis=axis)
+                # BSpline keeps the interpolated axis first in its coefficients
+                coeffs = np.moveaxis(spline.c, 0, axis)
+                knots.append(spline.t)
+                degrees.append(k)
+            self._interp = NdBSpline(tuple(knots), coeffs, tuple(degrees), extrapolate=False)
+
+    def _fill(self, log_values):
+        # Fill gaps by linear interpolation along velocity (or the last axis),
+        # holding the end values; all-NaN lines fall back to the grid mean
+        axis = self.names.index('shck_vel') if 'shck_vel' in self.names else len(self.names) - 1
+        moved = np.moveaxis(log_values, axis, -2)
+        flat = moved.reshape(-1, moved.shape[-2], moved.shape[-1]).copy()
+        nodes = self.nodes[axis]
+        fallback = np.nanmean(log_values, axis=tuple(range(log_values.ndim - 1)))
+        for line in flat:
+            for j in range(line.shape[1]):
+                good = np.isfinite(line[:, j])
+                if good.all():
+                    continue
+                if good.any():
+                    line[:, j] = np.interp(nodes, nodes[good], line[good, j])
+                else:
+                    line[:, j] = fallback[j]
+        return np.moveaxis(flat.reshape(moved.shape), -2, axis)
+
+    def __call__(self, **params):
+        """
+        Evaluate at arbitrary parameters (broadcast arrays, in physical units).
+
+        Keyword names are the axis names (shck_vel, mag_fld, preshck_dens).
+        Returns an array of shape broadcast(params) + (n_outputs,) in linear
+        units, NaN outside the grid or next to missing models.
+        """
+        unknown = set(params) - set(self.names) - set(self.fixed)
+        if unknown:
+            raise ValueError(f'Unknown grid parameters {sorted(unknown)}; grid has {self.names}')
+        missing = set(self.names) - set(params)
+        if missing:
+            raise ValueError(f'Missing grid parameters {sorted(missing)}')
+        coords = np.broadcast_arrays(*[_axis_coords(name, params[name]) for name in self.names])
+        shape = coords[0].shape
+        xi = np.column_stack([c.ravel() for c in coords])
+
+        log_values = self._interp(xi)
+        # A value is only trusted if every node it leans on is a real model
+        trusted = self._valid(xi) > 1 - 1e-9
+        values = 10**log_values
+        values[~trusted] = np.nan
+        return values.reshape(shape + (len(self.outputs),))
+
+def _digest(*arrays):
+    h = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype=float)
+        h.update(str(array.shape).encode())
+        h.update(array.view(np.uint8))
+    return h.hexdigest()
+
+def dense_grid_interpolator(dense, abundance=None, method='spline'):
+    """
+    Cached interpolant over (density, B, velocity) of a DenseModelGrid (analysis.grid_fit).
+
+    abundance picks one abundance (default: the first on the grid).
+    """
+    abundances = list(dense.axes['abundance'])
+    index = 0 if abundance is None else abundances.index(abundance)
+    values = dense.values[index]
+    axes = [(name, dense.axes[name]) for name in ['preshck_dens', 'mag_fld', 'shck_vel']]
+    key = ('dense', _digest(values, *[nodes for _, nodes in axes]), tuple(dense.ratio_names), method)
+    # DenseModelGrid already holds log10 ratios
+    return INTERP_CACHE.get_or_compute(key, lambda: GridInterpolator(axes, 10**values, dense.ratio_names, method))
+
+def model_grid_interpolator(grid, groups='model', method='spline'):
+    """
+    Cached interpolant over (B, velocity) of the plotted x and y of a ModelGrid.
+
+    Outputs are the x and y columns chosen by the selection (line ratios or
+    quantities). For independent grids, groups picks 'shock' or 'precursor'.
+    The interpolant is also kept on the grid object, so repeat calls for the
+    same grid skip hashing it.
+    """
+    memo = grid.__dict__.setdefault('_interpolators', {})
+    if (groups, method) in memo:
+        return memo[groups, method]
+
+    data_grouped = {
+        'model': grid.model_data_grouped,
+        'shock': grid.shock_data_grouped,
+        'precursor': grid.precursor_data_grouped,
+    }[groups]
+    if not data_grouped:
+        raise ValueError(f'Model grid has no {groups} curves to interpolate')
+    x_id, y_id = grid.xy_columns()
+
+    mags = np.array([data['mag_fld'].iloc[0] for data in data_grouped], dtype=float)
+    vels = np.unique(np.concatenate([data.iloc[:, 0].to_numpy(dtype=float) for data in data_grouped]))
+    values = np.full((len(mags), len(vels), 2), np.nan)
+    for i, data in enumerate(data_grouped):
+        rows = np.searchsorted(vels, data.iloc[:, 0].to_numpy(dtype=float))
+        values[i, rows, 0] = data.iloc[:, x_id].to_numpy(dtype=float)
+        values[i, rows, 1] = data.iloc[:, y_id].to_numpy(dtype=float)
+    order = np.argsort(mags)
+    mags, values = mags[order], values[order]
+
+    key = ('model', _digest(values, mags, vels), method)
+    memo[groups, method] = INTERP_CACHE.get_or_compute(key, lambda: GridInterpolator([('mag_fld', mags), ('shck_vel', vels)], values,
+                                                                                     [grid.x_lab, grid.y_lab], method))
+    return memo[groups, method]
@@ -0,0 +1,126 @@
+import numpy as np
+
+# Bytes of random draws held per block. Small enough that a block's draws and
+# the derived quantities stay in L2/L3 cache; the total memory used is fixed
+# no matter how many pixels or draws are requested.
+DEFAULT_BLOCK_BYTES = 4 * 2**20
+
+def ratio(num, den):
+    '''Line ratio with division by zero giving NaN (same convention as extract_line_ratio).'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(den != 0, num / den, np.nan)
+
+def identity(*values):
+    '''Pass draws through unchanged (inputs that are already ratios or quantities).'''
+    return values
+
+def _block_rows(n_inputs, n_draws, block_bytes, itemsize):
+    return max(1, block_bytes // (n_inputs * n_draws * itemsize))
+
+def iter_draws(values, errors, n_draws, block_bytes=DEFAULT_BLOCK_BYTES, seed=None, dtype=np.float64):
+    """
+    Yield (pixel slice, draws) with Gaussian realisations of every input.
+
+    Parameters:
+    - values: list of 1D arrays, one per input
+    - errors: list of matching 1D 1-sigma arrays (None, or NaN entries, for no noise)
+    - n_draws: realisations per pixel
+    - block_bytes: memory budget for one block of draws
+    - seed: seed for numpy's default Generator, for reproducible draws
+
+    draws is a list of (block, n_draws) arrays, one per input. The buffers are
+    reused between blocks, so copy anything that must outlive an iteration.
+    """
+    values = [np.asarray(v, dtype=dtype).ravel() for v in values]
+    errors = [np.zeros_like(v) if e is None else np.nan_to_num(np.asarray(e, dtype=dtype).ravel()) for v, e in zip(values, errors)]
+    n = len(values[0])
+    rng = np.random.default_rng(seed)
+    rows = _block_rows(len(values), n_draws, block_bytes, np.dtype(dtype).itemsize)
+    buffers = [np.empty((rows, n_draws), dtype=dtype) for _ in values]
+
+    for start in range(0, n, rows):
+        block = slice(start, min(start + rows, n))
+        size = block.stop - block.start
+        draws = []
+        for value, error, buffer in zip(values, errors, buffers):
+            out = buffer[:size]
+            rng.standard_normal(out=out, dtype=dtype)
+            out *= error[block, None]
+            out += value[block, None]
+            draws.append(out)
+        yield block, draws
+
+def propagate_percentiles(values, errors, func=identity, n_draws=1000, percentiles=(16, 50, 84), **kwargs):
+    """
+    Monte Carlo propagate per-pixel errors through func and return percentile maps.
+
+    func receives one (block, n_draws) array per input and returns one array
+    (or a tuple of arrays) of the same shape, e.g. ratio for a num/den pair.
+    Extra keyword arguments are passed to iter_draws.
+
+    Returns an (n_outputs, n_percentiles, n_pixels) array.
+    """
+    out = None
+    for block, draws in iter_draws(values, errors, n_draws, **kwargs):
+        results = func(*draws)
+        if isinstance(results, np.ndarray):
+            results = (results,)
+        if out is None:
+            out = np.full((len(results), len(percentiles), len(np.ravel(values[0]))), np.nan)
+        for i, result in enumerate(results):
+            out[i, :, block] = np.percentile(result, percentiles, axis=1)
+    return out
+
+def error_ellipses(values, errors, func=identity, n_draws=1000, log=True, **kwargs):
+    """
+    Per-pixel 1-sigma error ellipses of the (x, y) position on the diagram.
+
+    Inputs are drawn independently, passed through func (which must return the
+    x and y quantities) and, if log is True, moved to log10 space to match the
+    log-log axes. With the default func, values is simply [x, y]; line maps
+    can be combined with e.g. func=lambda a, b, c, d: (ratio(a, b), ratio(c, d)).
+
+    Draws that give a non-finite x or y (e.g. a non-positive ratio in log
+    space) are left out of that pixel's moments rather than making it NaN;
+    pixels with fewer than two usable draws stay NaN.
+
+    Returns centre_x, centre_y, width, height (full axis lengths), angle in
+    degrees anticlockwise from the x-axis and the fraction of draws dropped,
+    each a 1D array over pixels.
+    """
+    n = len(np.ravel(values[0]))
+    ellipses = np.full((6, n), np.nan)
+
+    for block, draws in iter_draws(values, errors, n_draws, **kwargs):
+        dx, dy = func(*draws)
+        if log:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dx, dy = np.log10(dx), np.log10(dy)
+
+        # Moments of every pixel at once, over its finite draws only
+        good = np.isfinite(dx) & np.isfinite(dy)
+        n_good = good.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dx = np.where(good, dx, 0.0)
+            dy = np.where(good, dy, 0.0)
+            mx = dx.sum(axis=1) / n_good
+            my = dy.sum(axis=1) / n_good
+            ddx = np.where(good, dx - mx[:, None], 0.0)
+            ddy = np.where(good, dy - my[:, None], 0.0)
+            sxx = (ddx * ddx).sum(axis=1) / n_good
+            syy = (ddy * ddy).sum(axis=1) / n_good
+            sxy = (ddx * ddy).sum(axis=1) / n_good
+
+        # Closed-form eigen decomposition of the 2x2 covariance
+        half_trace = 0.5 * (sxx + syy)
+        root = np.sqrt((0.5 * (sxx - syy))**2 + sxy**2)
+        lam1 = half_trace + root
+        lam2 = np.maximum(half_trace - root, 0.0)
+        angle = np.degrees(0.5 * np.arctan2(2 * sxy, sxx - syy))
+
+        result = np.array([mx, my, 2 * np.sqrt(lam1), 2 * np.sqrt(lam2), angle])
+        result[:, n_good < 2] = np.nan
+        ellipses[:5, block] = result
+        ellipses[5, block] = 1 - n_good / dx.shape[1]
+
+    return tuple(ellipses)
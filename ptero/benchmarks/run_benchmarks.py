@@ -0,0 +1,186 @@
+"""
+Time the query, extraction, FITS and plotting paths against synthetic data.
+
+Run from the ptero directory:
+
+    python -m benchmarks.run_benchmarks --sizes 1e4 1e5 1e6
+    python -m benchmarks.run_benchmarks --compare
+
+Each run appends one JSON line to benchmarks/history.jsonl (timings in
+seconds, plus commit and environment) so regressions show up run to run.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BENCH_DIR, 'data')
+HISTORY_PATH = os.path.join(BENCH_DIR, 'history.jsonl')
+DEFAULT_SIZES = [10**4, 10**5, 10**6]
+
+def time_call(func, repeat=5):
+    '''Wall times (seconds) of repeat calls to func.'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+def summarise(name, times, **params):
+    return dict(name=name, min=min(times), median=float(np.median(times)), mean=float(np.mean(times)), repeat=len(times), **params)
+
+def bench_query(repeat):
+    from data_io.query_3mdbs_tools import send_3mdbs_query, populate_abundance_dropdown, populate_density_dropdown
+    from pipeline import process_df
+
+    abundance = populate_abundance_dropdown()[0]
+    density = populate_density_dropdown(abundance)[0]
+    args = ('O23', 'S23', 'NII', 'Ha', 'OIII_5007', 'Hb', abundance, density, 100, 1000)
+
+    results = [
+        summarise('populate_abundance_dropdown', time_call(populate_abundance_dropdown, repeat)),
+        summarise('populate_density_dropdown', time_call(lambda: populate_density_dropdown(abundance), repeat)),
+        summarise('send_3mdbs_query', time_call(lambda: send_3mdbs_query(*args, False, True, False), repeat), independent=False),
+        summarise('send_3mdbs_query', time_call(lambda: send_3mdbs_query(*args, True, True, True), repeat), independent=True),
+    ]
+    df = send_3mdbs_query(*args, False, True, False)
+    results.append(summarise('process_df', time_call(lambda: process_df(df, 100, 1000, 25), repeat)))
+    return results
+
+def bench_extract(repeat):
+    try:
+        from data_io.extract_values import extract_line_ratio
+    except ImportError as e:
+        return [dict(name='extract_line_ratio', skipped=str(e))]
+    from benchmarks.synthetic import make_line_table
+
+    df = make_line_table()
+    lines = list(df['Emission lines'])
+    call = lambda: extract_line_ratio(df, lines[3], lines[1], lines[2], lines[0], 100, 1000, 25, 'x')
+    return [summarise('extract_line_ratio', time_call(call, repeat))]
+
+def bench_fits(sizes, repeat):
+    from data_io.handle_fits_data import load_fits_data
+    from benchmarks.synthetic import make_fits_maps, make_fits_tables
+
+    results = []
+    for n in sizes:
+        maps = make_fits_maps(DATA_DIR, n)
+        results.append(summarise('load_fits_data', time_call(lambda: load_fits_data(maps), repeat), size=n, layout='image'))
+        tables = make_fits_tables(DATA_DIR, n)
+        results.append(summarise('load_fits_data', time_call(lambda: load_fits_data(tables), repeat), size=n, layout='table'))
+    return results
+
+def bench_plot(sizes, repeat):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from data_io.handle_fits_data import load_fits_data
+    from pipeline import DiagramSelection, fetch_model_grid, FitsPoints, draw_grid, draw_points, render_diagnostic
+    from data_io.query_3mdbs_tools import populate_abundance_dropdown, populate_density_dropdown
+    from benchmarks.synthetic import make_fits_maps
+
+    abundance = populate_abundance_dropdown()[0]
+    density = populate_density_dropdown(abundance)[0]
+    selection = DiagramSelection('Line Ratio', 'Line Ratio', abundance, density, xnum='NII', xden='Ha', ynum='OIII_5007', yden='Hb')
+    grid = fetch_model_grid(selection)
+
+    def new_axes():
+        fig = Figure(figsize=(6, 6))
+        FigureCanvasAgg(fig)
+        return fig, fig.add_subplot()
+
+    results = [summarise('draw_model_curves', time_call(lambda: draw_grid(new_axes()[1], grid), repeat))]
+    for n in sizes:
+        points = FitsPoints(*load_fits_data(make_fits_maps(DATA_DIR, n)))
+        results.append(summarise('draw_fits_points', time_call(lambda: draw_points(new_axes()[1], points, selection), repeat), size=n))
+
+        def full_draw():
+            fig, ax = new_axes()
+            render_diagnostic(fig, ax, grid, points)
+            fig.canvas.draw()
+        results.append(summarise('canvas.draw', time_call(full_draw, repeat), size=n))
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_last_runs(history_path=HISTORY_PATH):
+    '''Print the median time of every benchmark in the last run relative to the run before.'''
+    with open(history_path) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    if len(runs) < 2:
+        print('Need at least two runs in the history to compare.')
+        return
+
+    def key(result):
+        return tuple(sorted((k, v) for k, v in result.items() if k not in ['min', 'median', 'mean', 'repeat']))
+
+    previous = {key(r): r for r in runs[-2]['results'] if 'median' in r}
+    for result in runs[-1]['results']:
+        if 'median' not in result or key(result) not in previous:
+            continue
+        ratio = result['median'] / previous[key(result)]['median']
+        flag = '  <-- slower' if ratio > 1.2 else ''
+        params = ', '.join(f'{k}={v}' for k, v in key(result) if k != 'name')
+        print(f"{result['name']:<30} {params:<30} {result['median']:.4g}s  x{ratio:.2f}{flag}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', type=float, default=DEFAULT_SIZES, help='pixel counts for the FITS and plotting benchmarks (up to 1e8)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--history', default=HISTORY_PATH)
+    parser.add_argument('--real-db', action='store_true', help='query the configured 3MdBs server instead of a synthetic SQLite copy')
+    parser.add_argument('--compare', action='store_true', help='only compare the last two runs in the history')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_last_runs(args.history)
+        return
+
+    sizes = [int(n) for n in args.sizes]
+
+    # Point the query layer at a fresh synthetic database unless told otherwise
+    if not args.real_db:
+        from benchmarks.synthetic import make_3mdbs_sqlite
+        db_path = make_3mdbs_sqlite(os.path.join(tempfile.mkdtemp(), '3mdbs.sqlite'))
+        os.environ['MdB_URL'] = f'sqlite:///{db_path}'
+
+    results = []
+    results += bench_query(args.repeat)
+    results += bench_extract(args.repeat)
+    results += bench_fits(sizes, args.repeat)
+    results += bench_plot(sizes, args.repeat)
+
+    run = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'database': 'real' if args.real_db else 'synthetic',
+        'results': results,
+    }
+    with open(args.history, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+
+    for result in results:
+        if 'skipped' in result:
+            print(f"{result['name']:<30} skipped: {result['skipped']}")
+        else:
+            params = ', '.join(f'{k}={v}' for k, v in result.items() if k in ['size', 'layout', 'independent'])
+            print(f"{result['name']:<30} {params:<30} median {result['median']:.4g}s  min {result['min']:.4g}s")
+
+if __name__ == '__main__':
+    main()
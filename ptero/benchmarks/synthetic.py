@@ -0,0 +1,136 @@
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from astropy.table import Table
+
+# Synthetic stand-ins for 3MdBs and observed FITS maps, so that benchmarks run
+# without the MySQL server or real data. Values are smooth functions of the
+# model parameters, not physical predictions.
+
+ABUNDANCES = ['Allen2008_Dopita2005', 'Allen2008_LMC', 'Allen2008_SMC', 'Allen2008_Solar', 'Allen2008_TwiceSolar']
+DENSITIES = [0.01, 0.1, 1.0, 10.0, 100.0, 1000.0]
+MAG_FIELDS = [0.0001, 0.5, 1.0, 2.0, 3.2, 4.0, 5.0, 10.0]
+VELOCITIES = np.arange(100, 1025, 25)
+MODEL_TYPES = ['shock', 'precursor', 'shock_plus_precursor']
+
+# Lines needed by return_lines() and return_quantities(), split by table
+VI_LINES = ['HI_6563', 'HI_4861', 'OIII_5007', 'OII_7320', 'NII_6548', 'NII_6583', 'SII_6716', 'SII_6731']
+IR_LINES = ['SIII_9069']
+
+def make_3mdbs_sqlite(file_path, ref='Allen08'):
+    """
+    Write a SQLite database with the shock_params/abundances/emis_VI/emis_IR
+    schema that send_3mdbs_query expects.
+
+    Point PTERO at it with os.environ['MdB_URL'] = f'sqlite:///{file_path}'.
+    """
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+    abund, dens, mag, vel = np.meshgrid(np.arange(len(ABUNDANCES)), DENSITIES, MAG_FIELDS, VELOCITIES, indexing='ij')
+    abund, dens, mag, vel = abund.ravel(), dens.ravel(), mag.ravel(), vel.ravel().astype(float)
+    model_ids = np.arange(1, len(vel) + 1)
+
+    shock_params = pd.DataFrame({
+        'ModelID': model_ids,
+        'AbundID': abund + 1,
+        'ref': ref,
+        'shck_vel': vel,
+        'mag_fld': mag,
+        'preshck_dens': dens,
+    })
+    abundances = pd.DataFrame({'AbundID': np.arange(1, len(ABUNDANCES) + 1), 'name': ABUNDANCES})
+
+    # Smooth, positive line fluxes that vary with every parameter and model type
+    rng = np.random.default_rng(0)
+    emis = {'emis_VI': [], 'emis_IR': []}
+    for t, model_type in enumerate(MODEL_TYPES):
+        base = (vel / 100.0)**(1 + 0.2 * t) * (1 + 0.1 * abund) * (1 + np.log10(dens + 1)) / (1 + 0.1 * mag)
+        for table, lines in [('emis_VI', VI_LINES), ('emis_IR', IR_LINES)]:
+            columns = {'ModelID': model_ids, 'model_type': model_type}
+            for k, line in enumerate(lines):
+                columns[line] = base * (0.2 + k * 0.3) * rng.uniform(0.9, 1.1, len(vel)) + 1e-3
+            emis[table].append(pd.DataFrame(columns))
+
+    with sqlite3.connect(file_path) as conn:
+        shock_params.to_sql('shock_params', conn, index=False)
+        abundances.to_sql('abundances', conn, index=False)
+        for table, frames in emis.items():
+            pd.concat(frames).to_sql(table, conn, index=False)
+        conn.execute('CREATE INDEX idx_sp_model ON shock_params (ModelID)')
+        conn.execute('CREATE INDEX idx_vi_model ON emis_VI (ModelID, model_type)')
+        conn.execute('CREATE INDEX idx_ir_model ON emis_IR (ModelID, model_type)')
+
+    return file_path
+
+def map_shape(n_pixels):
+    '''Roughly square 2D shape holding n_pixels.'''
+    ny = int(np.sqrt(n_pixels))
+    return ny, int(np.ceil(n_pixels / ny))
+
+def _write_streamed_image(file_path, extname, shape, fill_rows, chunk_rows=1024):
+    # Stream the image row block by row block so 10^8 pixel maps never sit in memory
+    fits.PrimaryHDU().writeto(file_path, overwrite=True)
+    header = fits.ImageHDU(data=np.zeros((1, 1), dtype=np.float32), name=extname).header
+    header['NAXIS1'] = shape[1]
+    header['NAXIS2'] = shape[0]
+    shdu = fits.StreamingHDU(file_path, header)
+    for start in range(0, shape[0], chunk_rows):
+        rows = min(chunk_rows, shape[0] - start)
+        shdu.write(fill_rows(rows, shape[1]).astype('>f4'))
+    shdu.close()
+
+def make_fits_maps(out_dir, n_pixels, seed=0):
+    """
+    Write x/y DIAGNOSTIC and z SIGMA image files of about n_pixels each.
+
+    Returns the three paths in the order load_fits_data expects.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    shape = map_shape(n_pixels)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for name, extname, fill_rows in [
+        ('x', 'DIAGNOSTIC', lambda r, c: 10**rng.normal(-0.2, 0.3, (r, c))),
+        ('y', 'DIAGNOSTIC', lambda r, c: 10**rng.normal(0.2, 0.3, (r, c))),
+        ('z', 'SIGMA', lambda r, c: rng.uniform(50, 600, (r, c))),
+    ]:
+        file_path = os.path.join(out_dir, f'map_{name}_{n_pixels}.fits')
+        if not os.path.exists(file_path):
+            _write_streamed_image(file_path, extname, shape, fill_rows)
+        paths.append(file_path)
+    return paths
+
+def make_fits_tables(out_dir, n_pixels, seed=0):
+    """
+    Write x/y FLUX and z SIGMA binary-table files of n_pixels rows each.
+
+    Returns the three paths in the order load_fits_data expects.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for name, column, values in [
+        ('x', 'FLUX', lambda: 10**rng.normal(-0.2, 0.3, n_pixels)),
+        ('y', 'FLUX', lambda: 10**rng.normal(0.2, 0.3, n_pixels)),
+        ('z', 'SIGMA', lambda: rng.uniform(50, 600, n_pixels)),
+    ]:
+        file_path = os.path.join(out_dir, f'table_{name}_{n_pixels}.fits')
+        if not os.path.exists(file_path):
+            Table({column: values().astype(np.float32)}).write(file_path, overwrite=True)
+        paths.append(file_path)
+    return paths
+
+def make_line_table(seed=0):
+    """
+    Emission line table in the per-model CSV layout extract_line_ratio reads:
+    an 'Emission lines' column followed by one column per shock velocity.
+    """
+    rng = np.random.default_rng(seed)
+    lines = ['Hβ λ4861', 'Hα λ6563', '[O III] λ5007', '[N II] λ6583', '[S II] λ6716', '[S II] λ6731']
+    data = {'Emission lines': lines}
+    for v in VELOCITIES:
+        data[str(v)] = rng.uniform(0.1, 3.0, len(lines))
+    return pd.DataFrame(data)
@@ -0,0 +1,212 @@
+import numpy as np
+from matplotlib.path import Path
+from matplotlib.widgets import LassoSelector, RectangleSelector
+
+# Linked brushing between the diagnostic diagram and a spatial map of the same
+# pixels. A PixelIndex is built once per FITS load (or mask change) and holds
+# the flat pixel index, log-space diagram position and map position of every
+# plotted point, so a lasso or box in either view is a single vectorised
+# containment test. The result is shown by blitting two artists (the map
+# overlay and the diagram highlight) over backgrounds saved at the last full
+# draw, so a million-point scatter is not re-rasterised per selection.
+
+HIGHLIGHT_COLOR = (1.0, 0.2, 0.2)
+
+def box_contains(xy, x0, x1, y0, y1):
+    '''Boolean array of the (N, 2) points xy inside the box (corners in any order).'''
+    x0, x1 = sorted([x0, x1])
+    y0, y1 = sorted([y0, y1])
+    return (xy[:, 0] >= x0) & (xy[:, 0] <= x1) & (xy[:, 1] >= y0) & (xy[:, 1] <= y1)
+
+def path_contains(xy, vertices):
+    '''Boolean array of the (N, 2) points xy inside the closed polygon vertices.'''
+    vertices = np.asarray(vertices, dtype=float)
+    if len(vertices) < 3:
+        return np.zeros(len(xy), dtype=bool)
+
+    # Cheap bounding-box cut first, so the exact test only sees nearby points
+    inside = box_contains(xy, vertices[:, 0].min(), vertices[:, 0].max(), vertices[:, 1].min(), vertices[:, 1].max())
+    candidates = np.flatnonzero(inside)
+    if len(candidates):
+        inside[candidates] = Path(vertices).contains_points(xy[candidates])
+    return inside
+
+class PixelIndex:
+    """
+    Positions of every plotted pixel of a FitsPoints in both views.
+
+    pixels are flat indices into the pixel grid of the unmasked points with
+    finite, positive x and y (the ones visible on log axes). log_xy and map_xy
+    are the matching (N, 2) diagram positions in dex and map (column, row).
+    """
+    def __init__(self, points):
+        if len(points.shape) != 2:
+            raise ValueError(f'FITS data has shape {points.shape}; a spatial map needs 2D data')
+
+        x = np.asarray(points.x, dtype=float)
+        y = np.asarray(points.y, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            keep = ~points.mask & (x > 0) & (y > 0) & np.isfinite(x) & np.isfinite(y)
+
+        self.shape = points.shape
+        self.pixels = np.flatnonzero(keep)
+        self.xy = np.column_stack([x[self.pixels], y[self.pixels]])
+        self.log_xy = np.log10(self.xy)
+        rows, cols = np.unravel_index(self.pixels, self.shape)
+        self.map_xy = np.column_stack([cols, rows]).astype(float)
+
+        # z laid out on the pixel grid, with unplotted pixels blank
+        self.z_map = np.full(self.shape, np.nan)
+        self.z_map.flat[self.pixels] = np.asarray(points.z, dtype=float)[self.pixels]
+
+    def select_diagram(self, vertices=None, box=None):
+        '''Points inside a lasso (vertices) or box (x0, x1, y0, y1) drawn on the log-log diagram, in data units.'''
+        if box is not None:
+            return box_contains(self.log_xy, *np.log10(np.abs(box)))
+        return path_contains(self.log_xy, np.log10(np.abs(vertices)))
+
+    def select_map(self, vertices=None, box=None):
+        '''Points inside a lasso (vertices) or box (x0, x1, y0, y1) drawn on the map, in pixel units.'''
+        if box is not None:
+            return box_contains(self.map_xy, *box)
+        return path_contains(self.map_xy, vertices)
+
+class LinkedBrush:
+    """
+    Draws the spatial map of a PixelIndex on map_ax and links it to a diagnostic axes.
+
+    The diagram axes is cleared on every re-plot, so call attach() after each
+    render to put the highlight and selector back. mode is 'lasso' or 'box'.
+    """
+    def __init__(self, map_ax, index, vmin=None, vmax=None, mode='lasso'):
+        self.index = index
+        self.map_ax = map_ax
+        self.diagram_ax = None
+        self.highlight = None
+        self.diagram_selector = None
+        self.mode = mode
+        self.selected = np.zeros(len(index.pixels), dtype=bool)
+
+        map_ax.clear()
+        map_ax.imshow(index.z_map, origin='lower', cmap='viridis', vmin=vmin, vmax=vmax, interpolation='nearest')
+        self.overlay = np.zeros(index.shape + (4,), dtype=np.float32)
+        self.overlay[..., :3] = HIGHLIGHT_COLOR
+        self.overlay_image = map_ax.imshow(self.overlay, origin='lower', interpolation='nearest')
+        self._hide(self.overlay_image)
+        map_ax.set_xlabel('x / pixel')
+        map_ax.set_ylabel('y / pixel')
+        self.map_selector = self._selector(map_ax, self.on_map_select)
+
+        self._backgrounds = {}
+        canvas = map_ax.figure.canvas
+        self._draw_cids = [(canvas, canvas.mpl_connect('draw_event', self._on_draw))]
+
+    @staticmethod
+    def _hide(artist):
+        # Animated and invisible, so full draws (and the selectors' background
+        # captures) leave it out; _blit draws it on top instead
+        artist.set_animated(True)
+        artist.set_visible(False)
+
+    def _artist(self, ax):
+        return self.overlay_image if ax is self.map_ax else self.highlight
+
+    def _on_draw(self, event):
+        # A full draw: save the background of each axes on this canvas, then
+        # draw the selection artists over it (savefig renders at its own dpi)
+        if event.canvas.is_saving():
+            return
+        for ax in [self.map_ax, self.diagram_ax]:
+            if ax is None or ax.figure.canvas is not event.canvas or not hasattr(event.canvas, 'copy_from_bbox'):
+                continue
+            # Padded so the partly covered pixels at the axes edges are restored too
+            self._backgrounds[ax] = event.canvas.copy_from_bbox(ax.bbox.padded(1))
+            self._draw_selection(ax)
+
+    def _draw_selection(self, ax):
+        artist = self._artist(ax)
+        artist.set_visible(True)
+        ax.draw_artist(artist)
+        artist.set_visible(False)
+
+    def _blit(self, ax):
+        '''Redraw only the selection artist of ax, or the whole canvas if no background is saved yet.'''
+        canvas = ax.figure.canvas
+        background = self._backgrounds.get(ax)
+        if background is None:
+            canvas.draw_idle()
+            return
+        canvas.restore_region(background)
+        self._draw_selection(ax)
+        canvas.blit(ax.bbox.padded(1))
+
+    def _selector(self, ax, callback):
+        if self.mode == 'box':
+            return RectangleSelector(ax, lambda press, release: callback(box=(press.xdata, release.xdata, press.ydata, release.ydata)),
+                                     useblit=True, interactive=False)
+        return LassoSelector(ax, lambda vertices: callback(vertices=vertices), useblit=True)
+
+    def set_mode(self, mode):
+        self.mode = mode
+        self.map_selector.disconnect_events()
+        self.map_selector = self._selector(self.map_ax, self.on_map_select)
+        if self.diagram_ax is not None:
+            self.diagram_selector.disconnect_events()
+            self.diagram_selector = self._selector(self.diagram_ax, self.on_diagram_select)
+
+    def attach(self, diagram_ax):
+        '''Add the highlight and selector to the diagnostic axes (no-op if they are still there).'''
+        if self.highlight is not None and self.highlight.axes is diagram_ax and self.highlight in diagram_ax.collections:
+            return
+        if self.diagram_selector is not None:
+            self.diagram_selector.disconnect_events()
+
+        self.diagram_ax = diagram_ax
+        self.highlight = diagram_ax.scatter([], [], color=HIGHLIGHT_COLOR, marker='.', zorder=3)
+        self._hide(self.highlight)
+        # The diagram was just redrawn, so its old background is stale
+        self._backgrounds.pop(diagram_ax, None)
+        canvas = diagram_ax.figure.canvas
+        if all(c is not canvas for c, _ in self._draw_cids):
+            self._draw_cids.append((canvas, canvas.mpl_connect('draw_event', self._on_draw)))
+        self.diagram_selector = self._selector(diagram_ax, self.on_diagram_select)
+        self.show_selection()
+
+    def disconnect(self):
+        '''Stop listening for selections (before the brush is replaced).'''
+        self.map_selector.disconnect_events()
+        if self.diagram_selector is not None:
+            self.diagram_selector.disconnect_events()
+        for canvas, cid in self._draw_cids:
+            canvas.mpl_disconnect(cid)
+        self._draw_cids = []
+        if self.highlight is not None and self.highlight.axes is not None and self.highlight in self.highlight.axes.collections:
+            self.highlight.remove()
+
+    def on_diagram_select(self, vertices=None, box=None):
+        self.select(self.index.select_diagram(vertices, box))
+
+    def on_map_select(self, vertices=None, box=None):
+        self.select(self.index.select_map(vertices, box))
+
+    def select(self, selected):
+        # Only the alpha of previously and newly selected pixels changes
+        flat_overlay = self.overlay.reshape(-1, 4)
+        flat_overlay[self.index.pixels[self.selected], 3] = 0
+        self.selected = selected
+        flat_overlay[self.index.pixels[self.selected], 3] = 0.8
+        self.show_selection()
+
+    def clear(self):
+        self.select(np.zeros(len(self.index.pixels), dtype=bool))
+
+    def show_selection(self):
+        self.overlay_image.set_data(self.overlay)
+        self._blit(self.map_ax)
+        if self.highlight is not None:
+            self.highlight.set_offsets(self.index.xy[self.selected])
+            self._blit(self.diagram_ax)
+
+    def selected_pixels(self):
+        '''Flat pixel indices of the current selection.'''
+        return self.index.pixels[self.selected]
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+# Custom function declarations
+from data_io.query_3mdbs_tools import model_type_filter, send_3mdbs_grid_query
+from pipeline import DiagramSelection, FitsPoints, build_model_grid, draw_grid, draw_points, render_to_array
+from profiling import span
+
+# The standard BPT-style set: every panel shares OIII/Hb on the y axis
+STANDARD_PANELS = [
+    dict(xqulr='Line Ratio', yqulr='Line Ratio', xnum='NII', xden='Ha', ynum='OIII_5007', yden='Hb'),
+    dict(xqulr='Line Ratio', yqulr='Line Ratio', xnum='SII', xden='Ha', ynum='OIII_5007', yden='Hb'),
+    dict(xqulr='Quantity', yqulr='Line Ratio', xquan='O23', ynum='OIII_5007', yden='Hb'),
+    dict(xqulr='Quantity', yqulr='Line Ratio', xquan='S23', ynum='OIII_5007', yden='Hb'),
+]
+
+def panel_selections(panels, abundance, density, vmin=100, vmax=1000, vstep=25, shock=True, precursor=False, independent=False):
+    '''One DiagramSelection per panel spec, all sharing the model and velocity choices.'''
+    return [DiagramSelection(abundance=abundance, density=density, vmin=vmin, vmax=vmax, vstep=vstep,
+                             shock=shock, precursor=precursor, independent=independent, **panel) for panel in panels]
+
+def axis_terms(selection, axis):
+    '''('ratio', (num, den)) or ('quantity', name) plotted on one axis of a selection.'''
+    if getattr(selection, f'{axis}qulr') == 'Quantity':
+        return 'quantity', getattr(selection, f'{axis}quan')
+    return 'ratio', (getattr(selection, f'{axis}num'), getattr(selection, f'{axis}den'))
+
+def query_frame(df, selection):
+    # Rebuild the send_3mdbs_query column layout for one panel, with NaN for
+    # the columns that panel does not plot (names may repeat, as in the original query)
+    names = ['shck_vel', f'{selection.xnum}_{selection.xden}', f'{selection.ynum}_{selection.yden}',
+             selection.xquan, selection.yquan, 'mag_fld']
+    values = [df[name].to_numpy(dtype=float) if name in df.columns else np.full(len(df), np.nan) for name in names]
+    return pd.DataFrame(np.column_stack(values), columns=names)
+
+def query_model_types(selection):
+    '''model_type values to query for a selection (same rule as send_3mdbs_query).'''
+    return model_type_filter(selection.shock, selection.precursor, selection.independent)
+
+def fetch_dashboard_grids(selections):
+    """
+    Fetch the model grid for every panel with one query per model type.
+
+    Every ratio and quantity needed by any panel is selected together, then
+    the result is split client-side into one ModelGrid per panel.
+    """
+    first = selections[0]
+    ratios, quantities = [], []
+    for selection in selections:
+        for axis in ['x', 'y']:
+            kind, term = axis_terms(selection, axis)
+            if kind == 'ratio' and term not in ratios:
+                ratios.append(term)
+            elif kind == 'quantity' and term not in quantities:
+                quantities.append(term)
+
+    with span('fetch_dashboard_grids', n_panels=len(selections)):
+        results = [send_3mdbs_grid_query(ratios, model_type, [first.abundance], [first.density],
+                                         first.vmin, first.vmax, quantities, [first.ref]) for model_type in query_model_types(first)]
+
+        grids = []
+        for selection in selections:
+            frames = [query_frame(df, selection) for df in results]
+            grids.append(build_model_grid(selection, frames if first.independent else frames[0]))
+    return grids
+
+def evaluate_panel_points(selections, line_maps, sigma, mask=None):
+    """
+    Observed x, y, z for every panel, computed in one vectorised pass.
+
+    line_maps holds flattened line flux maps keyed by return_lines() names (and
+    any quantity maps keyed by quantity name). All lines are stacked and masked
+    once, then every distinct ratio is evaluated with a single fancy-indexed
+    division. Returns one FitsPoints per panel, or None for a panel that needs
+    a map which was not loaded.
+    """
+    names = list(line_maps.keys())
+    stacked = np.vstack([np.asarray(line_maps[name], dtype=float) for name in names])
+    keep = np.ones(stacked.shape[1], dtype=bool) if mask is None else ~np.asarray(mask, dtype=bool).ravel()
+    stacked = stacked[:, keep]
+    z = np.asarray(sigma, dtype=float)[keep] if sigma is not None else np.full(stacked.shape[1], np.nan)
+
+    def available(selection):
+        terms = [axis_terms(selection, axis) for axis in ['x', 'y']]
+        return all(set(term if kind == 'ratio' else [term]) <= set(names) for kind, term in terms)
+
+    # Every distinct ratio needed by any panel that can be drawn
+    ratios = []
+    for selection in filter(available, selections):
+        for axis in ['x', 'y']:
+            kind, term = axis_terms(selection, axis)
+            if kind == 'ratio' and term not in ratios:
+                ratios.append(term)
+    num_idx = [names.index(num) for num, _ in ratios]
+    den_idx = [names.index(den) for _, den in ratios]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio_values = np.where(stacked[den_idx] != 0, stacked[num_idx] / stacked[den_idx], np.nan)
+
+    def axis_values(selection, axis):
+        kind, term = axis_terms(selection, axis)
+        if kind == 'ratio':
+            return ratio_values[ratios.index(term)]
+        return stacked[names.index(term)]
+
+    panel_shape = (int(keep.sum()),)
+    return [FitsPoints(axis_values(s, 'x'), axis_values(s, 'y'), z, shape=panel_shape) if available(s) else None
+            for s in selections]
+
+def render_dashboard(fig, grids, points_list=None):
+    """
+    Draw every panel onto one figure in a single row.
+
+    Panels that plot the same y quantity share their y axis, and one colorbar
+    serves every panel since they share the velocity normalisation. Returns
+    the axes and the colorbar.
+    """
+    y_labels = {grid.y_lab for grid in grids}
+    axes = fig.subplots(1, len(grids), sharey=len(y_labels) == 1, squeeze=False)[0]
+    points_list = points_list or [None] * len(grids)
+
+    lc = None
+    for ax, grid, points in zip(axes, grids, points_list):
+        lc = draw_grid(ax, grid) or lc
+        if points is not None:
+            draw_points(ax, points, grid.selection)
+        ax.set_xlabel(grid.x_lab)
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.tick_params(axis='both', labelsize=10)
+    axes[0].set_ylabel(grids[0].y_lab)
+
+    cbar = fig.colorbar(lc, ax=list(axes))
+    cbar.set_label('Shock velocity / km s$^{-1}$', size=14)
+    return axes, cbar
+
+def render_dashboard_arrays(grids, points_list=None, workers=None, figsize=(5, 5), dpi=100):
+    '''Rasterise each panel in its own process (headless), returning one RGBA array per panel.'''
+    points_list = points_list or [None] * len(grids)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(render_to_array, grids, points_list, [figsize] * len(grids), [dpi] * len(grids)))
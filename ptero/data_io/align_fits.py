@@ -0,0 +1,177 @@
+import hashlib
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+
+# Custom function declarations
+from data_io.handle_fits_data import is_table_fits, find_error_data, read_image
+from data_io.result_cache import ResultCache
+
+# Put the x, y and z maps onto one common pixel grid using their WCS headers.
+# The mapping from every output pixel to input pixels depends only on the two
+# headers and shapes, so it is computed once, cached by header hash, and
+# applied to data (and errors) as a plain index gather. Values are
+# interpolated, not flux-conserving, which suits ratio, diagnostic and
+# velocity dispersion maps.
+
+MAPPING_CACHE = ResultCache(maxsize=8)
+
+class PixelMapping:
+    """
+    Output pixels as weighted sums of input pixels.
+
+    indices and weights are (k, n_out): k = 1 for nearest, 4 for bilinear.
+    Output pixels that fall outside the input have index -1 and become NaN.
+    """
+    def __init__(self, indices, weights, shape):
+        self.indices = indices
+        self.weights = weights
+        self.shape = shape
+
+    def _gather(self, data):
+        # Input values per (k, n_out) term and normalised weights over the
+        # terms that count: inside the input, finite and with nonzero weight,
+        # so a NaN neighbour with zero weight cannot blank its neighbours
+        flat = np.asarray(data, dtype=float).ravel()
+        inside = self.indices >= 0
+        values = np.where(inside, flat[np.where(inside, self.indices, 0)], np.nan)
+        valid = inside & np.isfinite(values) & (self.weights > 0)
+        weights = np.where(valid, self.weights, 0.0)
+        total = weights.sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = weights / total
+        return np.where(valid, values, 0.0), weights, total > 0
+
+    def apply(self, data):
+        '''Reproject a map (or None) onto the output grid.'''
+        if data is None:
+            return None
+        values, weights, covered = self._gather(data)
+        return np.where(covered, (weights * values).sum(axis=0), np.nan).reshape(self.shape)
+
+    def apply_errors(self, err):
+        '''Reproject a 1-sigma error map (or None): errors of a weighted sum add as sqrt(sum(w**2 * err**2)).'''
+        if err is None:
+            return None
+        errors, weights, covered = self._gather(err)
+        return np.where(covered, np.sqrt((weights**2 * errors**2).sum(axis=0)), np.nan).reshape(self.shape)
+
+def input_hdu_name(hdul, i):
+    '''Extension load_fits_data reads for input i (0 = x, 1 = y, 2 = z).'''
+    if i == 2:
+        return 'SIGMA'
+    return 'DIAGNOSTIC' if 'DIAGNOSTIC' in hdul else 'FLUX'
+
+def header_key(header, shape):
+    '''Hash of the celestial WCS and shape of a map.'''
+    wcs_text = WCS(header).celestial.to_header_string(relax=True)
+    return hashlib.blake2b(f'{wcs_text}|{tuple(shape)}'.encode(), digest_size=16).hexdigest()
+
+def compute_mapping(src_header, src_shape, dst_header, dst_shape, method='bilinear'):
+    """
+    Pixel mapping that resamples a map on src onto the dst grid.
+
+    Every dst pixel centre goes to world coordinates and back into src pixel
+    coordinates in one vectorised WCS call each way.
+    """
+    if method not in ['nearest', 'bilinear']:
+        raise ValueError(f"<method> must be 'nearest' or 'bilinear'. You entered {method}")
+
+    src_wcs = WCS(src_header).celestial
+    dst_wcs = WCS(dst_header).celestial
+    if not (src_wcs.has_celestial and dst_wcs.has_celestial):
+        raise ValueError('Maps differ in shape or grid but do not all carry a celestial WCS to align them with')
+    rows, cols = np.indices(dst_shape).reshape(2, -1)
+    world = dst_wcs.all_pix2world(cols, rows, 0)
+    src_x, src_y = src_wcs.all_world2pix(world[0], world[1], 0)
+    src_ny, src_nx = src_shape
+
+    if method == 'nearest':
+        ix = np.rint(src_x).astype(np.int64)
+        iy = np.rint(src_y).astype(np.int64)
+        inside = (ix >= 0) & (ix < src_nx) & (iy >= 0) & (iy < src_ny)
+        indices = np.where(inside, iy * src_nx + ix, -1)[None]
+        return PixelMapping(indices, np.ones(indices.shape), dst_shape)
+
+    # Bilinear: the four surrounding input pixels; points beyond the outer
+    # pixel centres (but inside the map) take the edge pixel
+    x0 = np.floor(src_x).astype(np.int64)
+    y0 = np.floor(src_y).astype(np.int64)
+    fx = src_x - x0
+    fy = src_y - y0
+    indices, weights = [], []
+    for dy, dx, w in [(0, 0, (1 - fx) * (1 - fy)), (0, 1, fx * (1 - fy)), (1, 0, (1 - fx) * fy), (1, 1, fx * fy)]:
+        ix = np.clip(x0 + dx, 0, src_nx - 1)
+        iy = np.clip(y0 + dy, 0, src_ny - 1)
+        indices.append(iy * src_nx + ix)
+        weights.append(w)
+    indices = np.array(indices)
+    inside = (src_x > -0.5) & (src_x < src_nx - 0.5) & (src_y > -0.5) & (src_y < src_ny - 0.5)
+    indices[:, ~inside] = -1
+    return PixelMapping(indices, np.array(weights), dst_shape)
+
+def cached_mapping(src_header, src_shape, dst_header, dst_shape, method='bilinear'):
+    '''compute_mapping with results kept in MAPPING_CACHE, keyed by header hashes.'''
+    key = ('mapping', header_key(src_header, src_shape), header_key(dst_header, dst_shape), method)
+    return MAPPING_CACHE.get_or_compute(key, lambda: compute_mapping(src_header, src_shape, dst_header, dst_shape, method))
+
+def pixel_scale(header):
+    '''Mean pixel size of a map in degrees.'''
+    return float(np.mean(proj_plane_pixel_scales(WCS(header).celestial)))
+
+def load_aligned_fits(file_paths, reference=0, method='bilinear'):
+    """
+    Load the x, y, z maps (as load_fits_data) and their errors onto a common grid.
+
+    Parameters:
+    - file_paths: x, y, z FITS files
+    - reference: index of the file whose grid is used, or 'finest' for the
+      one with the smallest pixels
+    - method: 'bilinear' or 'nearest'
+
+    Returns flattened x, y, z, the common shape, the flattened x_err, y_err,
+    z_err (None where there is no error extension) and the common grid's header.
+    Inputs already on the reference grid are passed through untouched.
+    """
+    if any(is_table_fits(file_path) for file_path in file_paths):
+        raise ValueError('FITS tables carry no WCS, so they cannot be aligned')
+
+    maps, errs, headers = [], [], []
+    for i, file_path in enumerate(file_paths):
+        with fits.open(file_path, memmap=True) as hdul:
+            name = input_hdu_name(hdul, i)
+            maps.append(np.asarray(read_image(hdul, name)))
+            headers.append(hdul[name].header)
+        errs.append(find_error_data(file_path, name))
+
+    if reference == 'finest':
+        reference = int(np.argmin([pixel_scale(header) for header in headers]))
+    dst_header = headers[reference]
+    dst_shape = maps[reference].shape
+    dst_key = header_key(dst_header, dst_shape)
+
+    values, errors = [], []
+    for data, err, header in zip(maps, errs, headers):
+        if header_key(header, data.shape) == dst_key:
+            values.append(np.asarray(data, dtype=float))
+            errors.append(np.asarray(err, dtype=float) if err is not None else None)
+            continue
+        mapping = cached_mapping(header, data.shape, dst_header, dst_shape, method)
+        values.append(mapping.apply(data))
+        errors.append(mapping.apply_errors(err))
+
+    x, y, z = (v.ravel() for v in values)
+    x_err, y_err, z_err = (e.ravel() if e is not None else None for e in errors)
+    return x, y, z, dst_shape, (x_err, y_err, z_err), WCS(dst_header).celestial.to_header()
+
+def needs_alignment(file_paths):
+    '''True if the x, y, z maps differ in shape or WCS (tables never need it).'''
+    if any(is_table_fits(file_path) for file_path in file_paths):
+        return False
+    keys = set()
+    for i, file_path in enumerate(file_paths):
+        with fits.open(file_path, memmap=True) as hdul:
+            hdu = hdul[input_hdu_name(hdul, i)]
+            keys.add(header_key(hdu.header, hdu.shape))
+    return len(keys) > 1
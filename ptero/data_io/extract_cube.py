@@ -0,0 +1,286 @@
+import os
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from concurrent.futures import ProcessPoolExecutor
+
+# Custom function declarations
+from data_io.line_catalog import LINES_BY_NAME, line_names
+
+# Extract the line maps PTERO plots (FLUX, FLUX_ERR and SIGMA per line) from
+# an IFU data cube. The cube is read through hdu.section, so only the spectral
+# windows around each line, for one block of rows at a time, are ever in
+# memory; cubes larger than RAM are fine. Row blocks are spread over a process
+# pool and every spaxel in a block is measured at once.
+
+SPEED_OF_LIGHT = 299792.458  # km/s
+
+# Names the data and variance extensions go by in common IFU pipelines;
+# IVAR (inverse variance) is inverted on read
+DATA_EXTNAMES = ['DATA', 'FLUX', 'SCI']
+VAR_EXTNAMES = ['STAT', 'VAR', 'VARIANCE', 'IVAR', 'ERR', 'ERROR']
+
+# Bytes of cube read per task; sets the number of rows in a block
+DEFAULT_BLOCK_BYTES = 64 * 2**20
+
+def line_components(lines=None):
+    """
+    Rest wavelengths of the components summed into each line.
+
+    Parameters:
+    - lines: line catalog names (default all of them)
+
+    Returns a dict such as {'NII': [6548.05, 6583.45], ...}, the rest air
+    wavelengths (Angstrom) recorded in the line catalog.
+    """
+    lines = line_names() if lines is None else lines
+    return {line: list(LINES_BY_NAME[line].wavelengths) for line in lines}
+
+def spectral_axis(header):
+    '''Wavelength (Angstrom) of every channel, from the linear WCS of axis 3.'''
+    n = header['NAXIS3']
+    step = header.get('CDELT3', header.get('CD3_3'))
+    wave = header['CRVAL3'] + (np.arange(n) + 1 - header.get('CRPIX3', 1)) * step
+    unit = str(header.get('CUNIT3', 'Angstrom')).strip().lower()
+    scale = {'m': 1e10, 'nm': 10.0, 'um': 1e4, 'micron': 1e4}.get(unit, 1.0)
+    return wave * scale
+
+def find_cube_extensions(hdul):
+    '''Index of the data cube HDU, of its variance HDU (or None) and that HDU's name (IVAR/ERR are converted on read).'''
+    data_ext = None
+    for name in DATA_EXTNAMES:
+        if name in hdul and hdul[name].header.get('NAXIS') == 3:
+            data_ext = hdul.index_of(name)
+            break
+    if data_ext is None:
+        for i, hdu in enumerate(hdul):
+            if hdu.is_image and hdu.header.get('NAXIS') == 3:
+                data_ext = i
+                break
+    if data_ext is None:
+        raise ValueError('No 3D image extension found in the cube')
+
+    for name in VAR_EXTNAMES:
+        if name in hdul and hdul[name].header.get('NAXIS') == 3:
+            return data_ext, hdul.index_of(name), name
+    return data_ext, None, None
+
+def plan_windows(wave, components, redshift=0.0, window=300.0, continuum=30.0):
+    """
+    Channel ranges to measure each line component over.
+
+    Parameters:
+    - wave: channel wavelengths (Angstrom)
+    - components: output of line_components()
+    - redshift: systemic redshift of the cube
+    - window: half-width of the line window (km/s)
+    - continuum: width of the continuum band either side of the window (Angstrom)
+
+    Returns {line: [(lo, hi, continuum_channels, rest), ...]} with channel
+    indices into wave. Continuum channels that fall in any line window are dropped.
+    """
+    step = np.median(np.diff(wave))
+    in_line = np.zeros(len(wave), dtype=bool)
+    windows = {}
+    for line, rests in components.items():
+        windows[line] = []
+        for rest in rests:
+            centre = rest * (1 + redshift)
+            half = centre * window / SPEED_OF_LIGHT
+            lo, hi = np.searchsorted(wave, [centre - half, centre + half])
+            windows[line].append((lo, hi, centre, half, rest))
+            in_line[lo:hi] = True
+
+    plans = {}
+    for line, entries in windows.items():
+        plans[line] = []
+        for lo, hi, centre, half, rest in entries:
+            if hi - lo < 3:
+                raise ValueError(f'{line} ({rest:.0f} A) falls outside the cube or its window has fewer than 3 channels')
+            side = np.abs(wave - centre)
+            band = (side > half) & (side <= half + continuum + step) & ~in_line
+            plans[line].append((lo, hi, np.flatnonzero(band), rest))
+    return plans
+
+def moment_line(spec, var, wave, cont):
+    """
+    Continuum-subtracted flux, centroid and second-moment width of a line window.
+
+    spec, var are (n_channels, n_spaxels); var may be None. Returns flux,
+    flux error (NaN without variance), centroid and sigma, both in Angstrom.
+    """
+    step = np.gradient(wave)[:, None]
+    line = spec - cont
+    flux = np.nansum(line * step, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.nansum(line, axis=0)
+        centroid = np.nansum(line * wave[:, None], axis=0) / weight
+        second = np.nansum(line * (wave[:, None] - centroid)**2, axis=0) / weight
+    sigma = np.sqrt(np.where(second > 0, second, np.nan))
+    flux_err = np.sqrt(np.nansum(var * step**2, axis=0)) if var is not None else np.full(flux.shape, np.nan)
+
+    # nansum turns spaxels with no valid channel (outside the footprint,
+    # blanked) into 0; they have no measurement at all
+    empty = ~np.isfinite(line).any(axis=0)
+    for values in (flux, flux_err, centroid, sigma):
+        values[empty] = np.nan
+    return flux, flux_err, centroid, sigma
+
+def gaussian_line(spec, var, wave, cont):
+    """
+    Single-Gaussian flux, centroid and sigma from the three channels around the peak.
+
+    Uses the closed-form fit of a parabola to the log of the peak channel and
+    its neighbours (Caruana's method), so every spaxel is solved at once
+    without iteration. Same inputs and outputs as moment_line.
+    """
+    line = spec - cont
+    n = len(wave)
+    filled = np.where(np.isfinite(line), line, -np.inf)
+    peak = np.clip(np.argmax(filled, axis=0), 1, n - 2)
+    cols = np.arange(line.shape[1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        l0, l1, l2 = (np.log(line[peak + d, cols]) for d in (-1, 0, 1))
+        curvature = l0 - 2 * l1 + l2
+        offset = 0.5 * (l0 - l2) / curvature
+        width = np.sqrt(-1 / curvature)
+        amplitude = np.exp(l1 - 0.25 * (l0 - l2) * offset)
+
+    step = np.gradient(wave)[peak]
+    good = (curvature < 0) & (np.abs(offset) < 1)
+    centroid = np.where(good, wave[peak] + offset * step, np.nan)
+    sigma = np.where(good, width * step, np.nan)
+    flux = np.where(good, amplitude * sigma * np.sqrt(2 * np.pi), np.nan)
+    flux_err = moment_line(spec, var, wave, cont)[1]
+    return flux, flux_err, centroid, sigma
+
+MEASURES = {'moment': moment_line, 'gaussian': gaussian_line}
+
+# Per-process handles on the cube, opened once by _init_worker
+_worker_state = {}
+
+def _init_worker(file_path, data_ext, var_ext, var_kind, wave, plans, method, instrumental_sigma):
+    hdul = fits.open(file_path, memmap=True)
+    _worker_state.update(hdul=hdul, data=hdul[data_ext], var=hdul[var_ext] if var_ext is not None else None,
+                         var_kind=var_kind, wave=wave, plans=plans, measure=MEASURES[method],
+                         instrumental_sigma=instrumental_sigma)
+
+def _read(hdu, lo, hi, rows):
+    block = np.asarray(hdu.section[lo:hi, rows.start:rows.stop, :], dtype=float)
+    return block.reshape(hi - lo, -1)
+
+def _extract_block(rows):
+    state = _worker_state
+    wave = state['wave']
+    results = {}
+    for line, components in state['plans'].items():
+        fluxes, errs, sigmas = [], [], []
+        for lo, hi, band, rest in components:
+            # One contiguous read covers the window and both continuum bands
+            start, stop = min(lo, band.min(initial=lo)), max(hi, band.max(initial=hi - 1) + 1)
+            spec = _read(state['data'], start, stop, rows)
+            var = None
+            if state['var'] is not None:
+                var = _read(state['var'], lo, hi, rows)
+                if state['var_kind'] == 'IVAR':
+                    with np.errstate(divide='ignore'):
+                        var = 1 / var
+                elif state['var_kind'] in ['ERR', 'ERROR']:
+                    var = var**2
+
+            cont = np.nanmedian(spec[band - start], axis=0) if len(band) else np.zeros(spec.shape[1])
+            flux, flux_err, centroid, sigma = state['measure'](spec[lo - start:hi - start], var, wave[lo:hi], cont)
+            with np.errstate(invalid='ignore'):
+                sigma_kms = SPEED_OF_LIGHT * sigma / centroid
+                sigma_kms = np.sqrt(np.where(sigma_kms > state['instrumental_sigma'],
+                                             sigma_kms**2 - state['instrumental_sigma']**2, np.nan))
+            fluxes.append(flux)
+            errs.append(flux_err)
+            sigmas.append(sigma_kms)
+
+        # Blended lines (e.g. NII 6548 + 6583) add fluxes; their width is the flux-weighted mean
+        flux = np.sum(fluxes, axis=0)
+        flux_err = np.sqrt(np.sum(np.square(errs), axis=0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = np.clip(fluxes, 0, None)
+            sigma = np.nansum(weights * np.array(sigmas), axis=0) / np.sum(np.where(np.isfinite(sigmas), weights, 0), axis=0)
+        results[line] = (flux, flux_err, sigma)
+    return rows, results
+
+def extract_line_maps(file_path, lines=None, redshift=0.0, window=300.0, continuum=30.0, method='moment',
+                      instrumental_sigma=0.0, workers=None, block_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Measure every line in a data cube, spaxel by spaxel.
+
+    Parameters:
+    - file_path: FITS cube with a (wavelength, y, x) data extension and, optionally, a variance one
+    - lines: line catalog names (default all of them)
+    - redshift, window, continuum: see plan_windows
+    - method: 'moment' (continuum-subtracted moments) or 'gaussian' (closed-form single Gaussian)
+    - instrumental_sigma: instrumental dispersion (km/s) removed in quadrature from SIGMA
+    - workers: processes to spread row blocks over (None for os.cpu_count(), 1 to run serially)
+    - block_bytes: approximate bytes of cube read per block
+
+    Returns {line: {'FLUX': map, 'FLUX_ERR': map, 'SIGMA': map}} with SIGMA in
+    km/s, and a 2D header carrying the celestial WCS of the cube.
+    """
+    if method not in MEASURES:
+        raise ValueError(f'<method> must be one of {list(MEASURES)}. You entered {method}')
+
+    with fits.open(file_path, memmap=True) as hdul:
+        data_ext, var_ext, var_name = find_cube_extensions(hdul)
+        header = hdul[data_ext].header
+        n_chan, ny, nx = header['NAXIS3'], header['NAXIS2'], header['NAXIS1']
+        wave = spectral_axis(header)
+        celestial = WCS(header).celestial.to_header()
+
+    plans = plan_windows(wave, line_components(lines), redshift, window, continuum)
+    channels = sum(hi - lo + len(band) for components in plans.values() for lo, hi, band, _ in components)
+    rows_per_block = max(1, int(block_bytes // max(1, channels * nx * 8)))
+    blocks = [range(y, min(y + rows_per_block, ny)) for y in range(0, ny, rows_per_block)]
+
+    initargs = (file_path, data_ext, var_ext, var_name, wave, plans, method, instrumental_sigma)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(blocks) <= 1:
+        _init_worker(*initargs)
+        results = map(_extract_block, blocks)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs)
+        results = pool.map(_extract_block, blocks)
+
+    maps = {line: {name: np.full((ny, nx), np.nan) for name in ['FLUX', 'FLUX_ERR', 'SIGMA']} for line in plans}
+    try:
+        for rows, block in results:
+            for line, values in block.items():
+                for name, value in zip(['FLUX', 'FLUX_ERR', 'SIGMA'], values):
+                    maps[line][name][rows.start:rows.stop] = value.reshape(len(rows), nx)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        elif 'hdul' in _worker_state:
+            _worker_state.pop('hdul').close()
+
+    return maps, celestial
+
+def write_line_maps(out_dir, maps, header=None, prefix='cube', overwrite=False):
+    """
+    Write extract_line_maps output as one FITS file per line, e.g. <prefix>_Ha.fits,
+    with FLUX, FLUX_ERR and SIGMA extensions that load_fits_data and
+    load_line_maps read directly. Returns the file paths keyed by line.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+    for line, line_maps in maps.items():
+        hdul = fits.HDUList([fits.PrimaryHDU()])
+        for name, data in line_maps.items():
+            if name == 'FLUX_ERR' and not np.any(np.isfinite(data)):
+                continue
+            hdu = fits.ImageHDU(data, header=header, name=name)
+            if name == 'SIGMA':
+                hdu.header['BUNIT'] = 'km/s'
+            hdul.append(hdu)
+        paths[line] = os.path.join(out_dir, f'{prefix}_{line}.fits')
+        hdul.writeto(paths[line], overwrite=overwrite)
+    return paths
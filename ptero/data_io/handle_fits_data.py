@@ -1,19 +1,16 @@
+import os
 import numpy as np
 from astropy.io import fits
 from astropy.table import Table
 
+# Custom function declarations
+from data_io.compressed_fits import is_compressed, read_compressed, region_slices
+from data_io.line_catalog import fits_name, match_file_name
+
 def convert_line_ratio_label(label):
     
-    # Two lists for model labels and fits labels to convert between them
-    model_list = ["S23", "O23", "Hα λ6563"]
-    fits_list = ["S23", "O23", "Ha6563"]
-
-    if label in model_list:
-        fits_label = fits_list[model_list.index(label)]
-    else:
-        fits_label = None
-    
-    return fits_label
+    # Model labels resolve to FITS labels through the line catalog
+    return fits_name(label)
 
 def is_table_fits(file_path):
     """Return True if any extension is a BinTableHDU / TableHDU."""
@@ -24,12 +21,29 @@ def is_table_fits(file_path):
                 return True
     return False
 
-def load_fits_data(file_paths):
+def read_image(hdul, name, region=None):
+    """
+    Return the data of image extension <name>, or only a (y0, y1, x0, x1) cutout of it.
+
+    For tile-compressed extensions only the tiles the cutout touches are
+    decompressed.
+    """
+    hdu = hdul[name]
+    if is_compressed(hdu):
+        return read_compressed(hdu, region)
+    if region is None:
+        return hdu.data
+    rows, cols = region_slices(hdu.shape, region)
+    return hdu.section[rows, cols]
+
+def load_fits_data(file_paths, return_shape=False, region=None):
 
     # Loop over all filenames
     for i, file_path in enumerate(file_paths):
 
         if is_table_fits(file_path):
+            if region is not None:
+                raise ValueError('A cutout region only applies to FITS maps, not tables')
             # Open as table
             tb = Table.read(file_path)
 
@@ -47,20 +61,112 @@ def load_fits_data(file_paths):
                 # For x and y dimensions, try looking at diagnostics and flux
                 if i == 0:
                     try:
-                        x_data = hdul['DIAGNOSTIC'].data
-                    except Exception:
-                        x_data = hdul['FLUX'].data
+                        x_data = read_image(hdul, 'DIAGNOSTIC', region)
+                    except KeyError:
+                        x_data = read_image(hdul, 'FLUX', region)
                 elif i == 1:
                     try:
-                        y_data = hdul['DIAGNOSTIC'].data
-                    except Exception:
-                        y_data = hdul['FLUX'].data
+                        y_data = read_image(hdul, 'DIAGNOSTIC', region)
+                    except KeyError:
+                        y_data = read_image(hdul, 'FLUX', region)
                 # For z dimension, look only at sigma
                 elif i == 2:
-                    z_data = hdul['SIGMA'].data
+                    z_data = read_image(hdul, 'SIGMA', region)
     
+    # Optionally report the pixel grid so flattened values can be mapped back
+    if return_shape:
+        return x_data.flatten(), y_data.flatten(), z_data.flatten(), x_data.shape
     return x_data.flatten(), y_data.flatten(), z_data.flatten()
 
+def find_error_data(file_path, name, region=None):
+    """
+    Return the uncertainty matching the <name> HDU or table column, or None.
+
+    Looks for the usual suffixes (e.g. FLUX_ERR, FLUX_ERROR, ERR_FLUX) and, for
+    maps only, a variance extension (e.g. FLUX_VAR) which is square rooted.
+    """
+    err_names = [f'{name}_ERR', f'{name}_ERROR', f'ERR_{name}', f'{name}_SIGMA_ERR']
+    var_names = [f'{name}_VAR', f'VAR_{name}']
+
+    if is_table_fits(file_path):
+        tb = Table.read(file_path)
+        for err_name in err_names:
+            if err_name in tb.colnames:
+                return np.asarray(tb[err_name].data, dtype=float)
+        return None
+
+    with fits.open(file_path, memmap=True) as hdul:
+        for err_name in err_names:
+            if err_name in hdul:
+                return np.asarray(read_image(hdul, err_name, region), dtype=float)
+        for var_name in var_names:
+            if var_name in hdul:
+                return np.sqrt(np.asarray(read_image(hdul, var_name, region), dtype=float))
+    return None
+
+def load_fits_errors(file_paths, region=None):
+    """
+    Load the uncertainties matching the x, y, z data read by load_fits_data.
+
+    Returns flattened x_err, y_err, z_err; each is None if no error HDU/column exists.
+    """
+    errors = []
+    for i, file_path in enumerate(file_paths):
+        # Match the extension load_fits_data reads for this dimension
+        if i == 2:
+            name = 'SIGMA'
+        elif is_table_fits(file_path):
+            name = 'FLUX'
+        else:
+            with fits.open(file_path, memmap=True) as hdul:
+                name = 'DIAGNOSTIC' if 'DIAGNOSTIC' in hdul else 'FLUX'
+        err_data = find_error_data(file_path, name, region)
+        errors.append(err_data.flatten() if err_data is not None else None)
+
+    return tuple(errors)
+
+def match_line_name(file_path, names):
+    """Return the entry of names the file name's words spell out (catalog aliases included), or None."""
+    return match_file_name(file_path, names)
+
+def load_line_maps(file_paths, names):
+    """
+    Load one line (or quantity) map per file, identified by its file name.
+
+    Each file is read like the x/y inputs of load_fits_data (DIAGNOSTIC or FLUX);
+    the first SIGMA extension or column found is returned as the z map.
+    Returns a dict of flattened maps keyed by name, the flattened sigma map
+    (or None) and the shape of the pixel grid.
+    """
+    maps, sigma, shape = {}, None, None
+    for file_path in file_paths:
+        name = match_line_name(file_path, names)
+        if name is None:
+            raise ValueError(f'Could not match {os.path.basename(file_path)} to any of {names}')
+
+        if is_table_fits(file_path):
+            tb = Table.read(file_path)
+            data = np.asarray(tb['FLUX'].data)
+            sigma_data = np.asarray(tb['SIGMA'].data) if 'SIGMA' in tb.colnames else None
+        else:
+            with fits.open(file_path, memmap=True) as hdul:
+                data = hdul['DIAGNOSTIC'].data if 'DIAGNOSTIC' in hdul else hdul['FLUX'].data
+                sigma_data = hdul['SIGMA'].data if 'SIGMA' in hdul else None
+                data = np.asarray(data)
+                sigma_data = np.asarray(sigma_data) if sigma_data is not None else None
+
+        if shape is None:
+            shape = data.shape
+        elif data.shape != shape:
+            raise ValueError(f'{os.path.basename(file_path)} has shape {data.shape}, expected {shape}')
+        if name in maps:
+            raise ValueError(f'{os.path.basename(file_path)} is a second map for {name}')
+        maps[name] = data.flatten()
+        if sigma is None and sigma_data is not None:
+            sigma = sigma_data.flatten()
+
+    return maps, sigma, shape
+
 def load_fits_mask(file_path):
 
     with fits.open(file_path) as hdul:
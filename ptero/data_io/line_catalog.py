@@ -0,0 +1,152 @@
+import os
+import re
+from functools import lru_cache
+
+# One catalog of the emission lines and quantities PTERO knows about: short
+# name, species, ionisation state, rest wavelengths, 3MdBs SQL expression,
+# FITS name and the aliases the line goes by in model tables and file names.
+# Lookup tables are built once at import, so dropdowns, FITS matching and
+# query generation resolve names with dict lookups instead of re-parsing.
+
+class Line:
+    """
+    One catalog entry.
+
+    wavelengths are the rest air wavelengths (Angstrom) of every component
+    summed into the line (e.g. both [NII] lines); sql is the matching 3MdBs
+    expression. ion is the spectroscopic ionisation state (1 for HI, 3 for
+    OIII). order is the position in dropdowns.
+    """
+    def __init__(self, name, species, ion, wavelengths, sql, fits_name=None, aliases=(), order=0):
+        self.name = name
+        self.species = species
+        self.ion = ion
+        self.wavelengths = tuple(wavelengths)
+        self.sql = sql
+        self.fits_name = fits_name or name
+        self.aliases = tuple(aliases)
+        self.order = order
+
+    @property
+    def sort_key(self):
+        '''Same (element, ionisation state, rest) form as sorting.sort_key.'''
+        return (self.species.upper(), self.ion, f' {self.wavelengths[0]:.0f}')
+
+class Quantity:
+    """A line-ratio combination computed in SQL (e.g. O23), with its FITS name and aliases."""
+    def __init__(self, name, sql, fits_name=None, aliases=(), order=0):
+        self.name = name
+        self.sql = sql
+        self.fits_name = fits_name or name
+        self.aliases = tuple(aliases)
+        self.order = order
+
+LINES = [
+    Line('Ha', 'H', 1, [6562.80], 'emis_VI.HI_6563', 'Ha6563',
+         ['Halpha', 'H_alpha', 'H-alpha', 'Hα', 'Hα λ6563', 'Ha6563', 'Ha_6563', 'HI_6563']),
+    Line('Hb', 'H', 1, [4861.33], 'emis_VI.HI_4861', 'Hb4861',
+         ['Hbeta', 'H_beta', 'H-beta', 'Hβ', 'Hβ λ4861', 'Hb4861', 'Hb_4861', 'HI_4861']),
+    Line('OIII_5007', 'O', 3, [5006.84], 'emis_VI.OIII_5007', None,
+         ['[OIII]', '[OIII] λ5007', 'OIII5007', 'OIII 5007']),
+    Line('NII', 'N', 2, [6548.05, 6583.45], 'emis_VI.NII_6548 + emis_VI.NII_6583', None,
+         ['[NII]', '[NII] λ6583', 'NII_6583', 'NII6583']),
+    Line('SII', 'S', 2, [6716.44, 6730.82], 'emis_VI.SII_6716 + emis_VI.SII_6731', None,
+         ['[SII]', '[SII] λλ6716,6731', 'SII_6716', 'SII_6731', 'SII6716', 'SII6731']),
+]
+
+QUANTITIES = [
+    Quantity('O23', '(emis_VI.OII_7320 + emis_VI.OII_7320) / emis_VI.OIII_5007'),
+    Quantity('S23', '(emis_VI.SII_6716 + emis_VI.SII_6731 + emis_IR.SIII_9069) / emis_VI.HI_4861'),
+    Quantity('OIII_Hb', 'emis_VI.OIII_5007 / emis_VI.HI_4861', aliases=['[OIII]/Hb', 'O3Hb']),
+    Quantity('NII_Ha', 'emis_VI.NII_6583 / emis_VI.HI_6563', aliases=['[NII]/Ha', 'N2Ha']),
+    Quantity('SII_Ha', '(emis_VI.SII_6716 + emis_VI.SII_6731) / emis_VI.HI_6563', aliases=['[SII]/Ha', 'S2Ha']),
+]
+for order, entry in enumerate(LINES):
+    entry.order = order
+for order, entry in enumerate(QUANTITIES):
+    entry.order = order
+
+def _normalise(label):
+    # Case, brackets, spaces and separators do not distinguish names
+    return re.sub(r'[\s\[\]_\-]', '', label).lower()
+
+# Lookup tables
+LINES_BY_NAME = {line.name: line for line in LINES}
+QUANTITIES_BY_NAME = {quantity.name: quantity for quantity in QUANTITIES}
+LINE_SQL = {line.name: line.sql for line in LINES}
+QUANTITY_SQL = {quantity.name: quantity.sql for quantity in QUANTITIES}
+SORT_ORDER = {line.name: line.order for line in LINES}
+LABELS = {}
+ALIASES = {}
+for entry in LINES + QUANTITIES:
+    for label in (entry.name, entry.fits_name) + entry.aliases:
+        LABELS.setdefault(label, entry.name)
+        ALIASES.setdefault(_normalise(label), entry.name)
+
+def line_names():
+    '''Line names in dropdown order.'''
+    return list(LINE_SQL)
+
+def quantity_names():
+    '''Quantity names in dropdown order.'''
+    return list(QUANTITY_SQL)
+
+def resolve(label):
+    '''Catalog name of a line or quantity given any of its names or aliases, or None.'''
+    # Exact spellings need no normalising
+    name = LABELS.get(label)
+    return name if name is not None else ALIASES.get(_normalise(label))
+
+def lookup(label):
+    '''Line or Quantity for a name or alias; KeyError if unknown.'''
+    name = resolve(label)
+    if name is None:
+        raise KeyError(f'Unknown line or quantity {label!r}')
+    return LINES_BY_NAME.get(name) or QUANTITIES_BY_NAME[name]
+
+def fits_name(label):
+    '''Name of a line or quantity in FITS files, or None if it is not in the catalog.'''
+    name = resolve(label)
+    if name is None:
+        return None
+    return (LINES_BY_NAME.get(name) or QUANTITIES_BY_NAME[name]).fits_name
+
+def file_name_tokens(file_path):
+    '''Words of a file name without its FITS extensions, split at _, -, . and spaces.'''
+    stem = re.sub(r'(\.(fits?|fts|fz|gz))+$', '', os.path.basename(file_path), flags=re.IGNORECASE)
+    return [token for token in re.split(r'[\s_.\-]+', stem) if token]
+
+@lru_cache(maxsize=None)
+def _file_spellings(names):
+    # Every spelling of every name, normalised, mapped to the names it stands for
+    spellings = {}
+    for name in names:
+        entry = LINES_BY_NAME.get(name) or QUANTITIES_BY_NAME.get(name)
+        labels = [name] if entry is None else [name, entry.fits_name, *entry.aliases]
+        for label in labels:
+            spellings.setdefault(_normalise(label), set()).add(name)
+    return spellings
+
+def match_file_name(file_path, names):
+    """
+    Entry of names that the file name spells out, or None.
+
+    Runs of whole words of the file name (file_name_tokens) are compared
+    exactly against each name and its catalog aliases, so 'Ha' is found in
+    shape_Ha.fits but not in shape_Hb.fits. A match inside a longer one
+    (NII in NII_Ha) is ignored; ValueError if the file name still matches
+    more than one entry.
+    """
+    tokens = file_name_tokens(file_path)
+    spellings = _file_spellings(tuple(names))
+    matches = []
+    for start in range(len(tokens)):
+        for stop in range(start + 1, len(tokens) + 1):
+            for name in spellings.get(_normalise(''.join(tokens[start:stop])), ()):
+                matches.append((start, stop, name))
+
+    found = sorted({name for start, stop, name in matches
+                    if not any(s <= start and stop <= e and (s, e) != (start, stop) for s, e, _ in matches)})
+    if len(found) > 1:
+        raise ValueError(f'{os.path.basename(file_path)} matches more than one of {list(names)}: {found}')
+    return found[0] if found else None
@@ -0,0 +1,213 @@
+import ast
+import numpy as np
+
+# Custom function declarations
+from data_io.result_cache import ResultCache
+
+# Named bad pixel masks (True = bad) held bit-packed, 1 bit per pixel, and
+# combined with lazily evaluated boolean expressions such as
+# 'badpix | snr | ~region'. Operators work byte-wise on the packed bits, and
+# each evaluated combination is cached, still packed, until one of its
+# masks changes.
+
+class PackedMask:
+    """A boolean map stored with np.packbits (1 bit per pixel)."""
+    def __init__(self, bits, shape):
+        self.bits = bits
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_bool(cls, mask):
+        mask = np.asarray(mask, dtype=bool)
+        return cls(np.packbits(mask.ravel()), mask.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def to_bool(self):
+        return np.unpackbits(self.bits, count=self.size).view(bool).reshape(self.shape)
+
+    def count(self):
+        '''Number of True pixels.'''
+        # Padding bits are always zero, so every set bit is a pixel
+        return int(np.unpackbits(self.bits).sum())
+
+    def _check(self, other):
+        if self.shape != other.shape:
+            raise ValueError(f'Cannot combine masks of shape {self.shape} and {other.shape}')
+
+    def __and__(self, other):
+        self._check(other)
+        return PackedMask(self.bits & other.bits, self.shape)
+
+    def __or__(self, other):
+        self._check(other)
+        return PackedMask(self.bits | other.bits, self.shape)
+
+    def __xor__(self, other):
+        self._check(other)
+        return PackedMask(self.bits ^ other.bits, self.shape)
+
+    def __invert__(self):
+        bits = ~self.bits
+        # Keep the padding bits of the last byte clear
+        spare = len(bits) * 8 - self.size
+        if spare:
+            bits[-1] &= np.uint8((0xFF << spare) & 0xFF)
+        return PackedMask(bits, self.shape)
+
+def threshold_mask(values, lo=None, hi=None):
+    '''PackedMask of pixels below lo, above hi, or not finite.'''
+    values = np.asarray(values, dtype=float)
+    bad = ~np.isfinite(values)
+    if lo is not None:
+        bad |= values < lo
+    if hi is not None:
+        bad |= values > hi
+    return PackedMask.from_bool(bad)
+
+def sn_threshold_mask(flux, err, min_sn):
+    '''PackedMask of pixels whose flux / err is below min_sn (or undefined).'''
+    flux = np.asarray(flux, dtype=float)
+    err = np.asarray(err, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return threshold_mask(np.where(err > 0, flux / err, np.nan), lo=min_sn)
+
+class MaskExpr:
+    """
+    Lazy boolean combination of named masks, built with &, |, ^ and ~.
+
+    Nothing is computed until MaskStore.evaluate(); key is a canonical string
+    used to cache the result.
+    """
+    def __and__(self, other):
+        return MaskOp('&', self, other)
+
+    def __or__(self, other):
+        return MaskOp('|', self, other)
+
+    def __xor__(self, other):
+        return MaskOp('^', self, other)
+
+    def __invert__(self):
+        return MaskOp('~', self)
+
+class MaskRef(MaskExpr):
+    def __init__(self, name):
+        self.name = name
+
+    @property
+    def key(self):
+        return self.name
+
+    def names(self):
+        return {self.name}
+
+    def evaluate(self, store):
+        return store.packed(self.name)
+
+class MaskOp(MaskExpr):
+    def __init__(self, op, *args):
+        self.op = op
+        self.args = args
+
+    @property
+    def key(self):
+        if self.op == '~':
+            return f'~{self.args[0].key}'
+        return f'({self.args[0].key} {self.op} {self.args[1].key})'
+
+    def names(self):
+        return set().union(*(arg.names() for arg in self.args))
+
+    def evaluate(self, store):
+        values = [arg.evaluate(store) for arg in self.args]
+        if self.op == '~':
+            return ~values[0]
+        if self.op == '&':
+            return values[0] & values[1]
+        if self.op == '|':
+            return values[0] | values[1]
+        return values[0] ^ values[1]
+
+_AST_OPS = {ast.BitAnd: '&', ast.BitOr: '|', ast.BitXor: '^'}
+
+def parse_mask_expression(text):
+    '''Parse e.g. "badpix | (snr & ~region)" into a MaskExpr. Only names, &, |, ^, ~ and brackets are allowed.'''
+    def build(node):
+        if isinstance(node, ast.Name):
+            return MaskRef(node.id)
+        if isinstance(node, ast.BinOp) and type(node.op) in _AST_OPS:
+            return MaskOp(_AST_OPS[type(node.op)], build(node.left), build(node.right))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+            return ~build(node.operand)
+        raise ValueError(f'Unsupported mask expression: {ast.unparse(node)}')
+
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f'Invalid mask expression {text!r}: {e.msg}') from e
+    return build(tree.body)
+
+class MaskStore:
+    """
+    Named PackedMasks on one pixel grid, plus a cache of evaluated expressions.
+
+    Every mask added bumps its version, so cached results that used the old
+    mask are never returned.
+    """
+    def __init__(self, maxsize=16):
+        self.masks = {}
+        self.versions = {}
+        self.shape = None
+        self._cache = ResultCache(maxsize)
+
+    def names(self):
+        return list(self.masks)
+
+    def add(self, name, mask):
+        '''Add or replace a mask (bool array or PackedMask).'''
+        if not name.isidentifier():
+            raise ValueError(f'Mask names must be identifiers (letters, digits, _); got {name!r}')
+        packed = mask if isinstance(mask, PackedMask) else PackedMask.from_bool(mask)
+        if self.shape is not None and self.masks and packed.shape != self.shape:
+            raise ValueError(f'Mask {name!r} has shape {packed.shape}, expected {self.shape}')
+        self.shape = packed.shape
+        self.masks[name] = packed
+        self.versions[name] = self.versions.get(name, 0) + 1
+
+    def remove(self, name):
+        self.masks.pop(name, None)
+        self.versions[name] = self.versions.get(name, 0) + 1
+
+    def packed(self, name):
+        if name not in self.masks:
+            raise KeyError(f'No mask named {name!r}; have {self.names()}')
+        return self.masks[name]
+
+    def expression(self, text=None):
+        '''MaskExpr from text, defaulting to the union of every mask.'''
+        if text:
+            return parse_mask_expression(text)
+        if not self.masks:
+            raise ValueError('No masks loaded')
+        expr = None
+        for name in self.masks:
+            expr = MaskRef(name) if expr is None else expr | MaskRef(name)
+        return expr
+
+    def evaluate(self, expr):
+        '''
+        Evaluate an expression (MaskExpr or text) to a PackedMask, cached per mask versions.
+
+        Results stay packed; callers unpack (to_bool) only the mask they apply.
+        '''
+        if not isinstance(expr, MaskExpr):
+            expr = self.expression(expr)
+        key = (expr.key,) + tuple((name, self.versions.get(name, 0)) for name in sorted(expr.names()))
+        return self._cache.get_or_compute(key, lambda: expr.evaluate(self))
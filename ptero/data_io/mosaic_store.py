@@ -0,0 +1,122 @@
+import json
+import os
+import numpy as np
+
+# Many fields (pointings) in one on-disk pixel store. Every field's valid
+# pixels are appended to flat column files (x, y, z, field ID and the pixel's
+# index in its own map) which are read back as read-only memory maps, so
+# dozens of fields can be overlaid without holding them all in RAM. Each
+# field occupies one contiguous row range, recorded with its offset in
+# store.json.
+
+COLUMNS = {'x': np.float64, 'y': np.float64, 'z': np.float64, 'field': np.int32, 'pixel': np.int64}
+
+class MosaicStore:
+    """
+    Columnar, append-only store of pixels from many fields.
+
+    fields is a list of dicts (name, paths, shape, offset, count), in the
+    order they were added; a field's ID is its position in that list.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.meta_path = os.path.join(directory, 'store.json')
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.fields = json.load(f)['fields']
+        else:
+            self.fields = []
+
+    @property
+    def n_rows(self):
+        return sum(field['count'] for field in self.fields)
+
+    @property
+    def field_names(self):
+        return [field['name'] for field in self.fields]
+
+    def _column_path(self, name):
+        return os.path.join(self.directory, f'{name}.bin')
+
+    def _save_meta(self):
+        # Written after the column data, so a crash mid-append leaves the old rows readable
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'fields': self.fields}, f, indent=1)
+        os.replace(tmp_path, self.meta_path)
+
+    def add_field(self, name, points, paths=()):
+        """
+        Append the unmasked pixels with finite x and y of a FitsPoints as a new field.
+
+        Returns the field's ID.
+        """
+        if name in self.field_names:
+            raise ValueError(f'A field named {name!r} is already in the store')
+
+        keep = ~points.mask & np.isfinite(points.x) & np.isfinite(points.y)
+        pixel = np.flatnonzero(keep)
+        field_id = len(self.fields)
+        columns = {
+            'x': points.x[pixel],
+            'y': points.y[pixel],
+            'z': points.z[pixel],
+            'field': np.full(len(pixel), field_id),
+            'pixel': pixel,
+        }
+
+        # Existing files may hold rows past n_rows from an interrupted append; cut them off first
+        offset = self.n_rows
+        for col, dtype in COLUMNS.items():
+            path = self._column_path(col)
+            with open(path, 'ab') as f:
+                f.truncate(offset * np.dtype(dtype).itemsize)
+                f.write(np.ascontiguousarray(columns[col], dtype=dtype).tobytes())
+
+        self.fields.append(dict(name=name, paths=list(paths), shape=list(points.shape), offset=offset, count=len(pixel)))
+        self._save_meta()
+        return field_id
+
+    def column(self, name):
+        '''Read-only memory map of one column over every field.'''
+        n = self.n_rows
+        if n == 0:
+            return np.zeros(0, dtype=COLUMNS[name])
+        return np.memmap(self._column_path(name), dtype=COLUMNS[name], mode='r', shape=(n,))
+
+    def field_slice(self, field):
+        '''Row range of a field, by name or ID.'''
+        info = self.fields[self.field_names.index(field) if isinstance(field, str) else field]
+        return slice(info['offset'], info['offset'] + info['count'])
+
+    def select(self, fields=None):
+        """
+        FitsPoints of the chosen fields (names or IDs; default all).
+
+        A single field, or all of them, is returned as memory-mapped views;
+        other selections copy just the chosen row ranges. The points carry
+        field (ID per row) and field_names for colouring by field.
+        """
+        # Imported here so the store can be used without the plotting modules
+        from pipeline import FitsPoints
+
+        if fields is None:
+            rows = [slice(0, self.n_rows)]
+        else:
+            rows = [self.field_slice(field) for field in fields]
+
+        def gather(name):
+            col = self.column(name)
+            if len(rows) == 1:
+                return col[rows[0]]
+            return np.concatenate([col[r] for r in rows])
+
+        return FitsPoints(gather('x'), gather('y'), gather('z'), field=gather('field'), field_names=self.field_names)
+
+    def field_map(self, field, values):
+        '''Paint per-row values of one field (e.g. inferred velocities) back onto its pixel grid.'''
+        info = self.fields[self.field_names.index(field) if isinstance(field, str) else field]
+        full = np.full(int(np.prod(info['shape'])), np.nan)
+        full[self.column('pixel')[self.field_slice(field)]] = values
+        return full.reshape(info['shape'])
@@ -1,73 +1,112 @@
 import pandas as pd
 import os
-from sqlalchemy import create_engine
+import time
+from functools import lru_cache
+from sqlalchemy import bindparam, create_engine, text
+
+# Custom function declarations
+from data_io.line_catalog import LINE_SQL, QUANTITY_SQL
+from data_io.query_log import QUERY_LOG, QueryRecord
+from data_io.shared_cache import SHARED_CACHE
+from profiling import span
+
+# Statements are built once per query shape (which columns are selected and
+# which filters apply) as SQLAlchemy text() with bound parameters, and reused
+# with new values on every call. Engines are kept per URL, so their
+# connection pools and compiled-statement caches survive between queries.
+
+_ENGINES = {}
+
+def get_3mdbs_engine():
+
+    # A full SQLAlchemy URL (e.g. a local SQLite copy of 3MdBs) overrides the server settings
+    url = os.environ.get('MdB_URL')
+    if url is None:
+        # Set environment variables
+        host   = os.environ['MdB_HOST']
+        user   = os.environ['MdB_USER']
+        passwd = os.environ['MdB_PASSWD']
+        port   = os.environ['MdB_PORT']
+        dbname = "3MdBs"
+        url = f"mysql+pymysql://{user}:{passwd}@{host}:{port}/{dbname}"
+
+    # One engine per URL and process (pooled connections must not cross a fork)
+    key = (url, os.getpid())
+    if key not in _ENGINES:
+        _ENGINES[key] = create_engine(url)
+    return _ENGINES[key]
+
+def explain_prefix(dialect):
+    '''Statement prefix that asks this database for its query plan.'''
+    return 'EXPLAIN QUERY PLAN ' if dialect == 'sqlite' else 'EXPLAIN '
+
+def run_query(name, statement, params=None, **meta):
+    """
+    Execute a statement with bound parameters and return a DataFrame.
+
+    With a node-local SHARED_CACHE (PTERO_SHARED_CACHE) the result is shared
+    with other PTERO processes, keyed by database, statement and values, and
+    identical concurrent queries reach the database once.
+    """
+    params = params or {}
+    if SHARED_CACHE is None:
+        return execute_query(name, statement, params, **meta)
+    engine = get_3mdbs_engine()
+    key = (engine.url.render_as_string(hide_password=True), statement.text, sorted(params.items()))
+    return SHARED_CACHE.get_or_compute(key, lambda: execute_query(name, statement, params, **meta))
+
+def execute_query(name, statement, params, **meta):
+    """
+    run_query without the shared cache: always asks the database.
+
+    The call is timed into QUERY_LOG; if it is slow and QUERY_LOG.explain is
+    set, the database's plan for the same statement and values is kept too.
+    """
+    engine = get_3mdbs_engine()
+    with span(f'sql.{name}', **meta), engine.connect() as conn:
+        start = time.perf_counter()
+        result = pd.read_sql(statement, con=conn, params=params)
+        wall = time.perf_counter() - start
+
+        plan = None
+        if QUERY_LOG.explain and QUERY_LOG.is_slow(wall):
+            # List values are IN (...) parameters and must expand here too
+            expanding = [bindparam(key, expanding=True) for key, value in params.items() if isinstance(value, list)]
+            explain = text(explain_prefix(engine.dialect.name) + statement.text).bindparams(*expanding)
+            plan = pd.read_sql(explain, con=conn, params=params).to_dict('records')
+    QUERY_LOG.record(QueryRecord(name, ' '.join(statement.text.split()), params, wall, len(result), plan))
+    return result
 
 def format_quantity_as_sql_query(quantity):
 
-    # Dict of quantities to extract using SQL queries
-    quantities = return_quantities()
-    
-    # Only return SQL query if in quantities dict
-    if quantity in quantities.keys():
-        sql_query = f'{quantities.get(quantity)} AS {quantity}'
+    # Only return SQL query if the quantity is in the line catalog
+    if quantity in QUANTITY_SQL:
+        sql_query = f'{QUANTITY_SQL[quantity]} AS {quantity}'
     else:
         sql_query = None
     return sql_query
 
 def format_line_ratio_as_sql_query(num, den):
 
-    lines = return_lines()
-
-    if num in lines.keys() and den in lines.keys():
+    if num in LINE_SQL and den in LINE_SQL:
         # print('num:', num, 'den:', den)
-        sql_query = f'{lines.get(num)} / {lines.get(den)} AS {num}_{den}'
+        # Parenthesise so multi-line sums (e.g. NII, SII) are divided as a whole
+        sql_query = f'({LINE_SQL[num]}) / ({LINE_SQL[den]}) AS {num}_{den}'
 
     return sql_query
 
-def send_3mdbs_query(xquan, yquan, xnum, xden, ynum, yden, abundance, preshck_dens, shck_vel_lo, shck_vel_hi, precursor, shock, independent):
-
-    # print(xquan, yquan, xnum, xden, ynum, yden, abundance, preshck_dens, shck_vel_lo, shck_vel_hi, shock, precursor, independent)
-
-    # Set environment variables
-    host   = os.environ['MdB_HOST']
-    user   = os.environ['MdB_USER']
-    passwd = os.environ['MdB_PASSWD']
-    port   = os.environ['MdB_PORT']
-    dbname = "3MdBs"
-    engine = create_engine(f"mysql+pymysql://{user}:{passwd}@{host}:{port}/{dbname}")
-
-    # Select model type
-    if shock and not precursor:
-        model_type = 'shock'
-    elif precursor and not shock:
-        model_type = 'precursor'
-    elif precursor and shock and not independent:
-        model_type = 'shock_plus_precursor'
-    elif precursor and shock and independent:
-        model_type1 = 'shock'
-        model_type2 = 'precursor'
-
-    # Run two SQL queries for independent plottng of shock and precursor
+def model_type_filter(shock, precursor, independent):
+    '''model_type values to query: two for independent shock and precursor grids, else one.'''
     if independent:
-        sel_shck = f"""SELECT
-                    shock_params.shck_vel AS shck_vel,
-                    {format_line_ratio_as_sql_query(xnum, xden)},
-                    {format_line_ratio_as_sql_query(ynum, yden)},
-                    {format_quantity_as_sql_query(xquan)},
-                    {format_quantity_as_sql_query(yquan)},
-                    shock_params.mag_fld AS mag_fld
-                FROM shock_params
-                    INNER JOIN emis_IR ON emis_IR.ModelID=shock_params.ModelID
-                    INNER JOIN emis_VI ON emis_VI.ModelID=shock_params.ModelID
-                    INNER JOIN abundances ON abundances.AbundID=shock_params.AbundID
-                WHERE emis_VI.model_type='{model_type1}' AND emis_IR.model_type='{model_type1}'
-                    AND abundances.name='{abundance}'
-                    AND shock_params.ref='Allen08'
-                    AND shock_params.shck_vel BETWEEN {shck_vel_lo} AND {shck_vel_hi}
-                    AND shock_params.preshck_dens={preshck_dens}
-                ORDER BY shck_vel;"""
-        
-        sel_prec = f"""SELECT
+        return ['shock', 'precursor']
+    if shock and precursor:
+        return ['shock_plus_precursor']
+    return ['shock'] if shock else ['precursor']
+
+@lru_cache(maxsize=128)
+def model_query_statement(xquan, yquan, xnum, xden, ynum, yden):
+    '''Parameterised send_3mdbs_query statement for one choice of columns.'''
+    return text(f"""SELECT
                     shock_params.shck_vel AS shck_vel,
                     {format_line_ratio_as_sql_query(xnum, xden)},
                     {format_line_ratio_as_sql_query(ynum, yden)},
@@ -78,117 +117,139 @@ def send_3mdbs_query(xquan, yquan, xnum, xden, ynum, yden, abundance, preshck_de
                     INNER JOIN emis_IR ON emis_IR.ModelID=shock_params.ModelID
                     INNER JOIN emis_VI ON emis_VI.ModelID=shock_params.ModelID
                     INNER JOIN abundances ON abundances.AbundID=shock_params.AbundID
-                WHERE emis_VI.model_type='{model_type2}' AND emis_IR.model_type='{model_type2}'
-                    AND abundances.name='{abundance}'
-                    AND shock_params.ref='Allen08'
-                    AND shock_params.shck_vel BETWEEN {shck_vel_lo} AND {shck_vel_hi}
-                    AND shock_params.preshck_dens={preshck_dens}
-                ORDER BY shck_vel;"""
-
-        # Run query
-        with engine.connect() as conn:
-            result_shck = pd.read_sql(sel_shck, con=conn)
-            result_prec = pd.read_sql(sel_prec, con=conn)
-            return [result_shck, result_prec]
-    else:
-        sel = f"""SELECT
+                WHERE emis_VI.model_type=:model_type AND emis_IR.model_type=:model_type
+                    AND abundances.name=:abundance
+                    AND shock_params.ref=:ref
+                    AND shock_params.shck_vel BETWEEN :shck_vel_lo AND :shck_vel_hi
+                    AND shock_params.preshck_dens=:preshck_dens
+                ORDER BY shck_vel""")
+
+def send_3mdbs_query(xquan, yquan, xnum, xden, ynum, yden, abundance, preshck_dens, shck_vel_lo, shck_vel_hi, precursor, shock, independent, ref='Allen08'):
+
+    # print(xquan, yquan, xnum, xden, ynum, yden, abundance, preshck_dens, shck_vel_lo, shck_vel_hi, shock, precursor, independent)
+
+    # Same statement for every abundance, density, velocity window and model type
+    statement = model_query_statement(xquan, yquan, xnum, xden, ynum, yden)
+    params = dict(abundance=abundance, ref=ref, preshck_dens=float(preshck_dens),
+                  shck_vel_lo=float(shck_vel_lo), shck_vel_hi=float(shck_vel_hi))
+
+    # Run two SQL queries for independent plottng of shock and precursor
+    results = [run_query('send_3mdbs_query', statement, dict(params, model_type=model_type))
+               for model_type in model_type_filter(shock, precursor, independent)]
+    if independent:
+        return results
+    return results[0]
+
+@lru_cache(maxsize=128)
+def grid_query_statement(columns, filter_abundances, filter_densities):
+    '''Parameterised send_3mdbs_grid_query statement; IN (...) lists expand at execution.'''
+    ratio_columns = ',\n                    '.join(columns)
+
+    # Optional restrictions of the parameter space
+    filters = ''
+    params = [bindparam('refs', expanding=True)]
+    if filter_abundances:
+        filters += "\n                    AND abundances.name IN :abundances"
+        params.append(bindparam('abundances', expanding=True))
+    if filter_densities:
+        filters += "\n                    AND shock_params.preshck_dens IN :densities"
+        params.append(bindparam('densities', expanding=True))
+
+    return text(f"""SELECT
+                    shock_params.ref AS ref,
+                    abundances.name AS abundance,
+                    shock_params.preshck_dens AS preshck_dens,
+                    shock_params.mag_fld AS mag_fld,
                     shock_params.shck_vel AS shck_vel,
-                    {format_line_ratio_as_sql_query(xnum, xden)},
-                    {format_line_ratio_as_sql_query(ynum, yden)},
-                    {format_quantity_as_sql_query(xquan)},
-                    {format_quantity_as_sql_query(yquan)},
-                    shock_params.mag_fld AS mag_fld
+                    {ratio_columns}
                 FROM shock_params
                     INNER JOIN emis_IR ON emis_IR.ModelID=shock_params.ModelID
                     INNER JOIN emis_VI ON emis_VI.ModelID=shock_params.ModelID
                     INNER JOIN abundances ON abundances.AbundID=shock_params.AbundID
-                WHERE emis_VI.model_type='{model_type}' AND emis_IR.model_type='{model_type}'
-                    AND abundances.name='{abundance}'
-                    AND shock_params.ref='Allen08'
-                    AND shock_params.shck_vel BETWEEN {shck_vel_lo} AND {shck_vel_hi}
-                    AND shock_params.preshck_dens={preshck_dens}
-                ORDER BY shck_vel;"""
-
-        # Run query
-        with engine.connect() as conn:
-            result = pd.read_sql(sel, con=conn)
-            return result
-
-def populate_abundance_dropdown():
-
-    # Set environment variables
-    host   = os.environ['MdB_HOST']
-    user   = os.environ['MdB_USER']
-    passwd = os.environ['MdB_PASSWD']
-    port   = os.environ['MdB_PORT']
-    dbname = "3MdBs"
-    engine = create_engine(f"mysql+pymysql://{user}:{passwd}@{host}:{port}/{dbname}")
-
-    # Define SQL query
-    sel_abundance_query = """
-        SELECT DISTINCT a.name
-        FROM shock_params AS sp
-        JOIN abundances  AS a ON a.AbundID = sp.AbundID
-        WHERE sp.ref = 'Allen08'
-        ORDER BY a.name;
+                WHERE emis_VI.model_type=:model_type AND emis_IR.model_type=:model_type
+                    AND shock_params.ref IN :refs
+                    AND shock_params.shck_vel BETWEEN :shck_vel_lo AND :shck_vel_hi{filters}
+                ORDER BY ref, abundance, preshck_dens, mag_fld, shck_vel""").bindparams(*params)
+
+def send_3mdbs_grid_query(line_ratios, model_type='shock', abundances=None, densities=None, shck_vel_lo=100, shck_vel_hi=1000, quantities=(), refs=('Allen08',)):
     """
+    Fetch many line ratios over the full abundance x density x B x velocity grid.
+
+    Parameters:
+    - line_ratios: list of (num, den) pairs of names from the line catalog (return_lines())
+    - model_type: 'shock', 'precursor' or 'shock_plus_precursor'
+    - abundances, densities: optional lists restricting the grid (default: all)
+    - shck_vel_lo, shck_vel_hi: shock velocity window
+    - quantities: optional quantity names (return_quantities()) to select as well
+    - refs: model references (shock_params.ref) to include
+
+    Returns one row per model with columns ref, abundance, preshck_dens,
+    mag_fld, shck_vel, one <num>_<den> column per ratio and one column per
+    quantity.
+    """
+    columns = [format_line_ratio_as_sql_query(num, den) for num, den in line_ratios]
+    columns += [format_quantity_as_sql_query(quantity) for quantity in quantities]
+    statement = grid_query_statement(tuple(columns), abundances is not None, densities is not None)
 
-    # Perform query
-    with engine.connect() as conn:
-        result = pd.read_sql(sel_abundance_query, con=conn)
-        abundances = list(result.get('name'))
+    params = dict(model_type=model_type, refs=list(refs), shck_vel_lo=float(shck_vel_lo), shck_vel_hi=float(shck_vel_hi))
+    if abundances is not None:
+        params['abundances'] = list(abundances)
+    if densities is not None:
+        params['densities'] = [float(d) for d in densities]
 
-    return abundances
+    # Run query
+    return run_query('send_3mdbs_grid_query', statement, params, n_ratios=len(line_ratios))
 
-def populate_density_dropdown(abundance):
+REF_QUERY = text("""
+        SELECT DISTINCT sp.ref
+        FROM shock_params AS sp
+        ORDER BY sp.ref""")
 
-    # Set environment variables
-    host   = os.environ['MdB_HOST']
-    user   = os.environ['MdB_USER']
-    passwd = os.environ['MdB_PASSWD']
-    port   = os.environ['MdB_PORT']
-    dbname = "3MdBs"
-    engine = create_engine(f"mysql+pymysql://{user}:{passwd}@{host}:{port}/{dbname}")
+ABUNDANCE_QUERY = text("""
+        SELECT DISTINCT a.name
+        FROM shock_params AS sp
+        JOIN abundances  AS a ON a.AbundID = sp.AbundID
+        WHERE sp.ref = :ref
+        ORDER BY a.name""")
 
-    # Define SQL query
-    sel_density_query = f"""
+DENSITY_QUERY = text("""
         SELECT DISTINCT sp.preshck_dens
         FROM shock_params AS sp
         JOIN abundances AS a ON a.AbundID = sp.AbundID
-        WHERE sp.ref = 'Allen08'
-        AND a.name = '{abundance}'
-        ORDER BY sp.preshck_dens;
-    """
+        WHERE sp.ref = :ref
+        AND a.name = :abundance
+        ORDER BY sp.preshck_dens""")
+
+def populate_ref_dropdown():
+
+    # Every model reference (publication) with shock models
+    result = run_query('populate_ref_dropdown', REF_QUERY)
+    refs = list(result.get('ref'))
+
+    return refs
+
+def populate_abundance_dropdown(ref='Allen08'):
 
     # Perform query
-    with engine.connect() as conn:
-        result = pd.read_sql(sel_density_query, con=conn)
-        densities = list(result.get('preshck_dens'))
+    result = run_query('populate_abundance_dropdown', ABUNDANCE_QUERY, dict(ref=ref))
+    abundances = list(result.get('name'))
+
+    return abundances
+
+def populate_density_dropdown(abundance, ref='Allen08'):
+
+    # Perform query
+    result = run_query('populate_density_dropdown', DENSITY_QUERY, dict(ref=ref, abundance=abundance))
+    densities = list(result.get('preshck_dens'))
 
     return densities
 
 def return_lines():
 
-    # All lines currently able to be calculated using SQL queries
-    lines = {
-        'Ha': 'emis_VI.HI_6563',
-        'Hb': 'emis_VI.HI_4861',
-        'OIII_5007': 'emis_VI.OIII_5007',
-        'NII': 'emis_VI.NII_6548 + emis_VI.NII_6583',
-        'SII': 'emis_VI.SII_6716 + emis_VI.SII_6731'
-    }
-
-    return lines
+    # All lines currently able to be calculated using SQL queries (see data_io.line_catalog)
+    return dict(LINE_SQL)
 
 def return_quantities():
     
-    # All quantities currently able to be calculated using SQL queries
-    quantities = {
-        'O23': '(emis_VI.OII_7320 + emis_VI.OII_7320) / emis_VI.OIII_5007',
-        'S23': '(emis_VI.SII_6716 + emis_VI.SII_6731 + emis_IR.SIII_9069) / emis_VI.HI_4861',
-        'OIII_Hb': 'emis_VI.OIII_5007 / emis_VI.HI_4861',
-        'NII_Ha': 'emis_VI.NII_6583 / emis_VI.HI_6563',
-        'SII_Ha': '(emis_VI.SII_6716 + emis_VI.SII_6731) / emis_VI.HI_6563'
-        }
-    
-    return quantities
\ No newline at end of file
+    # All quantities currently able to be calculated using SQL queries (see data_io.line_catalog)
+    return dict(QUANTITY_SQL)
\ No newline at end of file
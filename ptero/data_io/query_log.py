@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Slow-query log for the 3MdBs layer. Every statement run through
+# query_3mdbs_tools.run_query is timed and counted; those slower than the
+# threshold are kept (with their bound parameters and, optionally, the
+# database's EXPLAIN plan) so it is clear which joins need an index.
+#
+#   QUERY_LOG.configure(threshold_ms=0, explain=True)
+#   ... plot ...
+#   print(QUERY_LOG.format_table())
+#
+# PTERO_SLOW_QUERY_MS sets the threshold, PTERO_EXPLAIN=1 turns on plans and
+# PTERO_QUERY_LOG=<path> appends slow entries to a JSON lines file.
+
+class QueryRecord:
+    """One executed statement: wall time in seconds, returned rows, plan rows (or None)."""
+    def __init__(self, name, shape, params, wall, rows, plan=None):
+        self.name = name
+        self.shape = shape
+        self.params = params
+        self.wall = wall
+        self.rows = rows
+        self.plan = plan
+        self.time = time.time()
+
+    def as_dict(self):
+        return dict(name=self.name, shape=self.shape, shape_id=shape_digest(self.shape), params=self.params,
+                    wall=self.wall, rows=self.rows, plan=self.plan, time=self.time)
+
+class QueryLog:
+    """
+    Per-statement timings plus a bounded log of the slow ones.
+
+    stats holds (count, total wall, total rows) per statement shape, for
+    every query, and names the run_query name of each shape; slow only the
+    last maxlen queries over threshold_ms.
+    """
+    def __init__(self, threshold_ms=500, explain=False, file_path=None, maxlen=200):
+        self.threshold_ms = threshold_ms
+        self.explain = explain
+        self.file_path = file_path
+        self.slow = deque(maxlen=maxlen)
+        self.stats = {}
+        self.names = {}
+        self._lock = threading.Lock()
+
+    def configure(self, threshold_ms=None, explain=None, file_path=None):
+        if threshold_ms is not None:
+            self.threshold_ms = threshold_ms
+        if explain is not None:
+            self.explain = explain
+        if file_path is not None:
+            self.file_path = file_path
+
+    def is_slow(self, wall):
+        return wall * 1e3 >= self.threshold_ms
+
+    def record(self, record):
+        with self._lock:
+            count, total, rows = self.stats.get(record.shape, (0, 0.0, 0))
+            self.stats[record.shape] = (count + 1, total + record.wall, rows + record.rows)
+            self.names[record.shape] = record.name
+            if not self.is_slow(record.wall):
+                return
+            self.slow.append(record)
+            if self.file_path:
+                with open(self.file_path, 'a') as f:
+                    f.write(json.dumps(record.as_dict(), default=str) + '\n')
+
+    def clear(self):
+        with self._lock:
+            self.slow.clear()
+            self.stats.clear()
+            self.names.clear()
+
+    def format_table(self):
+        '''Plain-text summary per statement shape, slowest total first.'''
+        with self._lock:
+            stats = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)
+            names = dict(self.names)
+        lines = [f"{'statement':<48} {'calls':>6} {'total ms':>10} {'mean ms':>9} {'rows':>9}"]
+        for shape, (count, total, rows) in stats:
+            label = shape_label(names.get(shape, ''), shape)
+            lines.append(f'{label[:48]:<48} {count:6d} {total * 1e3:10.1f} {total * 1e3 / count:9.1f} {rows:9d}')
+        return '\n'.join(lines)
+
+def shape_digest(shape):
+    '''Short hex digest of a statement shape (the shape_id of slow-log entries).'''
+    return hashlib.blake2b(shape.encode(), digest_size=4).hexdigest()
+
+def shape_label(name, shape):
+    '''Row label of a statement shape: its run_query name and shape_digest.'''
+    # Statements of one query function share a long common prefix, so a
+    # truncated shape would not tell them apart
+    return f'{name} #{shape_digest(shape)}'
+
+QUERY_LOG = QueryLog(threshold_ms=float(os.environ.get('PTERO_SLOW_QUERY_MS', 500)),
+                     explain=os.environ.get('PTERO_EXPLAIN') == '1',
+                     file_path=os.environ.get('PTERO_QUERY_LOG'))
@@ -0,0 +1,103 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import CancelledError
+
+# Custom function declarations
+from data_io.query_3mdbs_tools import send_3mdbs_query
+
+class ResultCache:
+    """
+    Thread-safe LRU cache of query results, keyed by the query arguments.
+
+    Cached DataFrames are shared between callers, so treat them as read-only
+    (process_df already works on a copy). Values can also be computed ahead of
+    time on an executor with prefetch(); a get_or_compute() for a key that is
+    still being prefetched waits for that result instead of computing it twice.
+    """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_compute(self, key, func):
+        '''Return the cached value for key, calling func() and caching its result on a miss.'''
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            future = self._pending.get(key)
+        # A prefetch still queued is dropped and computed here; one already
+        # running is waited for (falling through if it fails)
+        if future is not None and not future.cancel():
+            try:
+                return future.result()
+            except (CancelledError, Exception):
+                pass
+        value = func()
+        self.put(key, value)
+        return value
+
+    def prefetch(self, key, func, executor):
+        """
+        Compute func() on executor and cache the result, unless key is already
+        cached or pending. Returns the Future, or None if nothing was submitted.
+        """
+        with self._lock:
+            if key in self._data or key in self._pending:
+                return None
+
+            def compute():
+                value = func()
+                self.put(key, value)
+                return value
+
+            future = executor.submit(compute)
+            self._pending[key] = future
+        future.add_done_callback(lambda f: self._forget(key, f))
+        return future
+
+    def is_pending(self, key):
+        with self._lock:
+            return key in self._pending
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+QUERY_CACHE = ResultCache()
+
+def query_key(*args):
+    '''QUERY_CACHE key of a send_3mdbs_query call.'''
+    return ('send_3mdbs_query',) + args
+
+def cached_send_3mdbs_query(*args):
+    '''send_3mdbs_query with results kept in QUERY_CACHE (same positional arguments).'''
+    return QUERY_CACHE.get_or_compute(query_key(*args), lambda: send_3mdbs_query(*args))
@@ -0,0 +1,255 @@
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import stat
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Node-local cache of 3MdBs results shared by every PTERO process (GUI
+# sessions, batch scripts) on one machine. Results are pickled into one
+# SQLite file in WAL mode, so any process can read what another already
+# fetched. A miss takes an flock on a lock stripe for its key before
+# querying: concurrent identical requests, from other processes or other
+# threads, wait for the first one and then read its result, so the database
+# sees each distinct query once however many users ask for it.
+#
+# Enable it by pointing PTERO_SHARED_CACHE at a file on a local disk (not
+# NFS; SQLite locking needs a local filesystem), in a directory writable by
+# everyone who should share it:
+#
+#   export PTERO_SHARED_CACHE=/scratch/ptero/3mdbs_cache.sqlite
+#
+# PTERO_SHARED_CACHE_MB caps its size (default 2048), PTERO_SHARED_CACHE_TTL
+# expires entries after that many seconds (default: never; the model
+# database is read-only). Values are unpickled on read, so only share the
+# file between users who trust each other.
+#
+# The cache file, its lock files and directories are made group-writable
+# whatever the umask (SQLite gives the -wal/-shm files the cache file's
+# mode), so the directory should belong to the sharing group and be setgid:
+#
+#   mkdir -p /scratch/ptero && chgrp astro /scratch/ptero && chmod 2770 /scratch/ptero
+#
+# PTERO_SHARED_CACHE_MODE widens that, e.g. 666 to share with every user.
+# When the cache cannot be used it is bypassed, with a warning logged once.
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL)"""
+
+def key_digest(key):
+    '''Stable hex digest of a cache key (a tuple of plain values).'''
+    return hashlib.blake2b(repr(key).encode(), digest_size=20).hexdigest()
+
+class SharedCache:
+    """
+    Cross-process result cache in an SQLite file, with single-flight misses.
+
+    Parameters:
+    - file_path: SQLite file (created with its directory if missing)
+    - max_bytes: total pickled size kept; least recently read entries go first
+    - ttl: seconds after which an entry is refetched (None: never)
+    - stripes: number of lock files keys are spread over
+    - wait: seconds to wait for another process's fetch before querying anyway
+    - mode: permission bits every user of the cache needs on its files
+
+    Any failure of the cache itself (locked or unreadable file, full disk)
+    falls back to calling func() directly; the cache never fails a query.
+    Read times for eviction are written in batches, so hits do not contend
+    for SQLite's write lock.
+    """
+    def __init__(self, file_path, max_bytes=2048 * 2**20, ttl=None, stripes=64, wait=600, mode=0o660):
+        self.file_path = os.path.abspath(file_path)
+        self.lock_dir = self.file_path + '.locks'
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stripes = stripes
+        self.wait = wait
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self._local = threading.local()
+        self._touched = {}
+        self._touched_lock = threading.Lock()
+        self._flushed = time.monotonic()
+        self._warned = set()
+        for directory in [os.path.dirname(self.file_path), self.lock_dir]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+                self._share(directory)
+        self._connect().execute(SCHEMA)
+        self._share(self.file_path)
+
+    def _share(self, path):
+        # New files and directories get the process umask (often 0022), which
+        # would lock every other user out; only the owner may widen them
+        try:
+            current = stat.S_IMODE(os.stat(path).st_mode)
+            wanted = current | self.mode
+            if os.path.isdir(path):
+                # Directories need x wherever r is granted, and setgid to pass the group on
+                wanted |= ((self.mode & 0o444) >> 2) | stat.S_ISGID
+            if wanted != current:
+                os.chmod(path, wanted)
+        except OSError:
+            pass
+
+    def _warn(self, what, error):
+        # Once per kind of failure, not on every query
+        if what not in self._warned:
+            self._warned.add(what)
+            log.warning('Shared cache %s: %s failed (%s); querying 3MdBs directly', self.file_path, what, error)
+
+    def _connect(self):
+        # sqlite3 connections may not cross threads or a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.file_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key, default=None):
+        digest = key_digest(key)
+        try:
+            conn = self._connect()
+            row = conn.execute('SELECT value, created FROM results WHERE key=?', (digest,)).fetchone()
+            if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+                return default
+            self._touch(conn, digest)
+            return pickle.loads(row[0])
+        except (sqlite3.Error, pickle.UnpicklingError, EOFError) as e:
+            self._warn('read', e)
+            return default
+
+    def _touch(self, conn, digest, flush_every=64, flush_seconds=30):
+        # Eviction only needs a rough read order, so record reads here and
+        # write them in one transaction now and then
+        with self._touched_lock:
+            self._touched[digest] = time.time()
+            if len(self._touched) < flush_every and time.monotonic() - self._flushed < flush_seconds:
+                return
+        self._flush_touched(conn)
+
+    def _flush_touched(self, conn):
+        with self._touched_lock:
+            touched, self._touched = self._touched, {}
+            self._flushed = time.monotonic()
+        if touched:
+            conn.executemany('UPDATE results SET accessed=? WHERE key=?', [(t, d) for d, t in touched.items()])
+
+    def put(self, key, value):
+        try:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(blob) > self.max_bytes:
+                return
+            now = time.time()
+            conn = self._connect()
+            conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                         (key_digest(key), sqlite3.Binary(blob), len(blob), now, now))
+            self._flush_touched(conn)
+            self._evict(conn)
+        except (sqlite3.Error, pickle.PicklingError) as e:
+            self._warn('write', e)
+
+    def _evict(self, conn):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Oldest reads first until the rest fits
+        doomed = []
+        for digest, size in conn.execute('SELECT key, size FROM results ORDER BY accessed'):
+            if total <= self.max_bytes:
+                break
+            doomed.append((digest,))
+            total -= size
+        conn.executemany('DELETE FROM results WHERE key=?', doomed)
+
+    def _lock_file(self, key):
+        stripe = int(key_digest(key)[:8], 16) % self.stripes
+        return os.path.join(self.lock_dir, f'{stripe:03d}.lock')
+
+    def _acquire(self, key):
+        # flock locks belong to the open file, so threads of one process
+        # exclude each other as well as other processes
+        if fcntl is None:
+            return None, False
+        lock_file = self._lock_file(key)
+        f = open(lock_file, 'a')
+        self._share(lock_file)
+        deadline = time.monotonic() + self.wait
+        waited = False
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f, waited
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    f.close()
+                    return None, waited
+                waited = True
+                time.sleep(0.05)
+
+    def get_or_compute(self, key, func):
+        '''Return the shared value for key, or call func() once per node and share its result.'''
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            self.hits += 1
+            return value
+
+        try:
+            lock, waited = self._acquire(key)
+        except OSError as e:
+            self._warn('locking', e)
+            lock, waited = None, False
+        try:
+            # Whoever held the lock may just have fetched it
+            value = self.get(key, missing)
+            if value is not missing:
+                self.waits += waited
+                self.hits += not waited
+                return value
+            self.misses += 1
+            value = func()
+            self.put(key, value)
+            return value
+        finally:
+            if lock is not None:
+                lock.close()
+
+    def clear(self):
+        try:
+            self._connect().execute('DELETE FROM results')
+        except sqlite3.Error as e:
+            self._warn('clear', e)
+
+def shared_cache_from_env():
+    '''SharedCache configured from PTERO_SHARED_CACHE*, or None if it is not set.'''
+    file_path = os.environ.get('PTERO_SHARED_CACHE')
+    if not file_path:
+        return None
+    ttl = os.environ.get('PTERO_SHARED_CACHE_TTL')
+    try:
+        return SharedCache(file_path, max_bytes=int(float(os.environ.get('PTERO_SHARED_CACHE_MB', 2048)) * 2**20),
+                           ttl=float(ttl) if ttl else None, mode=int(os.environ.get('PTERO_SHARED_CACHE_MODE', '660'), 8))
+    except (OSError, sqlite3.Error) as e:
+        log.warning('Shared cache %s could not be opened (%s); it is disabled', file_path, e)
+        return None
+
+SHARED_CACHE = shared_cache_from_env()
@@ -1,6 +1,11 @@
 import matplotlib.pyplot as plt
 import re
+from functools import lru_cache
 
+# Custom function declarations
+from data_io.line_catalog import LINES_BY_NAME, resolve
+
+@lru_cache(maxsize=None)
 def roman_to_int(r):
     mapping = {'I': 1, 'V': 5, 'X': 10, 'L': 50, 'C': 100, 'D': 500, 'M': 1000}
     total, prev = 0, 0
@@ -10,7 +15,13 @@ def roman_to_int(r):
         prev = val
     return total
 
+@lru_cache(maxsize=None)
 def sort_key(line):
+    # Catalog lines sort by their known species, ionisation state and wavelength
+    entry = LINES_BY_NAME.get(resolve(line))
+    if entry is not None:
+        return entry.sort_key
+
     # Remove leading/trailing square brackets.
     trimmed = line.strip("[]")
     
@@ -23,4 +34,4 @@ def sort_key(line):
     if m:
         element, numeral, rest = m.groups()
         return (element.upper(), roman_to_int(numeral) if numeral else 0, rest)
-    return (trimmed, 0, "")
\ No newline at end of file
+    return (trimmed, 0, "")
@@ -0,0 +1,214 @@
+import numpy as np
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
+from mpl_toolkits.mplot3d.art3d import Line3DCollection, Poly3DCollection
+
+# Custom function declarations
+from profiling import span
+
+# The diagnostic in three dimensions: log x ratio, log y ratio and velocity.
+# Model grids become surfaces over (B, shock velocity), with shock velocity
+# as height, and observed pixels sit at their velocity dispersion. Rendering
+# is matplotlib's mplot3d (CPU only, any backend). Every rotation redraws all
+# artists, so the geometry is built once per grid and per point set (kept on
+# the ModelGrid and FitsPoints objects) and dense clouds are thinned first:
+# either a random subset, or one marker per occupied voxel sized by its count.
+
+POINT_MODES = ['auto', 'all', 'decimate', 'voxels']
+
+class SurfaceGeometry:
+    """
+    One model surface: quads (n, 4, 3) in (log x, log y, velocity), their mean
+    velocity (n,) for colouring, and the constant-B curves as (m, 3) arrays.
+    """
+    def __init__(self, quads, quad_vel, curves):
+        self.quads = quads
+        self.quad_vel = quad_vel
+        self.curves = curves
+
+def _log10(values):
+    values = np.asarray(values, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(values > 0, np.log10(values), np.nan)
+
+def surface_geometry(data_grouped, x_id, y_id):
+    '''SurfaceGeometry of the curves of one model type (one DataFrame per B).'''
+    if not data_grouped:
+        return None
+    data_grouped = sorted(data_grouped, key=lambda data: data['mag_fld'].iloc[0])
+    vels = np.unique(np.concatenate([data.iloc[:, 0].to_numpy(dtype=float) for data in data_grouped]))
+    grid = np.full((len(data_grouped), len(vels), 3), np.nan)
+    for i, data in enumerate(data_grouped):
+        cols = np.searchsorted(vels, data.iloc[:, 0].to_numpy(dtype=float))
+        grid[i, cols, 0] = _log10(data.iloc[:, x_id])
+        grid[i, cols, 1] = _log10(data.iloc[:, y_id])
+        grid[i, cols, 2] = vels[cols]
+
+    # Quads between neighbouring B curves and velocities, where all corners exist
+    quads = np.stack([grid[:-1, :-1], grid[:-1, 1:], grid[1:, 1:], grid[1:, :-1]], axis=2).reshape(-1, 4, 3)
+    quads = quads[np.all(np.isfinite(quads), axis=(1, 2))]
+    curves = [line[np.all(np.isfinite(line), axis=1)] for line in grid]
+    return SurfaceGeometry(quads, quads[:, :, 2].mean(axis=1), [c for c in curves if len(c) > 1])
+
+def model_surfaces(grid):
+    """
+    SurfaceGeometry per model type of a ModelGrid ('model', or 'shock' and
+    'precursor' for independent grids), cached on the grid.
+    """
+    if '_surfaces' in grid.__dict__:
+        return grid._surfaces
+    x_id, y_id = grid.xy_columns()
+    groups = {'shock': grid.shock_data_grouped, 'precursor': grid.precursor_data_grouped} \
+        if grid.selection.independent else {'model': grid.model_data_grouped}
+    with span('model_surfaces'):
+        surfaces = {name: surface_geometry(data_grouped, x_id, y_id) for name, data_grouped in groups.items()}
+    grid._surfaces = {name: s for name, s in surfaces.items() if s is not None}
+    return grid._surfaces
+
+class PointCloud3D:
+    """
+    Observed pixels ready to draw: xyz (n, 3) in (log x, log y, sigma) and
+    counts (n,) of pixels behind each marker (all ones unless voxelised).
+    n_pixels is the number of usable pixels before thinning.
+    """
+    def __init__(self, xyz, counts, n_pixels, mode):
+        self.xyz = xyz
+        self.counts = counts
+        self.n_pixels = n_pixels
+        self.mode = mode
+
+def decimate(n, max_points, seed=0):
+    '''Sorted random subset of max_points of range(n) (everything if n is smaller).'''
+    if n <= max_points:
+        return np.arange(n)
+    return np.sort(np.random.default_rng(seed).choice(n, max_points, replace=False))
+
+def voxel_aggregate(columns, bins=64, max_voxels=None):
+    """
+    Merge points into a bins^3 grid over their bounding box.
+
+    Parameters:
+    - columns: the x, y, z coordinates as three 1D arrays
+    - bins: voxels per axis
+    - max_voxels: halve bins until at most this many voxels are occupied
+
+    Returns the mean position (n, 3) of the points in every occupied voxel
+    and their count. Integer binning plus bincount over the bins^3 cells, so
+    it stays linear in the number of points (no sort); coarser grids reuse
+    the fine cell indices.
+    """
+    cells = []
+    for values in columns:
+        lo, hi = values.min(), values.max()
+        scale = bins / (hi - lo) if hi > lo else 0.0
+        index = ((values - lo) * scale).astype(np.int64)
+        cells.append(np.clip(index, 0, bins - 1, out=index))
+
+    factor = 1
+    while True:
+        # Round up: with bins not a power of two, index // factor reaches bins // factor
+        n_bins = -(-bins // factor)
+        flat = np.zeros(len(cells[0]), dtype=np.int64)
+        for index in cells:
+            flat *= n_bins
+            flat += index // factor
+        counts = np.bincount(flat, minlength=n_bins**3)
+        occupied = np.flatnonzero(counts)
+        if max_voxels is None or len(occupied) <= max_voxels or n_bins <= 4:
+            break
+        factor *= 2
+    sums = np.column_stack([np.bincount(flat, values, minlength=n_bins**3)[occupied] for values in columns])
+    return sums / counts[occupied, None], counts[occupied]
+
+def point_cloud(points, mode='auto', max_points=50000, bins=64, seed=0):
+    """
+    PointCloud3D of unmasked FitsPoints, cached on the points object.
+
+    Parameters:
+    - points: FitsPoints (x and y ratios, z velocity dispersion)
+    - mode: 'all', 'decimate' (random max_points), 'voxels' (bins^3 voxel
+      means, coarsened until at most max_points voxels are occupied), or
+      'auto': all if they fit in max_points, decimated up to ten times that,
+      voxels beyond
+    - max_points, bins, seed: thinning parameters
+    """
+    if mode not in POINT_MODES:
+        raise ValueError(f'<mode> must be one of {POINT_MODES}. You entered {mode}')
+    memo = points.__dict__.setdefault('_clouds', {})
+    key = (mode, max_points, bins, seed)
+    if key in memo:
+        return memo[key]
+
+    with span('point_cloud', n_points=len(points.x), mode=mode):
+        # Separate contiguous columns: reductions over an (n, 3) array's
+        # first axis are several times slower at millions of rows
+        columns = [_log10(points.x), _log10(points.y), np.asarray(points.z, dtype=float)]
+        keep = ~points.mask & np.isfinite(columns[0]) & np.isfinite(columns[1]) & np.isfinite(columns[2])
+        columns = [values[keep] for values in columns]
+        n = len(columns[0])
+        if mode == 'auto':
+            mode = 'all' if n <= max_points else 'decimate' if n <= 10 * max_points else 'voxels'
+
+        if mode == 'voxels' and n:
+            cloud_xyz, counts = voxel_aggregate(columns, bins, max_points)
+        else:
+            if mode == 'decimate':
+                columns = [values[decimate(n, max_points, seed)] for values in columns]
+            cloud_xyz, counts = np.column_stack(columns), np.ones(len(columns[0]), dtype=np.int64)
+    memo[key] = PointCloud3D(cloud_xyz, counts, n, mode)
+    return memo[key]
+
+def draw_surfaces(ax, grid, cmap='viridis', link_color='gray', alpha=0.35):
+    '''Draw the model surfaces of a ModelGrid on 3D Axes, coloured by shock velocity.'''
+    sel = grid.selection
+    norm = Normalize(sel.vmin, sel.vmax)
+    collection = None
+    for name, surface in model_surfaces(grid).items():
+        collection = Poly3DCollection(surface.quads, cmap=cmap, norm=norm, alpha=alpha, linewidths=0)
+        collection.set_array(surface.quad_vel)
+        ax.add_collection3d(collection)
+        # Constant-B edges, with dashes telling the precursor apart
+        ax.add_collection3d(Line3DCollection(surface.curves, colors=link_color, linewidths=0.8,
+                                             linestyles='--' if name == 'precursor' else '-'))
+    return collection
+
+def draw_cloud(ax, cloud, vmin, vmax, cmap='viridis', size=4):
+    '''Scatter a PointCloud3D coloured by sigma; voxel markers grow with their pixel count.'''
+    if not len(cloud.xyz):
+        return None
+    sizes = size * (1 + np.log10(cloud.counts)) if cloud.mode == 'voxels' else size
+    return ax.scatter(cloud.xyz[:, 0], cloud.xyz[:, 1], cloud.xyz[:, 2], c=cloud.xyz[:, 2], cmap=cmap,
+                      vmin=vmin, vmax=vmax, s=sizes, marker='.', alpha=0.5, depthshade=False, linewidths=0)
+
+def render_3d(fig, ax, grid, cloud=None):
+    """
+    Draw model surfaces and an optional PointCloud3D onto 3D Axes.
+
+    Returns the velocity colorbar so callers can remove it before the next redraw.
+    """
+    sel = grid.selection
+    with span('draw_surfaces'):
+        draw_surfaces(ax, grid)
+    if cloud is not None:
+        with span('draw_cloud', n_markers=len(cloud.xyz)):
+            draw_cloud(ax, cloud, sel.vmin, sel.vmax)
+
+    # add_collection3d does not autoscale, so fit the limits to everything drawn
+    parts = [s.quads.reshape(-1, 3) for s in model_surfaces(grid).values()]
+    if cloud is not None:
+        parts.append(cloud.xyz)
+    everything = np.concatenate(parts) if parts else np.zeros((0, 3))
+    if len(everything):
+        lo, hi = everything.min(axis=0), everything.max(axis=0)
+        pad = np.where(hi > lo, 0.05 * (hi - lo), 0.5)
+        ax.set_xlim(lo[0] - pad[0], hi[0] + pad[0])
+        ax.set_ylim(lo[1] - pad[1], hi[1] + pad[1])
+        ax.set_zlim(lo[2] - pad[2], hi[2] + pad[2])
+
+    ax.set_xlabel(f'log$_{{10}}$ {grid.x_lab}')
+    ax.set_ylabel(f'log$_{{10}}$ {grid.y_lab}')
+    ax.set_zlabel('Velocity / km s$^{-1}$')
+    # Opaque scale, not the translucent surfaces
+    cbar = fig.colorbar(ScalarMappable(Normalize(sel.vmin, sel.vmax), 'viridis'), ax=ax, shrink=0.7)
+    cbar.set_label('Shock velocity / km s$^{-1}$', size=12)
+    return cbar
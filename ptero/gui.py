@@ -2,15 +2,35 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qtagg import NavigationToolbar2QT
-from PyQt6.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QLabel, QComboBox, QHBoxLayout, QPushButton, QMessageBox, QFileDialog, QSpinBox, QCheckBox
-from PyQt6.QtGui import QPixmap
+from matplotlib.figure import Figure
+from PyQt6.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QLabel, QComboBox, QHBoxLayout, QPushButton, QMessageBox, QFileDialog, QSpinBox, QCheckBox, QPlainTextEdit, QInputDialog, QLineEdit
+from PyQt6.QtGui import QPixmap, QFontDatabase
+from PyQt6.QtCore import QTimer
 import os
+import re
+import tempfile
 from functools import partial
 
 # Custom function declarations
-from data_io.handle_fits_data import load_fits_data, load_fits_mask
-from data_io.query_3mdbs_tools import send_3mdbs_query, populate_abundance_dropdown, populate_density_dropdown, return_lines, return_quantities
-from plotter import draw_model_curves, draw_fits_points, finalize_plot
+from data_io.handle_fits_data import load_fits_mask, load_line_maps
+from data_io.masks import MaskStore, sn_threshold_mask
+from data_io.mosaic_store import MosaicStore
+from data_io.extract_cube import extract_line_maps, write_line_maps
+from data_io.query_3mdbs_tools import populate_abundance_dropdown, populate_density_dropdown, populate_ref_dropdown
+from data_io.query_log import QUERY_LOG
+from data_io.line_catalog import line_names, quantity_names
+from pipeline import DiagramSelection, load_fits_points
+from reactive import build_diagram_pipeline, selection_params, DiagramCanvas, StageError
+from prefetch import GridPrefetcher
+from dashboard import STANDARD_PANELS, panel_selections, fetch_dashboard_grids, evaluate_panel_points, render_dashboard
+from overlay import fetch_overlay_grids, render_overlay
+from diagram3d import point_cloud, render_3d
+from analysis.consistency import score_consistency
+from analysis.inference import write_inference_maps
+from analysis.binning import bin_pixel_points
+from brushing import PixelIndex, LinkedBrush
+from inspector import PointInspector, format_inspection
+from profiling import PROFILER, span
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -30,10 +50,19 @@ class MainWindow(QMainWindow):
         self.fig, self.ax = plt.subplots(figsize=(6, 6))
         plt.subplots_adjust(left=0.25, bottom=0.15, right=0.75, top=0.85)
         self.canvas = FigureCanvas(self.fig)
-        main_layout.addWidget(self.canvas)
+        canvas_layout = QHBoxLayout()
+        canvas_layout.addWidget(self.canvas)
+        main_layout.addLayout(canvas_layout)
         self.ax.clear()
         plt.axis('off')
 
+        # Spatial map of the FITS pixels, linked to the diagram by brushing
+        self.map_fig = Figure(figsize=(5, 5))
+        self.map_canvas = FigureCanvas(self.map_fig)
+        self.map_ax = self.map_fig.add_subplot()
+        self.map_canvas.setVisible(False)
+        canvas_layout.addWidget(self.map_canvas)
+
         # Add the Navigation Toolbar.
         self.toolbar = NavigationToolbar2QT(self.canvas, self)
         main_layout.addWidget(self.toolbar)
@@ -84,6 +113,13 @@ class MainWindow(QMainWindow):
         self.step_box.valueChanged.connect(partial(self.enforce_spinbox_constraints, self.step_box))
         layout1.addWidget(self.step_box)
 
+        # Model curves at native velocities, or interpolated in log space onto any step
+        layout1.addWidget(QLabel('Curves:'))
+        self.curve_combo = QComboBox()
+        self.curve_combo.addItems(['Nodes', 'Linear', 'Spline'])
+        self.curve_combo.currentIndexChanged.connect(self.on_curve_mode_changed)
+        layout1.addWidget(self.curve_combo)
+
         # Create check boxes for using shock/precursor or both
         layout1.addWidget(QLabel('Shock?'))
         self.check_shock = QCheckBox()
@@ -166,15 +202,144 @@ class MainWindow(QMainWindow):
         self.upload_mask_button.clicked.connect(self.on_mask_upload_clicked)
         layout3.addWidget(self.upload_mask_button)
 
+        # Mosaics: each added field is appended to an on-disk pixel store
+        self.add_field_button = QPushButton('Add Field', self)
+        self.add_field_button.clicked.connect(self.on_add_field_clicked)
+        layout3.addWidget(self.add_field_button)
+        self.field_combo = QComboBox()
+        self.field_combo.addItem('All Fields')
+        self.field_combo.currentIndexChanged.connect(self.select_fields)
+        layout3.addWidget(self.field_combo)
+        layout3.addWidget(QLabel('Colour by Field?'))
+        self.check_field_colour = QCheckBox()
+        layout3.addWidget(self.check_field_colour)
+        self.mosaic = None
+
+        # Masks are combined by expression (default: any mask flags a pixel as bad)
+        layout2.addWidget(QLabel('Mask:'))
+        self.mask_edit = QLineEdit()
+        self.mask_edit.setPlaceholderText('all masks, e.g. badpix | snr & ~region')
+        self.mask_edit.editingFinished.connect(self.apply_masks)
+        layout2.addWidget(self.mask_edit)
+        layout2.addWidget(QLabel('Min S/N'))
+        self.min_sn_box = QSpinBox()
+        self.min_sn_box.setRange(0, 1000)
+        self.min_sn_box.setValue(0)
+        self.min_sn_box.valueChanged.connect(self.update_sn_mask)
+        layout2.addWidget(self.min_sn_box)
+        self.masks = MaskStore()
+
+        # Button to extract line maps from an IFU data cube
+        self.extract_cube_button = QPushButton('Extract Cube', self)
+        self.extract_cube_button.clicked.connect(self.on_extract_cube_clicked)
+        layout3.addWidget(self.extract_cube_button)
+
         # Button to plot diagnostic
         self.plt_button = QPushButton('Plot Diagnostic', self)
         self.plt_button.clicked.connect(self.on_plot_button_clicked)  # connect to on_plt_button_clicked function
         layout3.addWidget(self.plt_button)
+
+        # Button to open the multi-panel diagnostic dashboard
+        self.dashboard_button = QPushButton('Dashboard', self)
+        self.dashboard_button.clicked.connect(self.on_dashboard_clicked)
+        layout3.addWidget(self.dashboard_button)
+
+        # Several references, abundances and densities on one diagram
+        self.overlay_button = QPushButton('Overlay', self)
+        self.overlay_button.clicked.connect(self.on_overlay_clicked)
+        layout3.addWidget(self.overlay_button)
+
+        # Model surfaces against the (x, y, sigma) point cloud
+        self.view3d_button = QPushButton('3D', self)
+        self.view3d_button.clicked.connect(self.on_view3d_clicked)
+        layout3.addWidget(self.view3d_button)
+
+        # Does each pixel's sigma agree with the shock velocity its diagram position implies?
+        self.score_button = QPushButton('Score Sigma', self)
+        self.score_button.clicked.connect(self.on_score_clicked)
+        layout3.addWidget(self.score_button)
+
+        # Linked spatial map: lasso or box in either view highlights the same pixels in the other
+        layout3.addWidget(QLabel('Map?'))
+        self.check_map = QCheckBox()
+        self.check_map.stateChanged.connect(self.on_map_toggled)
+        layout3.addWidget(self.check_map)
+        self.brush_combo = QComboBox()
+        self.brush_combo.addItems(['Lasso', 'Box'])
+        self.brush_combo.currentIndexChanged.connect(self.on_brush_mode_changed)
+        layout3.addWidget(self.brush_combo)
+        self.brush = None
+
+        # Adaptive S/N binning of the FITS pixels before plotting (0 = off)
+        layout3.addWidget(QLabel('Bin S/N'))
+        self.bin_sn_box = QSpinBox()
+        self.bin_sn_box.setRange(0, 1000)
+        self.bin_sn_box.setValue(0)
+        layout3.addWidget(self.bin_sn_box)
+        # Rebinning 1M pixels takes seconds, so map and inspector wait until the S/N stops changing
+        self.rebin_timer = QTimer(self)
+        self.rebin_timer.setSingleShot(True)
+        self.rebin_timer.setInterval(250)
+        self.rebin_timer.timeout.connect(self.on_bin_sn_changed)
+        self.bin_sn_box.valueChanged.connect(lambda _: self.rebin_timer.start())
+
+        # Hover/click inspector: nearest plotted pixel and model point under the cursor
+        layout3.addWidget(QLabel('Inspect?'))
+        self.check_inspect = QCheckBox()
+        self.check_inspect.stateChanged.connect(self.update_inspector)
+        layout3.addWidget(self.check_inspect)
+        self.inspector = None
+        self.canvas.mpl_connect('motion_notify_event', self.on_canvas_hover)
+        self.canvas.mpl_connect('button_press_event', self.on_canvas_click)
+
+        # Performance overlay: per-stage timings of the last plot or FITS load
+        layout3.addWidget(QLabel('Timings?'))
+        self.check_timings = QCheckBox()
+        self.check_timings.stateChanged.connect(self.on_timings_toggled)
+        self.profiler_state = None
+        layout3.addWidget(self.check_timings)
+        self.export_trace_button = QPushButton('Export Trace', self)
+        self.export_trace_button.clicked.connect(self.on_export_trace_clicked)
+        self.export_trace_button.setVisible(False)
+        layout3.addWidget(self.export_trace_button)
+        self.timings_panel = QPlainTextEdit()
+        self.timings_panel.setReadOnly(True)
+        self.timings_panel.setFont(QFontDatabase.systemFont(QFontDatabase.SystemFont.FixedFont))
+        self.timings_panel.setMaximumHeight(160)
+        self.timings_panel.setVisible(False)
+
+        # Live re-plotting: control changes are debounced and only stale stages recomputed
+        layout3.addWidget(QLabel('Live?'))
+        self.check_live = QCheckBox()
+        layout3.addWidget(self.check_live)
+        self.replot_timer = QTimer(self)
+        self.replot_timer.setSingleShot(True)
+        self.replot_timer.setInterval(250)
+        self.replot_timer.timeout.connect(self.live_replot)
+        for combo in [self.density_combo, self.ynum_combo, self.yden_combo, self.xnum_combo, self.xden_combo,
+                      self.yquan_combo, self.xquan_combo, self.yqulr_combo, self.xqulr_combo]:
+            combo.currentIndexChanged.connect(self.on_control_changed)
+        for spin_box in [self.min_box, self.max_box, self.step_box, self.bin_sn_box]:
+            spin_box.valueChanged.connect(self.on_control_changed)
+        for check_box in [self.check_shock, self.check_precursor, self.check_independent, self.check_field_colour]:
+            check_box.stateChanged.connect(self.on_control_changed)
+
+        # Cached plotting stages shared by the button and live updates
+        self.diagram = build_diagram_pipeline(DiagramCanvas(self.fig, self.ax))
+
+        # Neighbouring densities/abundances of the plotted grid are fetched in the background
+        layout3.addWidget(QLabel('Prefetch?'))
+        self.check_prefetch = QCheckBox()
+        self.check_prefetch.setChecked(True)
+        self.check_prefetch.stateChanged.connect(self.on_prefetch_toggled)
+        layout3.addWidget(self.check_prefetch)
+        self.prefetcher = GridPrefetcher(abundances=abundances)
         
         # Add the dropdown layout to the main layout
         main_layout.addLayout(layout1)
         main_layout.addLayout(layout2)
         main_layout.addLayout(layout3)
+        main_layout.addWidget(self.timings_panel)
 
         # Initialise booleans
         self.plotting = False
@@ -252,9 +417,9 @@ class MainWindow(QMainWindow):
 
     def load_lines_and_quantities(self):
 
-        # Extract lines and quantites from query_3mdbs_tools
-        lines = list(return_lines().keys())
-        quantities = list(return_quantities().keys())
+        # Extract lines and quantites from the line catalog
+        lines = line_names()
+        quantities = quantity_names()
 
         # Update dropdowns only if the emission lines have changed
         self.xquan_combo.clear()
@@ -271,108 +436,92 @@ class MainWindow(QMainWindow):
         self.xnum_combo.addItems(lines)
         self.xden_combo.addItems(lines)
 
-    def read_model_data(self):
+    def current_selection(self):
         xqulr, yqulr, xquan, yquan, xnum, xden, ynum, yden = self.abbreviate_x_y_variable_declarations()
-        abundance = self.abundance_combo.currentText()
-        density = self.density_combo.currentText()
-        vmin = self.min_box.value()
-        vmax = self.max_box.value()
-        vstep = self.step_box.value()
-        precursor = self.check_precursor.isChecked()
-        shock = self.check_shock.isChecked()
-        independent = self.check_independent.isChecked()
-
-        # Initialize labels
-        if xqulr == 'Quantity':
-            self.x_lab = self.xquan_combo.currentText()
-        if yqulr == 'Quantity':
-            self.y_lab = self.yquan_combo.currentText()
-
-        # Initialise lists
-        self.x_data_list = []
-        self.y_data_list = []
-        self.shocks_list = []
-
-        # Send SQL query
-        result = send_3mdbs_query(xquan, yquan, xnum, xden, ynum, yden, abundance, density, vmin, vmax, precursor, shock, independent)
-
-        if independent:
-            # Process results for shock_df and precursor_df separately
-            shock_df, prec_df = result
-            self.shock_data_grouped = self.process_df(shock_df)
-            self.precursor_data_grouped = self.process_df(prec_df)
-            
-            # For backward compatibility, combine but mark as independent
-            self.model_data_grouped = self.shock_data_grouped + self.precursor_data_grouped
-                    
-        else:
-            self.model_data_grouped = self.process_df(result)
-            self.shock_data_grouped = []
-            self.precursor_data_grouped = []
-
-    def process_df(self, df):
-        vmin = self.min_box.value()
-        vmax = self.max_box.value()
-        vstep = self.step_box.value()
-        df = df.copy()
-        df['shck_vel'] = df['shck_vel'].astype(float)
-        df = df.set_index('shck_vel')
-        vels = np.arange(vmin, vmax + 1e-6, vstep)
-        
-        grouped_data = []
-        for mag_value, subdf in df.groupby('mag_fld'):
-            reindexed = subdf.reindex(vels)
-            reindexed['mag_fld'] = mag_value
-            reindexed = reindexed.reset_index().rename(columns={'index': 'shck_vel'})
-            grouped_data.append(reindexed)
-        return grouped_data
+        return DiagramSelection(
+            xqulr, yqulr,
+            abundance=self.abundance_combo.currentText(),
+            density=self.density_combo.currentText(),
+            xquan=xquan, yquan=yquan, xnum=xnum, xden=xden, ynum=ynum, yden=yden,
+            vmin=self.min_box.value(),
+            vmax=self.max_box.value(),
+            vstep=self.step_box.value(),
+            shock=self.check_shock.isChecked(),
+            precursor=self.check_precursor.isChecked(),
+            independent=self.check_independent.isChecked(),
+        )
 
-    def plot_diagnostic(self):
+    def update_pipeline_params(self):
+        # Unchanged values are ignored by the pipeline, so it is cheap to push everything
+        self.diagram.set(**selection_params(self.current_selection()))
+        if self.data_uploaded:
+            self.diagram.set(fits_points=self.fits_points, fits_mask=self.fits_points.mask,
+                             bin_target_sn=self.bin_sn_box.value() or None)
+        self.diagram.set(colour_by='field' if self.check_field_colour.isChecked() else 'z')
+        curve_mode = self.curve_combo.currentText()
+        self.diagram.set(curve_interp=None if curve_mode == 'Nodes' else curve_mode.lower())
 
-        # Read in the model data
-        self.read_model_data()
+    def render_diagram(self):
+        # Recompute whichever stages are stale, then redraw the canvas
+        self.update_pipeline_params()
+        self.diagram.get('render')
+        self.model_grid = self.diagram.get('velocity_window')
+        if self.brush is not None:
+            self.brush.attach(self.ax)
+        if self.inspector is not None:
+            self.inspector.set_model_grid(self.model_grid)
+        with span('canvas.draw'):
+            self.canvas.draw()
+        self.plotting = True
+        self.prefetch_neighbours()
 
-        # Plot new diagnostic diagram
+    def prefetch_neighbours(self):
+        # Best effort: a failed density lookup must not spoil a successful plot
+        if not self.check_prefetch.isChecked():
+            return
         try:
-            self.clear_plot()
-            self.plot_data()
-            self.canvas.draw()
-            self.plotting = True
+            self.prefetcher.schedule(self.current_selection())
         except Exception as e:
-            QMessageBox.critical(self, 'Error', f'Failed to plot diagnostic: {e}')
+            self.statusBar().showMessage(f'Prefetch failed: {e}', 5000)
 
-    def clear_plot(self):
-        if hasattr(self, 'cbar'):
-            self.cbar.remove()
-        self.ax.clear()
+    def on_prefetch_toggled(self):
+        if self.check_prefetch.isChecked():
+            if self.plotting:
+                self.prefetch_neighbours()
+        else:
+            self.prefetcher.cancel()
 
-    def plot_data(self):
-        fig = self.fig
-        ax = self.ax
-        abundance = self.abundance_combo.currentText()
-        density = self.density_combo.currentText()
-        vmin = self.min_box.value()
-        vmax = self.max_box.value()
-        vstep = self.step_box.value()
-        xqulr, yqulr,_,_,_,_,_,_ = self.abbreviate_x_y_variable_declarations()
-        independent = self.check_independent.isChecked()
-
-        # Plot model curves, and FITS data if uploaded
-        try:
-            lc = draw_model_curves(ax, xqulr, yqulr, self.model_data_grouped, self.shock_data_grouped, self.precursor_data_grouped, vmin, vmax, vstep, independent)
-        except Exception as e:
-            QMessageBox.critical(self, 'Error', f'Failed to draw model curves: {e}')
-        
-        if self.data_uploaded:
+    def plot_diagnostic(self):
+        with span('plot_diagnostic'):
             try:
-                draw_fits_points(ax, self.fits_x_data, self.fits_y_data, self.fits_z_data, self.mask_uploaded, self.fits_mask, vmin, vmax)
+                # The button always redraws, even if nothing has changed
+                self.diagram.invalidate('render')
+                self.render_diagram()
+            except StageError as e:
+                QMessageBox.critical(self, 'Error', f'Failed to plot diagnostic ({e.stage}): {e.error}')
             except Exception as e:
-                QMessageBox.critical(self, 'Error', f'Failed to draw fits points: {e}')
-        
-        try:
-            self.cbar = finalize_plot(fig, ax, lc, self.x_lab, self.y_lab, abundance, density)
-        except Exception as e:
-            QMessageBox.critical(self, 'Error', f'Failed to finalise curves: {e}')
+                QMessageBox.critical(self, 'Error', f'Failed to plot diagnostic: {e}')
+
+        self.update_timings_panel()
+
+    def on_control_changed(self):
+        # Prefetches queued for the old selection would only delay the new one
+        self.prefetcher.retarget(self.current_selection())
+
+        # Restart the debounce timer on every change; only the last one triggers a re-plot
+        if self.check_live.isChecked():
+            self.replot_timer.start()
+
+    def live_replot(self):
+        # Errors mid-edit are expected (e.g. while choosing a denominator), so report quietly
+        with span('live_replot'):
+            try:
+                self.render_diagram()
+                self.statusBar().clearMessage()
+            except Exception as e:
+                self.statusBar().showMessage(f'Live update failed: {e}', 5000)
+
+        self.update_timings_panel()
 
     def on_fits_upload_clicked(self):
         # Load in file paths
@@ -384,14 +533,13 @@ class MainWindow(QMainWindow):
         # Check all paths are valid
         if np.all([os.path.exists(file_path) for file_path in file_paths]):
             try:
-                # Load FITS data from files
-                self.fits_x_data, self.fits_y_data, self.fits_z_data = load_fits_data(file_paths)
+                # Load FITS data from files, keeping any mask already uploaded
+                with span('on_fits_upload_clicked'):
+                    self.fits_points = load_fits_points(file_paths)
+                self.update_timings_panel()
                 QMessageBox.information(self, 'Success', 'FITS files loaded successfully.')
                 self.data_uploaded = True
-
-                # Initialise bad pixel mask to include all pixels if not uploaded
-                if not self.mask_uploaded:
-                    self.fits_mask = np.zeros_like(self.fits_x_data).astype(bool)
+                self.update_sn_mask()
             except Exception as e:
                 QMessageBox.critical(self, 'Error', f'Failed to load FITS file: {e}')
 
@@ -402,12 +550,529 @@ class MainWindow(QMainWindow):
         # Check path is valid
         if os.path.exists(file_path):
             try:
-                # Load FITS data from files
-                self.fits_mask = load_fits_mask(file_path)
-                QMessageBox.information(self, 'Success', 'FITS mask loaded successfully.')
-                self.mask_uploaded = True
+                # Load FITS data from files; each mask is kept under its file name
+                name = re.sub(r'\W', '_', os.path.splitext(os.path.basename(file_path))[0])
+                name = name if name.isidentifier() else f'mask_{name}'
+                self.masks.add(name, load_fits_mask(file_path))
+                QMessageBox.information(self, 'Success', f"FITS mask loaded successfully as '{name}'.")
+                self.apply_masks()
             except Exception as e:
                 QMessageBox.critical(self, 'Error', f'Failed to load FITS mask: {e}')
 
+    def on_extract_cube_clicked(self):
+        # Writes one <cube>_<line>.fits per line, ready for Upload FITS or the dashboard
+        file_path,_ = QFileDialog.getOpenFileName(self, 'Select FITS Cube', '', 'FITS Files (*.fits *.fit)')
+        if not os.path.exists(file_path):
+            return
+        redshift, ok = QInputDialog.getDouble(self, 'Extract Cube', 'Redshift:', 0.0, -0.1, 10.0, 5)
+        if not ok:
+            return
+        out_dir = QFileDialog.getExistingDirectory(self, 'Select Output Directory', os.path.dirname(file_path))
+        if not out_dir:
+            return
+        try:
+            with span('extract_line_maps'):
+                maps, header = extract_line_maps(file_path, redshift=redshift)
+                prefix = os.path.splitext(os.path.basename(file_path))[0]
+                paths = write_line_maps(out_dir, maps, header, prefix, overwrite=True)
+            self.update_timings_panel()
+            QMessageBox.information(self, 'Success', 'Line maps written:\n' + '\n'.join(paths.values()))
+        except Exception as e:
+            QMessageBox.critical(self, 'Error', f'Failed to extract line maps: {e}')
+
+    def on_add_field_clicked(self):
+        # Same three x, y, z files as Upload FITS, added alongside the fields already loaded
+        file_paths = []
+        while len(file_paths) < 3:
+            file_path,_ = QFileDialog.getOpenFileName(self, 'Select FITS File', '', 'FITS Files (*.fits *.fit)')
+            file_paths.append(file_path)
+        if not np.all([os.path.exists(file_path) for file_path in file_paths]):
+            return
+
+        n_fields = len(self.mosaic.fields) if self.mosaic is not None else 0
+        name, ok = QInputDialog.getText(self, 'Add Field', 'Field name:', text=f'field{n_fields + 1}')
+        if not ok or not name:
+            return
+        try:
+            with span('add_field'):
+                points = load_fits_points(file_paths)
+                if self.mask_uploaded and self.fits_mask.size == len(points.x):
+                    points.mask = self.fits_mask.to_bool().ravel()
+                if self.mosaic is None:
+                    self.mosaic = MosaicStore(os.environ.get('PTERO_MOSAIC_DIR') or tempfile.mkdtemp(prefix='ptero_mosaic_'))
+                self.mosaic.add_field(name, points, file_paths)
+            self.update_timings_panel()
+        except Exception as e:
+            QMessageBox.critical(self, 'Error', f'Failed to add field: {e}')
+            return
+
+        self.field_combo.blockSignals(True)
+        self.field_combo.clear()
+        self.field_combo.addItems(['All Fields'] + self.mosaic.field_names)
+        self.field_combo.blockSignals(False)
+        self.select_fields()
+
+    def select_fields(self):
+        if self.mosaic is None:
+            return
+        choice = self.field_combo.currentText()
+        self.fits_points = self.mosaic.select(None if choice == 'All Fields' else [choice])
+        self.data_uploaded = True
+        self.apply_masks()
+
+    def update_sn_mask(self):
+        # Low S/N pixels of the y map (needs its errors) form the 'snr' mask
+        min_sn = self.min_sn_box.value()
+        if min_sn and self.data_uploaded and self.fits_points.y_err is not None:
+            points = self.fits_points
+            self.masks.add('snr', sn_threshold_mask(np.reshape(points.y, points.shape), np.reshape(points.y_err, points.shape), min_sn))
+        else:
+            self.masks.remove('snr')
+        self.apply_masks()
+
+    def apply_masks(self):
+        # Recombine the masks and push the result to the loaded points
+        try:
+            if self.masks.names():
+                self.fits_mask = self.masks.evaluate(self.mask_edit.text().strip())
+                self.mask_uploaded = True
+            else:
+                self.fits_mask = None
+                self.mask_uploaded = False
+            if self.data_uploaded and self.fits_points.field is not None:
+                # Mosaic pixels were masked field by field when they were added
+                pass
+            elif self.data_uploaded:
+                if self.mask_uploaded and self.fits_mask.size != len(self.fits_points.x):
+                    raise ValueError(f'mask has shape {self.fits_mask.shape}, data has shape {self.fits_points.shape}')
+                self.fits_points.mask = self.fits_mask.to_bool().ravel() if self.mask_uploaded else np.zeros(len(self.fits_points.x), dtype=bool)
+        except Exception as e:
+            QMessageBox.critical(self, 'Error', f'Failed to apply masks: {e}')
+            return
+        self.update_brush()
+        self.update_inspector()
+        self.on_control_changed()
+
     def on_plot_button_clicked(self):
-        self.plot_diagnostic()
\ No newline at end of file
+        self.plot_diagnostic()
+
+    def on_dashboard_clicked(self):
+        # Keep a reference so the window is not garbage collected
+        self.dashboard_window = DashboardWindow(self)
+        self.dashboard_window.show()
+        self.dashboard_window.plot_dashboard()
+
+    def on_curve_mode_changed(self):
+        # Interpolated curves can be sampled finer than the 25 km/s model grid
+        if self.curve_combo.currentText() == 'Nodes':
+            self.step_box.setRange(25, 250)
+            self.step_box.setSingleStep(25)
+            self.enforce_spinbox_constraints(self.step_box)
+        else:
+            self.step_box.setRange(5, 250)
+            self.step_box.setSingleStep(5)
+        self.on_control_changed()
+
+    def on_overlay_clicked(self):
+        # Keep a reference so the window is not garbage collected
+        self.overlay_window = OverlayWindow(self)
+        self.overlay_window.show()
+        self.overlay_window.plot_overlay()
+
+    def on_view3d_clicked(self):
+        # Keep a reference so the window is not garbage collected
+        self.view3d_window = Diagram3DWindow(self)
+        self.view3d_window.show()
+        self.view3d_window.plot_3d()
+
+    def on_score_clicked(self):
+        if not self.data_uploaded:
+            self.show_message('Error', 'FITS data must be uploaded in order to score sigma consistency')
+            return
+        # Keep a reference so the window is not garbage collected
+        self.score_window = ConsistencyWindow(self)
+        self.score_window.show()
+        self.score_window.plot_scores()
+
+    def on_map_toggled(self):
+        self.map_canvas.setVisible(self.check_map.isChecked())
+        self.update_brush()
+
+    def on_brush_mode_changed(self):
+        if self.brush is not None:
+            self.brush.set_mode(self.brush_combo.currentText().lower())
+
+    def pixel_points(self):
+        '''Pixels as drawn on the diagram: with S/N binning on, each pixel at its bin's position.'''
+        target_sn = self.bin_sn_box.value()
+        if not target_sn:
+            return self.fits_points
+        return bin_pixel_points(self.fits_points, target_sn, self.fits_points.mask)
+
+    def on_bin_sn_changed(self):
+        # Map and inspector must follow the points actually drawn
+        self.update_brush()
+        self.update_inspector()
+
+    def update_brush(self):
+        # The pixel index is rebuilt only when the FITS data or mask changes
+        if self.brush is not None:
+            self.brush.disconnect()
+            self.brush = None
+        if not (self.check_map.isChecked() and self.data_uploaded):
+            return
+        try:
+            with span('build_pixel_index', n_points=len(self.fits_points.x)):
+                index = PixelIndex(self.pixel_points())
+            sel = self.current_selection()
+            self.brush = LinkedBrush(self.map_ax, index, sel.vmin, sel.vmax, self.brush_combo.currentText().lower())
+            if self.plotting:
+                self.brush.attach(self.ax)
+            self.map_canvas.draw_idle()
+        except Exception as e:
+            self.brush = None
+            QMessageBox.critical(self, 'Error', f'Failed to show spatial map: {e}')
+
+    def update_inspector(self):
+        # The KD-tree is rebuilt only when the FITS data or mask changes
+        self.inspector = None
+        if not (self.check_inspect.isChecked() and self.data_uploaded):
+            return
+        try:
+            with span('build_inspector', n_points=len(self.fits_points.x)):
+                self.inspector = PointInspector(self.pixel_points())
+                if self.plotting:
+                    self.inspector.set_model_grid(self.model_grid)
+        except Exception as e:
+            QMessageBox.critical(self, 'Error', f'Failed to build inspector: {e}')
+
+    def inspect_event(self, event):
+        if self.inspector is None or event.inaxes is not self.ax:
+            return None
+        return self.inspector.pick(self.ax, event.x, event.y)
+
+    def on_canvas_hover(self, event):
+        info = self.inspect_event(event)
+        if info is not None:
+            self.statusBar().showMessage(format_inspection(info), 2000)
+
+    def on_canvas_click(self, event):
+        # A click keeps the message until the next one
+        info = self.inspect_event(event)
+        if info is not None:
+            self.statusBar().showMessage(format_inspection(info))
+
+    def on_timings_toggled(self):
+        # Spans are only recorded while the overlay is shown (or PTERO_PROFILE is set)
+        if self.check_timings.isChecked():
+            self.profiler_state = PROFILER.state()
+            PROFILER.enable(trace_memory=True)
+        elif self.profiler_state is not None:
+            PROFILER.restore(self.profiler_state)
+            self.profiler_state = None
+        self.timings_panel.setVisible(self.check_timings.isChecked())
+        self.export_trace_button.setVisible(self.check_timings.isChecked())
+        self.update_timings_panel()
+
+    def update_timings_panel(self):
+        if self.check_timings.isChecked():
+            # Stage tree, then where the time in SQL went per statement
+            self.timings_panel.setPlainText(PROFILER.format_tree() + '\n\n' + QUERY_LOG.format_table())
+
+    def on_export_trace_clicked(self):
+        file_path,_ = QFileDialog.getSaveFileName(self, 'Export Trace', 'ptero_trace.json', 'Chrome Trace (*.json)')
+        if file_path:
+            try:
+                PROFILER.to_chrome_trace(file_path)
+            except Exception as e:
+                QMessageBox.critical(self, 'Error', f'Failed to export trace: {e}')
+
+    def closeEvent(self, event):
+        # Do not keep the interpreter alive for queries nobody will look at
+        self.prefetcher.shutdown()
+        super().closeEvent(event)
+
+class DashboardWindow(QMainWindow):
+    """
+    Standard diagnostic panels side by side, sharing one grid fetch, one
+    line-map load and one colour scale. Model choices come from the main window.
+    """
+    def __init__(self, main_window):
+        super().__init__()
+        self.main_window = main_window
+        self.setWindowTitle('PTERO Dashboard')
+        central_widget = QWidget()
+        self.setCentralWidget(central_widget)
+        layout = QVBoxLayout(central_widget)
+
+        # Create and embed the Matplotlib figure
+        self.fig = Figure(figsize=(4 * len(STANDARD_PANELS), 4))
+        self.canvas = FigureCanvas(self.fig)
+        layout.addWidget(self.canvas)
+        self.toolbar = NavigationToolbar2QT(self.canvas, self)
+        layout.addWidget(self.toolbar)
+
+        buttons = QHBoxLayout()
+        self.upload_lines_button = QPushButton('Upload Line Maps', self)
+        self.upload_lines_button.clicked.connect(self.on_upload_lines_clicked)
+        buttons.addWidget(self.upload_lines_button)
+        self.plt_button = QPushButton('Plot Dashboard', self)
+        self.plt_button.clicked.connect(self.plot_dashboard)
+        buttons.addWidget(self.plt_button)
+        layout.addLayout(buttons)
+
+        self.line_maps = None
+
+    def on_upload_lines_clicked(self):
+        # One file per line, named after it (e.g. field_NII.fits); SIGMA is taken from any of them
+        file_paths,_ = QFileDialog.getOpenFileNames(self, 'Select Line Map FITS Files', '', 'FITS Files (*.fits *.fit)')
+        if not file_paths:
+            return
+        try:
+            names = line_names() + quantity_names()
+            with span('load_line_maps', n_files=len(file_paths)):
+                self.line_maps, self.sigma, self.shape = load_line_maps(file_paths, names)
+            QMessageBox.information(self, 'Success', f'Loaded line maps: {", ".join(self.line_maps)}')
+            self.plot_dashboard()
+        except Exception as e:
+            QMessageBox.critical(self, 'Error', f'Failed to load line maps: {e}')
+
+    def plot_dashboard(self):
+        selection = self.main_window.current_selection()
+        selections = panel_selections(STANDARD_PANELS, selection.abundance, selection.density, selection.vmin,
+                                      selection.vmax, selection.vstep, selection.shock, selection.precursor, selection.independent)
+        with span('plot_dashboard'):
+            try:
+                grids = fetch_dashboard_grids(selections)
+                points_list = None
+                if self.line_maps is not None:
+                    # Reuse the main window's bad pixel mask when it covers the same pixels
+                    main = self.main_window
+                    n_pixels = len(next(iter(self.line_maps.values())))
+                    mask = main.fits_mask.to_bool().ravel() if main.mask_uploaded and main.fits_mask.size == n_pixels else None
+                    points_list = evaluate_panel_points(selections, self.line_maps, self.sigma, mask)
+                self.fig.clear()
+                render_dashboard(self.fig, grids, points_list)
+                with span('canvas.draw'):
+                    self.canvas.draw()
+            except Exception as e:
+                QMessageBox.critical(self, 'Error', f'Failed to plot dashboard: {e}')
+        self.main_window.update_timings_panel()
+
+class OverlayWindow(QMainWindow):
+    """
+    Model families from several references, abundances and densities on one
+    diagram, fetched in one query. Lines, model type and velocity window come
+    from the main window, as do its FITS points.
+    """
+    def __init__(self, main_window):
+        super().__init__()
+        self.main_window = main_window
+        self.setWindowTitle('PTERO Overlay')
+        central_widget = QWidget()
+        self.setCentralWidget(central_widget)
+        layout = QVBoxLayout(central_widget)
+
+        # Create and embed the Matplotlib figure
+        self.fig = Figure(figsize=(8, 6))
+        self.canvas = FigureCanvas(self.fig)
+        layout.addWidget(self.canvas)
+        self.toolbar = NavigationToolbar2QT(self.canvas, self)
+        layout.addWidget(self.toolbar)
+
+        # Comma separated lists, starting from the main window's choice
+        selection = main_window.current_selection()
+        controls = QHBoxLayout()
+        controls.addWidget(QLabel('Refs:'))
+        self.refs_edit = QLineEdit(selection.ref)
+        self.refs_edit.setToolTip('Available: ' + ', '.join(populate_ref_dropdown()))
+        controls.addWidget(self.refs_edit)
+        controls.addWidget(QLabel('Abundances:'))
+        self.abundances_edit = QLineEdit(selection.abundance)
+        controls.addWidget(self.abundances_edit)
+        controls.addWidget(QLabel('Densities (cm-3):'))
+        self.densities_edit = QLineEdit(selection.density)
+        controls.addWidget(self.densities_edit)
+        self.plt_button = QPushButton('Plot Overlay', self)
+        self.plt_button.clicked.connect(self.plot_overlay)
+        controls.addWidget(self.plt_button)
+        layout.addLayout(controls)
+
+    @staticmethod
+    def split_list(edit):
+        return [item.strip() for item in edit.text().split(',') if item.strip()]
+
+    def plot_overlay(self):
+        main = self.main_window
+        selection = main.current_selection()
+        with span('plot_overlay'):
+            try:
+                families = fetch_overlay_grids(selection, self.split_list(self.refs_edit), self.split_list(self.abundances_edit),
+                                               self.split_list(self.densities_edit))
+                points = None
+                if main.data_uploaded:
+                    # Same masked (and possibly binned) points as the main diagram
+                    main.update_pipeline_params()
+                    points = main.diagram.get('fits_preparation')
+                self.fig.clear()
+                ax = self.fig.add_subplot()
+                colour_by = 'field' if main.check_field_colour.isChecked() else 'z'
+                render_overlay(self.fig, ax, families, points, colour_by)
+                with span('canvas.draw'):
+                    self.canvas.draw()
+            except Exception as e:
+                QMessageBox.critical(self, 'Error', f'Failed to plot overlay: {e}')
+        main.update_timings_panel()
+
+class Diagram3DWindow(QMainWindow):
+    """
+    The main window's diagram in 3D: log x, log y and velocity. Model grids
+    are surfaces over B and shock velocity; FITS pixels sit at their velocity
+    dispersion, thinned (decimated or voxelised) so rotation stays responsive.
+    """
+    def __init__(self, main_window):
+        super().__init__()
+        self.main_window = main_window
+        self.setWindowTitle('PTERO 3D')
+        central_widget = QWidget()
+        self.setCentralWidget(central_widget)
+        layout = QVBoxLayout(central_widget)
+
+        # Create and embed the Matplotlib figure (drag to rotate)
+        self.fig = Figure(figsize=(8, 7))
+        self.canvas = FigureCanvas(self.fig)
+        layout.addWidget(self.canvas)
+        self.toolbar = NavigationToolbar2QT(self.canvas, self)
+        layout.addWidget(self.toolbar)
+
+        controls = QHBoxLayout()
+        controls.addWidget(QLabel('Points:'))
+        self.mode_combo = QComboBox()
+        self.mode_combo.addItems(['Auto', 'All', 'Decimate', 'Voxels'])
+        controls.addWidget(self.mode_combo)
+        controls.addWidget(QLabel('Max markers'))
+        self.max_points_box = QSpinBox()
+        self.max_points_box.setRange(1000, 1000000)
+        self.max_points_box.setSingleStep(10000)
+        self.max_points_box.setValue(50000)
+        controls.addWidget(self.max_points_box)
+        controls.addWidget(QLabel('Voxels/axis'))
+        self.bins_box = QSpinBox()
+        self.bins_box.setRange(8, 256)
+        self.bins_box.setValue(64)
+        controls.addWidget(self.bins_box)
+        self.plt_button = QPushButton('Plot 3D', self)
+        self.plt_button.clicked.connect(self.plot_3d)
+        controls.addWidget(self.plt_button)
+        layout.addLayout(controls)
+
+    def plot_3d(self):
+        main = self.main_window
+        with span('plot_3d'):
+            try:
+                # Same grid and (masked, possibly binned) points as the main diagram
+                main.update_pipeline_params()
+                grid = main.diagram.get('velocity_window')
+                cloud = None
+                if main.data_uploaded:
+                    points = main.diagram.get('fits_preparation')
+                    cloud = point_cloud(points, self.mode_combo.currentText().lower(), self.max_points_box.value(),
+                                        self.bins_box.value())
+                self.fig.clear()
+                ax = self.fig.add_subplot(projection='3d')
+                render_3d(self.fig, ax, grid, cloud)
+                if cloud is not None:
+                    self.statusBar().showMessage(f'{len(cloud.xyz)} markers for {cloud.n_pixels} pixels ({cloud.mode})')
+                with span('canvas.draw'):
+                    self.canvas.draw()
+            except Exception as e:
+                QMessageBox.critical(self, 'Error', f'Failed to plot 3D diagram: {e}')
+        main.update_timings_panel()
+
+class ConsistencyWindow(QMainWindow):
+    """
+    Sigma-velocity consistency of the uploaded pixels against the main
+    window's model grid: residual map (sigma minus model shock velocity) and
+    residual histogram per model type, with the maps exportable to FITS.
+    """
+    def __init__(self, main_window):
+        super().__init__()
+        self.main_window = main_window
+        self.maps = None
+        self.setWindowTitle('PTERO Sigma Consistency')
+        central_widget = QWidget()
+        self.setCentralWidget(central_widget)
+        layout = QVBoxLayout(central_widget)
+
+        # Create and embed the Matplotlib figure
+        self.fig = Figure(figsize=(10, 5))
+        self.canvas = FigureCanvas(self.fig)
+        layout.addWidget(self.canvas)
+        self.toolbar = NavigationToolbar2QT(self.canvas, self)
+        layout.addWidget(self.toolbar)
+
+        controls = QHBoxLayout()
+        controls.addWidget(QLabel('Model velocity:'))
+        self.method_combo = QComboBox()
+        self.method_combo.addItems(['Nearest', 'Linear'])
+        controls.addWidget(self.method_combo)
+        self.plt_button = QPushButton('Score', self)
+        self.plt_button.clicked.connect(self.plot_scores)
+        controls.addWidget(self.plt_button)
+        self.save_button = QPushButton('Save Maps', self)
+        self.save_button.clicked.connect(self.on_save_clicked)
+        controls.addWidget(self.save_button)
+        layout.addLayout(controls)
+
+    def plot_scores(self):
+        main = self.main_window
+        with span('plot_scores'):
+            try:
+                # Same grid as the main diagram; the full pixel maps (with
+                # their mask and sigma errors) so results come back as maps
+                main.update_pipeline_params()
+                grid = main.diagram.get('velocity_window')
+                points = main.fits_points
+                self.maps, summaries = score_consistency(grid, points, self.method_combo.currentText().lower())
+
+                self.fig.clear()
+                groups = list(summaries)
+                for i, group in enumerate(groups):
+                    residual = self.maps[group]['RESIDUAL']
+                    if residual.ndim == 2:
+                        map_ax = self.fig.add_subplot(len(groups), 2, 2 * i + 1)
+                        image = map_ax.imshow(residual, origin='lower', cmap='RdBu_r', vmin=-300, vmax=300)
+                        self.fig.colorbar(image, ax=map_ax, label='$\\sigma - v_{shock}$ / km s$^{-1}$')
+                        map_ax.set_title(group)
+                    summary = summaries[group]
+                    hist_ax = self.fig.add_subplot(len(groups), 2, 2 * i + 2)
+                    hist_ax.stairs(summary.counts, summary.edges, fill=True, alpha=0.6)
+                    hist_ax.axvline(0, color='gray', linewidth=0.8)
+                    hist_ax.set_xlabel('$\\sigma - v_{shock}$ / km s$^{-1}$')
+                    if summary.n:
+                        hist_ax.set_title(f'{summary.label}\nmedian {summary.median:.0f} km/s, '
+                                          f'{summary.fraction:.0%} of {summary.n} consistent', fontsize=9)
+                    else:
+                        hist_ax.set_title(f'{summary.label}\nno pixels inside the model grid', fontsize=9)
+                self.fig.tight_layout()
+                with span('canvas.draw'):
+                    self.canvas.draw()
+            except Exception as e:
+                QMessageBox.critical(self, 'Error', f'Failed to score sigma consistency: {e}')
+        main.update_timings_panel()
+
+    def on_save_clicked(self):
+        if self.maps is None:
+            return
+        file_path,_ = QFileDialog.getSaveFileName(self, 'Save Consistency Maps', 'ptero_consistency.fits', 'FITS Files (*.fits)')
+        if not file_path:
+            return
+        # One extension per map; independent grids are prefixed SHOCK_ / PRECURSOR_
+        maps = {}
+        for group, group_maps in self.maps.items():
+            prefix = '' if group == 'model' else f'{group.upper()}_'
+            maps.update({prefix + name: data for name, data in group_maps.items()})
+        try:
+            write_inference_maps(file_path, maps, overwrite=True)
+        except Exception as e:
+            QMessageBox.critical(self, 'Error', f'Failed to save maps: {e}')
@@ -0,0 +1,88 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Custom function declarations
+from analysis.inference import log_points, ShockInference
+
+class PointInspector:
+    """
+    Nearest-pixel lookup on the diagnostic plane for hover and click inspection.
+
+    A KD-tree over the log-space positions of the unmasked FitsPoints is built
+    once per FITS load, so each mouse event is a single O(log N) query instead
+    of matplotlib's O(N) pick over the whole scatter. set_model_grid() adds the
+    nearest model point (shock velocity and magnetic field) to every lookup.
+    """
+    def __init__(self, points):
+        keep = np.flatnonzero(~points.mask)
+        log_xy, good = log_points(points.x[keep], points.y[keep])
+        if len(log_xy) == 0:
+            raise ValueError('No unmasked FITS points with finite, positive x and y to inspect')
+
+        self.points = points
+        self.pixels = keep[good]
+        self.tree = cKDTree(log_xy)
+        self.model = None
+        self._model_grid = None
+
+    def set_model_grid(self, grid, groups='model'):
+        # Rebuilt only when the plotted grid actually changes
+        if grid is not self._model_grid:
+            self.model = ShockInference(grid, groups)
+            self._model_grid = grid
+
+    def lookup(self, x, y):
+        """
+        Inspect the plotted pixel nearest to diagram position (x, y) (data units).
+
+        Returns a dict with the flat pixel index, its (row, col) on the pixel
+        grid, its x, y and sigma values, and the nearest model point's shock
+        velocity, magnetic field and log-space distance (NaN with no model grid).
+        """
+        if x <= 0 or y <= 0:
+            return None
+        _, i = self.tree.query((np.log10(x), np.log10(y)))
+        return self._describe(self.pixels[i])
+
+    def _describe(self, pixel):
+        px, py = self.points.x[pixel], self.points.y[pixel]
+
+        vel = mag = dist = np.nan
+        if self.model is not None:
+            dist, j = self.model.tree.query((np.log10(px), np.log10(py)))
+            vel, mag = self.model.vels[j], self.model.mags[j]
+
+        return dict(index=pixel, pixel=np.unravel_index(pixel, self.points.shape), x=px, y=py,
+                    sigma=self.points.z[pixel], shck_vel=vel, mag_fld=mag, model_dist=dist)
+
+    def pick(self, ax, event_x, event_y, tolerance=5):
+        '''lookup() for a mouse position in display pixels, or None if no point lies within tolerance pixels.'''
+        x, y = ax.transData.inverted().transform((event_x, event_y))
+        if not (x > 0 and y > 0):
+            return None
+        # The tree is in dex, but a dex spans different pixel lengths on the two
+        # axes, so the nearest point in dex need not be nearest on screen. Take
+        # every point within tolerance pixels along the shorter dex axis, then
+        # measure them in display pixels.
+        corner = ax.transData.transform((x * 10, y * 10))
+        per_dex = np.abs(corner - (event_x, event_y)).min()
+        if not per_dex > 0:
+            return None
+        candidates = self.tree.query_ball_point((np.log10(x), np.log10(y)), tolerance / per_dex, p=np.inf)
+        if not candidates:
+            return None
+        pixels = self.pixels[candidates]
+        display = ax.transData.transform(np.column_stack([self.points.x[pixels], self.points.y[pixels]]))
+        distance = np.hypot(display[:, 0] - event_x, display[:, 1] - event_y)
+        best = np.argmin(distance)
+        if distance[best] > tolerance:
+            return None
+        return self._describe(pixels[best])
+
+def format_inspection(info):
+    '''One-line description of a lookup() result for the status bar.'''
+    pixel = ', '.join(str(int(p)) for p in info['pixel'])
+    text = f"pixel ({pixel})  x = {info['x']:.4g}  y = {info['y']:.4g}  sigma = {info['sigma']:.4g}"
+    if np.isfinite(info['shck_vel']):
+        text += f"  |  nearest model: v = {info['shck_vel']:.0f} km/s, B = {info['mag_fld']:g}, {info['model_dist']:.3f} dex away"
+    return text
@@ -0,0 +1,115 @@
+import numpy as np
+from matplotlib import colormaps
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import ListedColormap, Normalize
+from matplotlib.lines import Line2D
+
+# Custom function declarations
+from data_io.query_3mdbs_tools import send_3mdbs_grid_query
+from dashboard import axis_terms, query_frame, query_model_types
+from pipeline import build_model_grid, draw_grid, draw_points
+from profiling import span
+
+# Several model families (reference x abundance x density) on one diagram.
+# All of them come back from a single query per model type, filtered with
+# IN (...) lists, and are split client-side into one ModelGrid per family.
+# Each family is drawn with its own single-hue colour map, so families stay
+# distinguishable while shock velocity still reads as light-to-dark.
+
+FAMILY_CMAPS = ['Blues', 'Oranges', 'Greens', 'Purples', 'Reds', 'Greys', 'YlOrBr', 'PuRd']
+
+def family_cmap(i):
+    '''Colour map of family i, without the palest third so slow shocks stay visible.'''
+    cmap = colormaps[FAMILY_CMAPS[i % len(FAMILY_CMAPS)]]
+    return ListedColormap(cmap(np.linspace(0.35, 1, 256)))
+
+class ModelFamily:
+    """One ModelGrid of an overlay, with the reference, abundance and density it was fetched for."""
+    def __init__(self, ref, abundance, density, grid):
+        self.ref = ref
+        self.abundance = abundance
+        self.density = density
+        self.grid = grid
+
+    @property
+    def label(self):
+        return f'{self.ref}, {self.abundance}, {self.density:g} cm$^{{-3}}$'
+
+def fetch_overlay_grids(selection, refs, abundances, densities):
+    """
+    Fetch every combination of refs x abundances x densities in one query per model type.
+
+    Parameters:
+    - selection: DiagramSelection giving the axes, model type and velocity window
+    - refs, abundances, densities: lists of model references, abundance names and densities
+
+    Returns one ModelFamily per combination present in 3MdBs, in the order the
+    lists were given.
+    """
+    ratios, quantities = [], []
+    for axis in ['x', 'y']:
+        kind, term = axis_terms(selection, axis)
+        if kind == 'ratio':
+            ratios.append(term)
+        else:
+            quantities.append(term)
+    densities = [float(d) for d in densities]
+
+    with span('fetch_overlay_grids', n_families=len(refs) * len(abundances) * len(densities)):
+        results = [send_3mdbs_grid_query(ratios, model_type, abundances, densities, selection.vmin, selection.vmax,
+                                         quantities, refs) for model_type in query_model_types(selection)]
+
+        # Split each result into per-family frames with a single groupby pass
+        keys = ['ref', 'abundance', 'preshck_dens']
+        # MySQL returns DECIMAL densities, which do not compare equal to the float keys below
+        results = [result.assign(preshck_dens=result['preshck_dens'].astype(float)) for result in results]
+        split = [{key: df for key, df in result.groupby(keys, sort=False)} for result in results]
+
+        families = []
+        for ref in refs:
+            for abundance in abundances:
+                for density in densities:
+                    key = (ref, abundance, density)
+                    if not all(key in parts for parts in split):
+                        continue
+                    family_selection = selection.replace(ref=ref, abundance=abundance, density=f'{density:g}')
+                    frames = [query_frame(parts[key], family_selection) for parts in split]
+                    grid = build_model_grid(family_selection, frames if selection.independent else frames[0])
+                    families.append(ModelFamily(ref, abundance, density, grid))
+    return families
+
+def render_overlay(fig, ax, families, points=None, colour_by='z'):
+    """
+    Draw every ModelFamily onto one Axes, with a family legend and a velocity colorbar.
+
+    Returns the colorbar so callers can remove it before the next redraw.
+    """
+    if not families:
+        raise ValueError('None of the requested model families exist in 3MdBs')
+
+    handles = []
+    for i, family in enumerate(families):
+        cmap = family_cmap(i)
+        draw_grid(ax, family.grid, cmap, link_color=cmap(0.5))
+        handles.append(Line2D([], [], color=cmap(0.75), label=family.label))
+
+    grid = families[0].grid
+    if points is not None:
+        draw_points(ax, points, grid.selection, colour_by)
+
+    # Keep a field legend from draw_points alongside the family legend
+    if ax.get_legend() is not None:
+        ax.add_artist(ax.get_legend())
+    ax.legend(handles=handles, loc='best', fontsize=8)
+
+    ax.set_xlabel(grid.x_lab)
+    ax.set_ylabel(grid.y_lab)
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    ax.tick_params(axis='both', labelsize=12)
+
+    # Velocity scale shared by every family, shown on a neutral ramp
+    velocity = ScalarMappable(Normalize(grid.selection.vmin, grid.selection.vmax), family_cmap(FAMILY_CMAPS.index('Greys')))
+    cbar = fig.colorbar(velocity, ax=ax)
+    cbar.set_label('Shock velocity / km s$^{-1}$', size=14)
+    return cbar
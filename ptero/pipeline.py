@@ -0,0 +1,326 @@
+import copy
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Custom function declarations
+from data_io.handle_fits_data import load_fits_data, load_fits_errors, load_fits_mask
+from data_io.align_fits import needs_alignment, load_aligned_fits
+from data_io.compressed_fits import region_slices
+from data_io.query_3mdbs_tools import send_3mdbs_query
+from profiling import span
+from plotter import draw_model_curves, draw_fits_points, draw_field_points, draw_error_ellipses, finalize_plot
+
+# Qt-free core of PTERO. Everything MainWindow does to produce a diagram lives
+# here so that scripts, batch jobs and worker processes can build the same plot
+# without PyQt6 or a display:
+#
+#   selection = DiagramSelection('Line Ratio', 'Line Ratio', xnum='NII', xden='Ha', ...)
+#   grid = fetch_model_grid(selection)
+#   points = load_fits_points([x_path, y_path, z_path], mask_path)
+#   rgba = render_to_array(grid, points)
+
+class DiagramSelection:
+    """
+    Every user choice needed to build one diagnostic diagram.
+
+    Mirrors the MainWindow controls one-to-one (defaults are the controls'
+    initial values), so the GUI only has to read its widgets into one of these
+    and hand it to the functions below. The query always selects both line
+    ratios and both quantities, so all four must be valid names.
+    """
+    def __init__(self, xqulr, yqulr, abundance, density, xquan='O23', yquan='O23', xnum='Ha', xden='Ha', ynum='Ha', yden='Ha',
+                 vmin=100, vmax=1000, vstep=25, shock=True, precursor=False, independent=False, ref='Allen08'):
+        self.xqulr = xqulr
+        self.yqulr = yqulr
+        self.abundance = abundance
+        self.density = density
+        self.xquan = xquan
+        self.yquan = yquan
+        self.xnum = xnum
+        self.xden = xden
+        self.ynum = ynum
+        self.yden = yden
+        self.vmin = vmin
+        self.vmax = vmax
+        self.vstep = vstep
+        self.shock = shock
+        self.precursor = precursor
+        self.independent = independent
+        self.ref = ref
+
+    def replace(self, **changes):
+        '''Copy of this selection with some choices changed.'''
+        selection = copy.copy(self)
+        for name, value in changes.items():
+            setattr(selection, name, value)
+        return selection
+
+    def query_args(self):
+        '''Positional arguments for send_3mdbs_query.'''
+        return (self.xquan, self.yquan, self.xnum, self.xden, self.ynum, self.yden, self.abundance, self.density,
+                self.vmin, self.vmax, self.precursor, self.shock, self.independent, self.ref)
+
+    @property
+    def x_lab(self):
+        if self.xqulr == 'Quantity':
+            return self.xquan
+        return f'{self.xnum}_{self.xden}'
+
+    @property
+    def y_lab(self):
+        if self.yqulr == 'Quantity':
+            return self.yquan
+        return f'{self.ynum}_{self.yden}'
+
+class ModelGrid:
+    """
+    Model curves for one selection, split into one DataFrame per magnetic field.
+
+    Columns follow the query layout: shck_vel, x line ratio, y line ratio,
+    x quantity, y quantity, mag_fld.
+    """
+    def __init__(self, selection, model_data_grouped, shock_data_grouped=None, precursor_data_grouped=None):
+        self.selection = selection
+        self.model_data_grouped = model_data_grouped
+        self.shock_data_grouped = shock_data_grouped or []
+        self.precursor_data_grouped = precursor_data_grouped or []
+
+    @property
+    def x_lab(self):
+        return self.selection.x_lab
+
+    @property
+    def y_lab(self):
+        return self.selection.y_lab
+
+    def xy_columns(self):
+        '''Column positions of the plotted x and y values (same choice as draw_model_curves).'''
+        x_id = 1 if self.selection.xqulr == 'Line Ratio' else 3
+        y_id = 2 if self.selection.yqulr == 'Line Ratio' else 4
+        return x_id, y_id
+
+    def grid_points(self, groups='model'):
+        """
+        Flatten the grid into 1D arrays of (shck_vel, mag_fld, x, y).
+
+        groups selects 'model' (everything plotted), 'shock' or 'precursor'.
+        """
+        data_grouped = {
+            'model': self.model_data_grouped,
+            'shock': self.shock_data_grouped,
+            'precursor': self.precursor_data_grouped,
+        }[groups]
+        x_id, y_id = self.xy_columns()
+
+        vels, mags, xs, ys = [], [], [], []
+        for data in data_grouped:
+            vels.append(data.iloc[:, 0].to_numpy(dtype=float))
+            mags.append(data['mag_fld'].to_numpy(dtype=float))
+            xs.append(data.iloc[:, x_id].to_numpy(dtype=float))
+            ys.append(data.iloc[:, y_id].to_numpy(dtype=float))
+        if not vels:
+            empty = np.empty(0)
+            return empty, empty, empty, empty
+        return np.concatenate(vels), np.concatenate(mags), np.concatenate(xs), np.concatenate(ys)
+
+class FitsPoints:
+    """
+    Flattened observed x, y, z values plus a bad pixel mask (True = bad).
+
+    shape is the original pixel grid, used to turn per-pixel results back into maps.
+    x_err, y_err, z_err are the matching 1-sigma uncertainties, or None if not available.
+    Points from a MosaicStore also carry field (field ID per point) and field_names.
+    """
+    def __init__(self, x, y, z, mask=None, shape=None, x_err=None, y_err=None, z_err=None, field=None, field_names=None):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.x_err = x_err
+        self.y_err = y_err
+        self.z_err = z_err
+        self.field = field
+        self.field_names = field_names
+        self.shape = tuple(shape) if shape is not None else (len(x),)
+        if mask is None:
+            mask = np.zeros_like(x).astype(bool)
+        self.mask = np.asarray(mask, dtype=bool).flatten()
+
+def process_df(df, vmin, vmax, vstep):
+    """
+    Split a query result into one DataFrame per magnetic field, reindexed onto
+    the requested shock velocity grid (missing velocities become NaN).
+    """
+    df = df.copy()
+    df['shck_vel'] = df['shck_vel'].astype(float)
+    df = df.set_index('shck_vel')
+    vels = np.arange(vmin, vmax + 1e-6, vstep)
+
+    grouped_data = []
+    for mag_value, subdf in df.groupby('mag_fld'):
+        reindexed = subdf.reindex(vels)
+        reindexed['mag_fld'] = mag_value
+        reindexed = reindexed.reset_index().rename(columns={'index': 'shck_vel'})
+        grouped_data.append(reindexed)
+    return grouped_data
+
+def build_model_grid(selection, result):
+    """Turn the raw output of send_3mdbs_query into a ModelGrid."""
+    vmin, vmax, vstep = selection.vmin, selection.vmax, selection.vstep
+
+    if selection.independent:
+        # Process results for shock_df and precursor_df separately
+        shock_df, prec_df = result
+        shock_data_grouped = process_df(shock_df, vmin, vmax, vstep)
+        precursor_data_grouped = process_df(prec_df, vmin, vmax, vstep)
+
+        # For backward compatibility, combine but mark as independent
+        model_data_grouped = shock_data_grouped + precursor_data_grouped
+        return ModelGrid(selection, model_data_grouped, shock_data_grouped, precursor_data_grouped)
+
+    return ModelGrid(selection, process_df(result, vmin, vmax, vstep))
+
+def window_model_grid(grid, vmin, vmax, vstep, interpolate=None):
+    """
+    Reindex an already processed ModelGrid onto a new velocity window and step,
+    without going back to the database.
+
+    By default only native model velocities carry values. With interpolate
+    ('linear' or 'spline') the plotted x and y are interpolated in log space
+    between the nodes, so any vstep gives a complete curve.
+    """
+    vels = np.arange(vmin, vmax + 1e-6, vstep)
+
+    def window(data_grouped, groups):
+        if interpolate:
+            # Imported here so scipy's spline machinery is only loaded when used
+            from analysis.interpolate import model_grid_interpolator
+            interp = model_grid_interpolator(grid, groups, interpolate)
+            x_id, y_id = grid.xy_columns()
+        windowed = []
+        for data in data_grouped:
+            mag_value = data['mag_fld'].iloc[0]
+            reindexed = data.set_index('shck_vel').reindex(vels)
+            reindexed['mag_fld'] = mag_value
+            reindexed = reindexed.reset_index().rename(columns={'index': 'shck_vel'})
+            if interpolate:
+                values = interp(mag_fld=mag_value, shck_vel=vels)
+                reindexed.iloc[:, x_id] = values[:, 0]
+                reindexed.iloc[:, y_id] = values[:, 1]
+            windowed.append(reindexed)
+        return windowed
+
+    selection = grid.selection.replace(vmin=vmin, vmax=vmax, vstep=vstep)
+    if selection.independent:
+        shock_data_grouped = window(grid.shock_data_grouped, 'shock')
+        precursor_data_grouped = window(grid.precursor_data_grouped, 'precursor')
+        return ModelGrid(selection, shock_data_grouped + precursor_data_grouped, shock_data_grouped, precursor_data_grouped)
+    return ModelGrid(selection, window(grid.model_data_grouped, 'model'))
+
+def fetch_model_grid(selection):
+    """Query 3MdBs for a selection and return the resulting ModelGrid."""
+    with span('fetch_model_grid'):
+        result = send_3mdbs_query(*selection.query_args())
+        with span('process_df'):
+            return build_model_grid(selection, result)
+
+def load_fits_points(file_paths, mask_path=None, align=True, reference=0, region=None):
+    """
+    Load the x, y, z FITS files (and optional bad pixel mask) into FitsPoints.
+
+    If align is set and the maps differ in shape or WCS, they are resampled
+    onto the grid of file_paths[reference] (or the finest, for 'finest'); the
+    mask must then be on that grid. region is an optional (y0, y1, x0, x1)
+    cutout of maps on a shared grid; for tile-compressed maps only the tiles
+    it touches are decoded.
+    """
+    if align and needs_alignment(file_paths):
+        with span('load_aligned_fits'):
+            x, y, z, shape, (x_err, y_err, z_err), _ = load_aligned_fits(file_paths, reference)
+        if region is not None:
+            # Cut the region out of the common grid
+            cut = region_slices(shape, region)
+            x, y, z, x_err, y_err, z_err = (a.reshape(shape)[cut].ravel() if a is not None else None
+                                            for a in (x, y, z, x_err, y_err, z_err))
+            shape = (cut[0].stop - cut[0].start, cut[1].stop - cut[1].start)
+    else:
+        with span('load_fits_data'):
+            x, y, z, shape = load_fits_data(file_paths, return_shape=True, region=region)
+        with span('load_fits_errors'):
+            x_err, y_err, z_err = load_fits_errors(file_paths, region)
+    with span('load_fits_mask'):
+        mask = load_fits_mask(mask_path) if mask_path is not None else None
+        if mask is not None and region is not None:
+            mask = mask[region_slices(mask.shape, region)]
+    return FitsPoints(x, y, z, mask, shape, x_err, y_err, z_err)
+
+def draw_grid(ax, grid, cmap='viridis', link_color='gray'):
+    """Draw the model curves of a ModelGrid, returning the LineCollection for the colorbar."""
+    sel = grid.selection
+    with span('draw_model_curves', n_curves=len(grid.model_data_grouped)):
+        return draw_model_curves(ax, sel.xqulr, sel.yqulr, grid.model_data_grouped, grid.shock_data_grouped,
+                                 grid.precursor_data_grouped, sel.vmin, sel.vmax, sel.vstep, sel.independent,
+                                 cmap, link_color)
+
+def draw_points(ax, points, selection, colour_by='z'):
+    """Scatter FitsPoints, coloured by z on the selection's velocity scale, or by field for mosaic points."""
+    if colour_by == 'field' and points.field is not None:
+        keep = ~points.mask
+        with span('draw_field_points', n_points=len(points.x)):
+            draw_field_points(ax, points.x[keep], points.y[keep], points.field[keep], points.field_names)
+        return
+    with span('draw_fits_points', n_points=len(points.x)):
+        draw_fits_points(ax, points.x, points.y, points.z, True, points.mask, selection.vmin, selection.vmax)
+
+def draw_point_errors(ax, points, n_draws=1000, seed=None):
+    """
+    Monte Carlo the x/y errors of unmasked FitsPoints and outline their error ellipses.
+
+    Does nothing if the FITS files had no error extensions for x or y.
+    """
+    if points.x_err is None and points.y_err is None:
+        return None
+
+    # Imported here so the Monte Carlo module is only loaded when errors are drawn
+    from analysis.monte_carlo import error_ellipses
+
+    keep = ~points.mask
+    x_err = points.x_err[keep] if points.x_err is not None else None
+    y_err = points.y_err[keep] if points.y_err is not None else None
+    ellipses = error_ellipses([points.x[keep], points.y[keep]], [x_err, y_err], n_draws=n_draws, seed=seed)
+    # The last output is the fraction of draws dropped, which is not drawn
+    return draw_error_ellipses(ax, *ellipses[:5])
+
+def finalize_diagram(fig, ax, lc, grid):
+    """Add colorbar, log scales and labels for a ModelGrid."""
+    sel = grid.selection
+    with span('finalize_plot'):
+        return finalize_plot(fig, ax, lc, grid.x_lab, grid.y_lab, sel.abundance, sel.density)
+
+def render_diagnostic(fig, ax, grid, points=None, colour_by='z'):
+    """
+    Draw a complete diagnostic diagram onto existing Figure/Axes.
+
+    Returns the colorbar so callers can remove it before the next redraw.
+    """
+    lc = draw_grid(ax, grid)
+    if points is not None:
+        draw_points(ax, points, grid.selection, colour_by)
+    return finalize_diagram(fig, ax, lc, grid)
+
+def render_figure(grid, points=None, figsize=(6, 6)):
+    """Render onto a new Agg-backed Figure (no pyplot state, safe in worker processes)."""
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    fig.subplots_adjust(left=0.25, bottom=0.15, right=0.75, top=0.85)
+    render_diagnostic(fig, ax, grid, points)
+    return fig
+
+def render_to_array(grid, points=None, figsize=(6, 6), dpi=100):
+    """Render a diagnostic diagram headlessly and return it as an (H, W, 4) uint8 RGBA array."""
+    fig = render_figure(grid, points, figsize)
+    fig.set_dpi(dpi)
+    with span('canvas.draw'):
+        fig.canvas.draw()
+    return np.asarray(fig.canvas.buffer_rgba()).copy()
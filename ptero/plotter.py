@@ -1,8 +1,9 @@
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib import colormaps
+from matplotlib.colors import Normalize
 from matplotlib.collections import LineCollection
 
-def draw_model_curves(ax, xqulr, yqulr, model_data_grouped, shock_data_grouped, precursor_data_grouped, vmin, vmax, vstep, independent):
+def draw_model_curves(ax, xqulr, yqulr, model_data_grouped, shock_data_grouped, precursor_data_grouped, vmin, vmax, vstep, independent, cmap='viridis', link_color='gray'):
 
     last_lc = None
 
@@ -38,8 +39,8 @@ def draw_model_curves(ax, xqulr, yqulr, model_data_grouped, shock_data_grouped,
             prec_segments = np.concatenate([prec_points[:-1], prec_points[1:]], axis=1)
 
             # Create a LineCollection with colors based on 'shocks'
-            shck_lc = LineCollection(shck_segments, cmap='viridis', norm=plt.Normalize(vmin, vmax))
-            prec_lc = LineCollection(prec_segments, cmap='viridis', norm=plt.Normalize(vmin, vmax))
+            shck_lc = LineCollection(shck_segments, cmap=cmap, norm=Normalize(vmin, vmax))
+            prec_lc = LineCollection(prec_segments, cmap=cmap, norm=Normalize(vmin, vmax))
             shck_lc.set_array(shck_vels)
             prec_lc.set_array(shck_vels)
             ax.add_collection(shck_lc)
@@ -60,8 +61,8 @@ def draw_model_curves(ax, xqulr, yqulr, model_data_grouped, shock_data_grouped,
                 prev_prec_xdata = precursor_data_grouped[i - 1].iloc[:, x_id].values
                 prev_prec_ydata = precursor_data_grouped[i - 1].iloc[:, y_id].values
 
-                ax.plot((shck_xdata, prev_shck_xdata), (shck_ydata, prev_shck_ydata), color='gray', alpha=0.5)
-                ax.plot((prec_xdata, prev_prec_xdata), (prec_ydata, prev_prec_ydata), color='gray', alpha=0.5)
+                ax.plot((shck_xdata, prev_shck_xdata), (shck_ydata, prev_shck_ydata), color=link_color, alpha=0.5)
+                ax.plot((prec_xdata, prev_prec_xdata), (prec_ydata, prev_prec_ydata), color=link_color, alpha=0.5)
 
     else:
         # Loop over each magnetic field group
@@ -82,14 +83,15 @@ def draw_model_curves(ax, xqulr, yqulr, model_data_grouped, shock_data_grouped,
             model_ylab = model_data.columns[y_id]
             shck_vels = model_data.iloc[:, 0].values
 
-            # TODO: Add in changes to shock velocities with vstep
+            # Curves arrive already on the vstep velocity grid (window_model_grid),
+            # interpolated between model velocities when requested
 
             # Convert x_data and y_data into a sequence of line segments
             points = np.array([model_xdata, model_ydata]).T.reshape(-1, 1, 2)
             segments = np.concatenate([points[:-1], points[1:]], axis=1)
 
             # Create a LineCollection with colors based on 'shocks'
-            shck_lc = LineCollection(segments, cmap='viridis', norm=plt.Normalize(vmin, vmax))
+            shck_lc = LineCollection(segments, cmap=cmap, norm=Normalize(vmin, vmax))
             shck_lc.set_array(shck_vels)
             ax.add_collection(shck_lc)
             last_lc = shck_lc
@@ -104,7 +106,7 @@ def draw_model_curves(ax, xqulr, yqulr, model_data_grouped, shock_data_grouped,
                 # Access previous model data
                 prev_model_xdata = model_data_grouped[i - 1].iloc[:, x_id].values
                 prev_model_ydata = model_data_grouped[i - 1].iloc[:, y_id].values
-                ax.plot((model_xdata, prev_model_xdata), (model_ydata, prev_model_ydata), color='gray', alpha=0.5)
+                ax.plot((model_xdata, prev_model_xdata), (model_ydata, prev_model_ydata), color=link_color, alpha=0.5)
 
     return last_lc
 
@@ -136,6 +138,59 @@ def draw_fits_points(ax, fits_x, fits_y, fits_z, use_fits_mask, fits_mask, vmin,
         alpha=0.5
     )
 
+def draw_field_points(ax, fits_x, fits_y, field, field_names):
+    """
+    Plot data points from several fields, one colour per field.
+
+    Parameters:
+    - ax: matplotlib Axes object to draw on
+    - fits_x, fits_y: 1D arrays of same length, for scatter plot
+    - field: 1D array of field IDs (indices into field_names)
+    - field_names: list of field names, used for the legend
+    """
+    cmap = colormaps['tab20' if len(field_names) > 10 else 'tab10']
+
+    # Rows of one field are contiguous in a mosaic store, so only sort if they are not
+    field = np.asarray(field)
+    order = np.arange(len(field)) if np.all(field[1:] >= field[:-1]) else np.argsort(field, kind='stable')
+    ids, starts = np.unique(field[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    for field_id, start, end in zip(ids, starts, ends):
+        rows = order[start:end]
+        ax.scatter(
+            fits_x[rows],
+            fits_y[rows],
+            color=cmap(field_id % cmap.N),
+            marker='.',
+            alpha=0.5,
+            label=field_names[field_id]
+        )
+    ax.legend(loc='best', fontsize=8, markerscale=2)
+
+def draw_error_ellipses(ax, centre_x, centre_y, width, height, angle, n_vertices=32, color='gray', alpha=0.3):
+    """
+    Outline per-pixel error ellipses computed in log10 space (see analysis.monte_carlo.error_ellipses).
+
+    Parameters:
+    - ax: matplotlib Axes object with log x and y scales
+    - centre_x, centre_y, width, height: 1D arrays in dex
+    - angle: 1D array of angles in degrees
+    """
+    # Build every ellipse outline at once in log space, then map back to linear
+    t = np.linspace(0, 2 * np.pi, n_vertices + 1)
+    theta = np.radians(angle)[:, None]
+    a = 0.5 * width[:, None] * np.cos(t)
+    b = 0.5 * height[:, None] * np.sin(t)
+    log_x = centre_x[:, None] + a * np.cos(theta) - b * np.sin(theta)
+    log_y = centre_y[:, None] + a * np.sin(theta) + b * np.cos(theta)
+    outlines = np.stack([10**log_x, 10**log_y], axis=-1)
+
+    # Skip pixels whose ellipse could not be computed
+    outlines = outlines[np.all(np.isfinite(outlines), axis=(1, 2))]
+    ec = LineCollection(outlines, colors=color, alpha=alpha, linewidths=0.5)
+    ax.add_collection(ec)
+    return ec
+
 def finalize_plot(fig, ax, lc, x_lab, y_lab, abun, dens):
     """
     Add colorbar, labels, title, and log scales to the plot.
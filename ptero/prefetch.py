@@ -0,0 +1,153 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Custom function declarations
+from data_io.query_3mdbs_tools import populate_abundance_dropdown, populate_density_dropdown, send_3mdbs_query
+from data_io.result_cache import QUERY_CACHE, query_key
+from reactive import grid_query_args
+from profiling import span
+
+# Speculative fetching of the model grids next to the one on screen. Users
+# mostly step one entry along the density or abundance dropdown, so once a
+# grid is displayed its neighbours (same lines and model type, adjacent
+# density or abundance) are queried on a small pool of low-priority threads
+# into QUERY_CACHE. Finding the neighbours can itself need dropdown queries,
+# so that also happens on the pool, never on the GUI thread. Moving to another
+# selection cancels whatever has not started yet; a query already running is
+# left to finish, since the cache keeps its result either way.
+
+def _lower_priority(niceness):
+    # Linux schedules threads individually, so this only affects the worker
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)
+    except (AttributeError, OSError):
+        pass
+
+def _query_task(args):
+    def fetch():
+        with span('prefetch.query'):
+            return send_3mdbs_query(*args)
+    return fetch
+
+class GridPrefetcher:
+    """
+    Prefetches neighbouring model grids of a DiagramSelection into QUERY_CACHE.
+
+    Parameters:
+    - max_workers: queries run at the same time (the concurrency cap)
+    - niceness: scheduling priority added to the worker threads (Linux only)
+    - cache: ResultCache shared with the grid_fetch stage
+    - abundances: abundance dropdown entries of the Allen08 models, if already
+      known (queried otherwise)
+    """
+    def __init__(self, max_workers=2, niceness=10, cache=QUERY_CACHE, abundances=None):
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetch',
+                                           initializer=_lower_priority, initargs=(niceness,))
+        self.futures = {}
+        self._plan = None
+        self._generation = 0
+        self._abundances = {'Allen08': list(abundances)} if abundances is not None else {}
+        self._densities = {}
+        self._lock = threading.Lock()
+
+    def abundances(self, ref='Allen08'):
+        if ref not in self._abundances:
+            self._abundances[ref] = populate_abundance_dropdown(ref)
+        return self._abundances[ref]
+
+    def densities(self, abundance, ref='Allen08'):
+        '''Density dropdown entries (as strings) of an abundance, cached per abundance.'''
+        if (ref, abundance) not in self._densities:
+            self._densities[ref, abundance] = [str(d) for d in populate_density_dropdown(abundance, ref)]
+        return self._densities[ref, abundance]
+
+    def neighbours(self, selection):
+        """
+        Selections one step away in density (same abundance) or in abundance
+        (same density, where that abundance has it), nearest first.
+        """
+        found = []
+        densities = self.densities(selection.abundance, selection.ref)
+        if selection.density in densities:
+            i = densities.index(selection.density)
+            found += [selection.replace(density=densities[j]) for j in (i + 1, i - 1) if 0 <= j < len(densities)]
+
+        abundances = self.abundances(selection.ref)
+        if selection.abundance in abundances:
+            i = abundances.index(selection.abundance)
+            for j in (i + 1, i - 1):
+                if 0 <= j < len(abundances) and selection.density in self.densities(abundances[j], selection.ref):
+                    found.append(selection.replace(abundance=abundances[j]))
+        return found
+
+    def schedule(self, selection):
+        """
+        Queue the neighbours of a displayed selection that are not cached yet.
+
+        Returns at once: queued work is cancelled, so the neighbours are
+        looked up next on the pool, and any still wanted are queued again.
+        Returns the Future of that step, whose result is the number of
+        queries submitted.
+        """
+        with self._lock:
+            self._new_generation()
+            self._cancel(keep=())
+            self._plan = self.executor.submit(self._schedule_neighbours, selection, self._generation)
+            return self._plan
+
+    def _new_generation(self):
+        # Plans of older selections stop before submitting anything
+        self._generation += 1
+        if self._plan is not None:
+            self._plan.cancel()
+            self._plan = None
+
+    def _schedule_neighbours(self, selection, generation):
+        with span('prefetch.schedule'):
+            wanted = {}
+            for neighbour in self.neighbours(selection):
+                args = grid_query_args(neighbour)
+                wanted[query_key(*args)] = args
+
+        with self._lock:
+            if generation != self._generation:
+                return 0
+            self._cancel(keep=wanted)
+            submitted = 0
+            for key, args in wanted.items():
+                if key in self.futures:
+                    continue
+                future = self.cache.prefetch(key, _query_task(args), self.executor)
+                if future is not None:
+                    self.futures[key] = future
+                    submitted += 1
+            return submitted
+
+    def retarget(self, selection):
+        '''Cancel queued work that is not the grid of selection itself (called when the controls change).'''
+        with self._lock:
+            self._new_generation()
+            self._cancel(keep={query_key(*grid_query_args(selection))})
+
+    def cancel(self):
+        with self._lock:
+            self._new_generation()
+            self._cancel(keep=())
+
+    def _cancel(self, keep):
+        for key, future in list(self.futures.items()):
+            if future.done():
+                del self.futures[key]
+            elif key not in keep and future.cancel():
+                del self.futures[key]
+
+    def pending(self):
+        '''Number of prefetches queued or running.'''
+        with self._lock:
+            return sum(not future.done() for future in self.futures.values())
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,170 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+# Lightweight stage timing for PTERO. Wrap a stage in `with span('name'):` and,
+# while the profiler is enabled, its wall time, CPU time and (optionally) peak
+# Python allocation are recorded. Disabled spans cost one attribute check.
+#
+#   PROFILER.enable(trace_memory=True)
+#   ... plot ...
+#   PROFILER.to_chrome_trace('trace.json')   # open in chrome://tracing or Perfetto
+#
+# Setting PTERO_PROFILE=1 (or PTERO_PROFILE=memory) enables it at import time.
+# Only the most recent max_spans spans are kept, so a long session's memory
+# and the cost of finding the last stage stay bounded.
+
+class Span:
+    """One completed stage: timings in seconds, peak allocation in bytes (None if not traced)."""
+    def __init__(self, name, start, wall, cpu, peak_bytes, depth, thread_id, args):
+        self.name = name
+        self.start = start
+        self.wall = wall
+        self.cpu = cpu
+        self.peak_bytes = peak_bytes
+        self.depth = depth
+        self.thread_id = thread_id
+        self.args = args
+
+    def as_dict(self):
+        return dict(name=self.name, start=self.start, wall=self.wall, cpu=self.cpu, peak_bytes=self.peak_bytes,
+                    depth=self.depth, thread_id=self.thread_id, args=self.args)
+
+class Profiler:
+    def __init__(self, max_spans=100000):
+        self.enabled = False
+        self.trace_memory = False
+        self.spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+
+    def enable(self, trace_memory=False):
+        self.enabled = True
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.trace_memory = False
+
+    def state(self):
+        '''(enabled, trace_memory), for restore() after a temporary enable().'''
+        return self.enabled, self.trace_memory
+
+    def restore(self, state):
+        enabled, trace_memory = state
+        if (self.enabled, self.trace_memory) == (enabled, trace_memory):
+            return
+        self.disable()
+        if enabled:
+            self.enable(trace_memory)
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+
+        stack = self._stack()
+        trace_memory = self.trace_memory and tracemalloc.is_tracing()
+        frame = {'max_peak': 0}
+        if trace_memory:
+            # tracemalloc keeps a single peak, so hand the parent what it has seen
+            # so far before resetting it for this span
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1]['max_peak'] = max(stack[-1]['max_peak'], peak)
+            tracemalloc.reset_peak()
+            frame['start_mem'] = current
+        stack.append(frame)
+
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+            stack.pop()
+
+            peak_bytes = None
+            if trace_memory and tracemalloc.is_tracing():
+                peak = max(frame['max_peak'], tracemalloc.get_traced_memory()[1])
+                peak_bytes = max(peak - frame['start_mem'], 0)
+                if stack:
+                    stack[-1]['max_peak'] = max(stack[-1]['max_peak'], peak)
+
+            record = Span(name, start - self._origin, wall, cpu, peak_bytes, len(stack), threading.get_ident(), args)
+            with self._lock:
+                self.spans.append(record)
+
+    def last_tree(self):
+        '''Spans of the most recent top-level stage (and everything nested in it), in start order.'''
+        # Spans are appended as they finish, so a stage's nested spans come
+        # just before it; walk back from the end instead of over every span
+        tree, root = [], None
+        with self._lock:
+            for s in reversed(self.spans):
+                if root is None:
+                    if s.depth == 0:
+                        root = s
+                        tree.append(s)
+                elif s.start + s.wall < root.start:
+                    break
+                elif s.thread_id == root.thread_id and s.start >= root.start:
+                    tree.append(s)
+        return sorted(tree, key=lambda s: (s.start, s.depth))
+
+    def format_tree(self, spans=None):
+        '''Plain-text table of spans (default: last_tree()), indented by nesting depth.'''
+        spans = self.last_tree() if spans is None else spans
+        lines = [f"{'stage':<36} {'wall ms':>9} {'cpu ms':>9} {'peak MB':>9}"]
+        for s in spans:
+            peak = f'{s.peak_bytes / 2**20:9.1f}' if s.peak_bytes is not None else f"{'-':>9}"
+            lines.append(f"{'  ' * s.depth + s.name:<36} {s.wall * 1e3:9.1f} {s.cpu * 1e3:9.1f} {peak}")
+        return '\n'.join(lines)
+
+    def to_json(self, file_path):
+        with self._lock:
+            spans = [s.as_dict() for s in self.spans]
+        with open(file_path, 'w') as f:
+            json.dump(spans, f, indent=1)
+
+    def to_chrome_trace(self, file_path):
+        '''Write spans in the Chrome/Perfetto trace event format (complete "X" events, microseconds).'''
+        pid = os.getpid()
+        with self._lock:
+            events = [{
+                'name': s.name,
+                'ph': 'X',
+                'ts': s.start * 1e6,
+                'dur': s.wall * 1e6,
+                'pid': pid,
+                'tid': s.thread_id,
+                'args': dict(s.args, cpu_ms=s.cpu * 1e3, peak_bytes=s.peak_bytes),
+            } for s in self.spans]
+        with open(file_path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+PROFILER = Profiler()
+span = PROFILER.span
+
+if os.environ.get('PTERO_PROFILE'):
+    PROFILER.enable(trace_memory=os.environ['PTERO_PROFILE'] == 'memory')
@@ -0,0 +1,193 @@
+# Custom function declarations
+from data_io.line_catalog import line_names, quantity_names
+from data_io.result_cache import cached_send_3mdbs_query
+from pipeline import DiagramSelection, FitsPoints, build_model_grid, window_model_grid, render_diagnostic
+from analysis.binning import bin_points
+from profiling import span
+
+# Native velocity grid of the models. The grid is always fetched over the full
+# range so that changing the velocity window or step never re-queries 3MdBs.
+FULL_VMIN, FULL_VMAX, FULL_VSTEP = 100, 1000, 25
+
+class StageError(Exception):
+    """Raised when a stage function fails; records which stage it was."""
+    def __init__(self, stage, error):
+        super().__init__(f'{stage}: {error}')
+        self.stage = stage
+        self.error = error
+
+def _same(a, b):
+    # Arrays and other objects without a plain boolean == are compared by identity
+    if a is b:
+        return True
+    try:
+        return bool(a == b)
+    except (TypeError, ValueError):
+        return False
+
+class ReactivePipeline:
+    """
+    A small dependency graph of cached stages.
+
+    Parameters are set with set(); stages are functions whose keyword arguments
+    name parameters or other stages. get() recomputes a stage only if one of its
+    inputs has changed since it was last computed, so a change to one control
+    only reruns the stages downstream of it.
+    """
+    def __init__(self):
+        self.params = {}
+        self.stages = {}
+        self._versions = {}
+        self._cache = {}
+
+    def add_stage(self, name, func, inputs):
+        self.stages[name] = (func, list(inputs))
+        self._cache.pop(name, None)
+
+    def set(self, **params):
+        '''Update parameters, bumping the version of those whose value actually changed.'''
+        for name, value in params.items():
+            if name in self.params and _same(self.params[name], value):
+                continue
+            self.params[name] = value
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+    def invalidate(self, name):
+        '''Force a stage (and so everything downstream) to recompute on the next get().'''
+        self._cache.pop(name, None)
+
+    def _input_versions(self, name):
+        _, inputs = self.stages[name]
+        versions = []
+        for inp in inputs:
+            if inp in self.stages:
+                self.get(inp)
+                versions.append(self._cache[inp][2])
+            else:
+                versions.append(self._versions.get(inp, 0))
+        return tuple(versions)
+
+    def is_stale(self, name):
+        '''True if get(name) would recompute the stage itself.'''
+        if name not in self._cache:
+            return True
+        _, inputs = self.stages[name]
+        for inp in inputs:
+            if inp in self.stages:
+                if self.is_stale(inp):
+                    return True
+        cached_versions = self._cache[name][0]
+        versions = tuple(self._cache[inp][2] if inp in self.stages else self._versions.get(inp, 0) for inp in inputs)
+        return versions != cached_versions
+
+    def get(self, name):
+        func, inputs = self.stages[name]
+        versions = self._input_versions(name)
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == versions:
+            return cached[1]
+
+        kwargs = {inp: (self._cache[inp][1] if inp in self.stages else self.params.get(inp)) for inp in inputs}
+        with span(f'stage.{name}'):
+            try:
+                value = func(**kwargs)
+            except StageError:
+                raise
+            except Exception as e:
+                raise StageError(name, e) from e
+
+        # A stage's own version only moves when it is recomputed
+        version = cached[2] + 1 if cached is not None else 1
+        self._cache[name] = (versions, value, version)
+        return value
+
+class DiagramCanvas:
+    """Figure/Axes pair that remembers its colorbar so a redraw can remove it first."""
+    def __init__(self, fig, ax):
+        self.fig = fig
+        self.ax = ax
+        self.cbar = None
+
+    def redraw(self, grid, points=None, colour_by='z'):
+        if self.cbar is not None:
+            self.cbar.remove()
+            self.cbar = None
+        self.ax.clear()
+        self.cbar = render_diagnostic(self.fig, self.ax, grid, points, colour_by)
+        return self.cbar
+
+# Controls that change what has to be fetched from 3MdBs
+QUERY_PARAMS = ['xquan', 'yquan', 'xnum', 'xden', 'ynum', 'yden', 'abundance', 'density', 'shock', 'precursor', 'independent', 'ref']
+
+def _catalog():
+    return line_names(), quantity_names()
+
+def grid_query_args(selection):
+    '''send_3mdbs_query arguments the grid_fetch stage uses for a DiagramSelection.'''
+    return selection.replace(vmin=FULL_VMIN, vmax=FULL_VMAX).query_args()
+
+def _grid_fetch(catalog, xquan, yquan, xnum, xden, ynum, yden, abundance, density, shock, precursor, independent, ref):
+    # Reject unknown names here rather than as an SQL error from 3MdBs
+    lines, quantities = catalog
+    for param, name, names in [('xnum', xnum, lines), ('xden', xden, lines), ('ynum', ynum, lines), ('yden', yden, lines),
+                               ('xquan', xquan, quantities), ('yquan', yquan, quantities)]:
+        if name not in names:
+            raise ValueError(f'<{param}> must be one of {names}. You entered {name}')
+    return cached_send_3mdbs_query(xquan, yquan, xnum, xden, ynum, yden, abundance, density,
+                                   FULL_VMIN, FULL_VMAX, precursor, shock, independent, ref)
+
+def _ratio_evaluation(grid_fetch, xqulr, yqulr, xquan, yquan, xnum, xden, ynum, yden, abundance, density, shock, precursor, independent, ref):
+    # Full-resolution grid with the x/y choice; the window is applied downstream
+    selection = DiagramSelection(xqulr, yqulr, abundance, density, xquan, yquan, xnum, xden, ynum, yden,
+                                 FULL_VMIN, FULL_VMAX, FULL_VSTEP, shock, precursor, independent, ref)
+    return build_model_grid(selection, grid_fetch)
+
+def _velocity_window(ratio_evaluation, vmin, vmax, vstep, curve_interp):
+    return window_model_grid(ratio_evaluation, vmin, vmax, vstep, curve_interp)
+
+def _fits_preparation(fits_points, fits_mask, bin_target_sn):
+    # Drop masked pixels once, so redraws do not re-mask full maps
+    if fits_points is None:
+        return None
+    if bin_target_sn:
+        # One point per S/N bin; the bin assignment itself is cached by content
+        binned, _ = bin_points(fits_points, bin_target_sn, fits_mask)
+        return binned
+    keep = ~(fits_points.mask if fits_mask is None else fits_mask)
+    field = fits_points.field[keep] if fits_points.field is not None else None
+    return FitsPoints(fits_points.x[keep], fits_points.y[keep], fits_points.z[keep], field=field, field_names=fits_points.field_names)
+
+def _render(canvas, velocity_window, fits_preparation, colour_by):
+    return canvas.redraw(velocity_window, fits_preparation, colour_by or 'z')
+
+def build_diagram_pipeline(canvas=None):
+    """
+    Reactive version of the MainWindow plotting path:
+    catalog -> grid_fetch -> ratio_evaluation -> velocity_window -> render,
+    with fits_preparation feeding render alongside.
+
+    Set every QUERY_PARAMS entry plus xqulr, yqulr, vmin, vmax, vstep,
+    fits_points (FitsPoints or None), fits_mask (bad pixel mask overriding
+    fits_points.mask, or None), bin_target_sn (S/N to bin the FITS pixels to,
+    or None), colour_by ('z' or 'field'), curve_interp (None for native model
+    velocities, or 'linear'/'spline' to interpolate curves onto vstep) and
+    canvas (a DiagramCanvas), then get('render').
+    Parameters are compared by value, arrays by identity, so pass a new mask
+    array rather than editing one in place.
+    """
+    pipeline = ReactivePipeline()
+    pipeline.add_stage('catalog', _catalog, [])
+    pipeline.add_stage('grid_fetch', _grid_fetch, ['catalog'] + QUERY_PARAMS)
+    pipeline.add_stage('ratio_evaluation', _ratio_evaluation, ['grid_fetch', 'xqulr', 'yqulr'] + QUERY_PARAMS)
+    pipeline.add_stage('velocity_window', _velocity_window, ['ratio_evaluation', 'vmin', 'vmax', 'vstep', 'curve_interp'])
+    pipeline.add_stage('fits_preparation', _fits_preparation, ['fits_points', 'fits_mask', 'bin_target_sn'])
+    pipeline.add_stage('render', _render, ['canvas', 'velocity_window', 'fits_preparation', 'colour_by'])
+    pipeline.set(fits_points=None, fits_mask=None, bin_target_sn=None, colour_by='z', ref='Allen08', curve_interp=None)
+    if canvas is not None:
+        pipeline.set(canvas=canvas)
+    return pipeline
+
+def selection_params(selection):
+    '''Pipeline parameters equivalent to a DiagramSelection.'''
+    names = QUERY_PARAMS + ['xqulr', 'yqulr', 'vmin', 'vmax', 'vstep']
+    return {name: getattr(selection, name) for name in names}